@@ -0,0 +1,107 @@
+"""Benchmarks the throughput (messages/sec) of the communication queue.
+
+Compares the previous write path (one transaction, one WAL checkpoint and a
+1 ms sleep per message on the calling thread) with the buffered
+`enqueue_message` and the `enqueue_many` group commit, both measured until
+the writer thread committed all messages. Runs against a temporary database.
+
+Usage: python scripts/benchmark_communication_queue.py [--messages 2000]
+"""
+
+import argparse
+import dataclasses
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+os.environ["ACROPOLIS_DATA_PATH"] = tempfile.mkdtemp(
+    prefix="acropolis-queue-benchmark-")
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from interfaces import communication_queue
+from custom_types import mqtt_playload_types
+
+PAYLOAD = mqtt_playload_types.MQTTCO2Data(
+    gmp343_raw=420.1,
+    gmp343_compensated=421.2,
+    gmp343_filtered=421.0,
+    gmp343_edge_corrected=None,
+    gmp343_edge_dry=None,
+    gmp343_temperature=30.5,
+    bme280_temperature=21.3,
+    bme280_humidity=45.2,
+    bme280_pressure=955.4,
+    sht45_temperature=21.1,
+    sht45_humidity=44.9,
+)
+
+
+def _reset_queue(queue: communication_queue.CommunicationQueue,
+                 con: sqlite3.Connection) -> None:
+    queue.flush()
+    con.execute("DELETE FROM messages;")
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+
+
+def legacy_enqueue(con: sqlite3.Connection, n: int) -> None:
+    """Write path before the group commit was introduced."""
+    con.execute("PRAGMA synchronous=FULL;")
+    for _ in range(n):
+        con.execute(
+            "INSERT INTO messages (ts_ms, type, payload) VALUES(?, ?, ?);",
+            (int(time.time_ns() / 1_000_000), "measurement",
+             json.dumps(dataclasses.asdict(PAYLOAD))))
+        con.execute("PRAGMA wal_checkpoint(PASSIVE);")
+        time.sleep(1 / 1000)
+
+
+def buffered_enqueue(queue: communication_queue.CommunicationQueue,
+                     n: int) -> None:
+    for _ in range(n):
+        queue.enqueue_message("measurement", PAYLOAD)
+    queue.flush()
+
+
+def enqueue_many(queue: communication_queue.CommunicationQueue,
+                 n: int) -> None:
+    queue.enqueue_many([("measurement", PAYLOAD)] * n)
+    queue.flush()
+
+
+def run(label: str, fn: Callable[[int], None],
+        queue: communication_queue.CommunicationQueue,
+        con: sqlite3.Connection, n: int) -> float:
+    _reset_queue(queue, con)
+    start = time.perf_counter()
+    fn(n)
+    duration = time.perf_counter() - start
+    rows = con.execute("SELECT COUNT(*) FROM messages;").fetchone()[0]
+    assert rows == n, f"{label}: expected {n} rows, found {rows}"
+    rate = n / duration
+    print(f"{label:<28} {n:>7} messages {duration:>8.3f} s "
+          f"{rate:>10.0f} messages/sec")
+    return rate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    queue = communication_queue.CommunicationQueue()
+    con = sqlite3.connect(queue.db_path, isolation_level=None)
+    print(f"database: {queue.db_path}")
+
+    before = run("before (per-message commit)",
+                 lambda n: legacy_enqueue(con, n), queue, con, args.messages)
+    after = run("after (enqueue_message)", lambda n: buffered_enqueue(
+        queue, n), queue, con, args.messages)
+    batch = run("after (enqueue_many)", lambda n: enqueue_many(queue, n),
+                queue, con, args.messages)
+    print(f"speedup: {after / before:.1f}x (enqueue_message), "
+          f"{batch / before:.1f}x (enqueue_many)")
@@ -111,6 +111,17 @@ class MeasurementConfig(BaseModel):
 # -----------------------------------------------------------------------------
 
 
+class CommunicationQueueConfig(BaseModel):
+    """Quota of messages buffered for the gateway while it is not available"""
+    model_config = ConfigDict(extra='forbid')
+
+    max_rows: int = Field(1_000_000, ge=1_000)
+    max_bytes: int = Field(256_000_000, ge=1_000_000)
+
+
+# -----------------------------------------------------------------------------
+
+
 class Config(BaseModel):
     """The config.json for each sensor"""
     model_config = ConfigDict(extra='forbid')
@@ -123,3 +134,5 @@ class Config(BaseModel):
     documentation: DocumentationConfig
     hardware: HardwareConfig
     measurement: MeasurementConfig
+    communication_queue: CommunicationQueueConfig = Field(
+        default_factory=CommunicationQueueConfig)
@@ -79,3 +79,12 @@ class MQTTWindSensorInfo():
     wxt532_supply_voltage: float
     wxt532_reference_voltage: float
     wxt532_last_update_time: float
+
+
+@dataclasses.dataclass
+class MQTTCommunicationQueueData():
+    communication_queue_written: int
+    communication_queue_dropped: int
+    communication_queue_compacted: int
+    communication_queue_evicted_logs: int
+    communication_queue_evicted: int
@@ -193,7 +193,8 @@ class CO2MeasurementModule:
                 bme280_pressure=self.air_inlet_bme280_data.pressure,
                 sht45_temperature=self.air_inlet_sht45_data.temperature,
                 sht45_humidity=self.air_inlet_sht45_data.humidity,
-            ), )
+            ),
+            timestamp_ms=self.co2_sensor.last_read_timestamp_ms)
 
     def send_CO2_calibration_data(self,
                                   CO2_sensor_data: sensor_types.CO2SensorData,
@@ -213,7 +214,8 @@ class CO2MeasurementModule:
                 cal_sht45_temperature=self.air_inlet_sht45_data.temperature,
                 cal_sht45_humidity=self.air_inlet_sht45_data.humidity,
                 cal_gmp343_temperature=CO2_sensor_data.temperature,
-            ), )
+            ),
+            timestamp_ms=self.co2_sensor.last_read_timestamp_ms)
 
     def send_calibration_correction_data(self) -> None:
 
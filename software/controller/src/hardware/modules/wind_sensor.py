@@ -51,7 +51,9 @@ class WindSensorModule:
                     wxt532_speed_avg=wind_sensor_data.speed_avg,
                     wxt532_speed_max=wind_sensor_data.speed_max,
                     wxt532_last_update_time=wind_sensor_data.last_update_time,
-                ), )
+                ),
+                # the time of the latest message of the sensor
+                timestamp_ms=round(wind_sensor_data.last_update_time * 1000))
         else:
             self.logger.info(f"did not receive any wind sensor measurement")
 
@@ -72,7 +74,9 @@ class WindSensorModule:
                     reference_voltage,
                     wxt532_last_update_time=wind_sensor_status.
                     last_update_time,
-                ), )
+                ),
+                timestamp_ms=round(wind_sensor_status.last_update_time *
+                                   1000))
 
         else:
             self.logger.info(f"did not receive any wind sensor device info")
@@ -9,6 +9,7 @@ except Exception:
 
 from custom_types import config_types
 from interfaces import logging_interface, communication_queue
+from utils import timestamps
 
 
 class Sensor(ABC):
@@ -34,6 +35,9 @@ class Sensor(ABC):
         self.retry_delay = retry_delay
         self.pin_factory = pin_factory
 
+        # acquisition time of the last successful read (ms since epoch)
+        self.last_read_timestamp_ms: Optional[int] = None
+
         # init logger with sensor class name
         self.logger = logging_interface.Logger(
             communication_queue=self.communication_queue,
@@ -81,15 +85,22 @@ class Sensor(ABC):
 
     def read(self, *args: Any, **kwargs: Any) -> Any:
         """Read the sensor value and forward dynamic arguments to _read.
+        Stores the acquisition time in `last_read_timestamp_ms`, None if the
+        read failed.
         Raises SimulatedValue if the sensor is in simulation mode.
         Raises SensorError if the read fails."""
 
         if self.simulate:
             self.logger.info("Simulating read.")
-            return self._simulate_read(*args, **kwargs)
+            simulated_value = self._simulate_read(*args, **kwargs)
+            self.last_read_timestamp_ms = timestamps.now_ms()
+            return simulated_value
 
+        self.last_read_timestamp_ms = None
         try:
-            return self._read(*args, **kwargs)
+            value = self._read(*args, **kwargs)
+            self.last_read_timestamp_ms = timestamps.now_ms()
+            return value
 
         except (BrokenPipeError, ConnectionError) as e:
             self.logger.exception(e, "Lost connection to pigpiod.")
@@ -1,12 +1,16 @@
 import os
 import sqlite3
+import threading
+from collections import deque
+from enum import IntEnum
 from os.path import dirname
 import dataclasses
-from typing import Union
+from typing import Any, Literal, Optional, Union
 import time
 import json
 
 from custom_types import mqtt_playload_types
+from utils import timestamps
 
 PROJECT_DIR = dirname(dirname(os.path.abspath(__file__)))
 ACROPOLIS_DATA_PATH = os.environ.get("ACROPOLIS_DATA_PATH") or os.path.join(
@@ -18,59 +22,652 @@ THINGSBOARD_PAYLOADS = Union[mqtt_playload_types.MQTTCO2Data,
                              mqtt_playload_types.MQTTSystemData,
                              mqtt_playload_types.MQTTWindData,
                              mqtt_playload_types.MQTTWindSensorInfo,
+                             mqtt_playload_types.MQTTCommunicationQueueData,
                              mqtt_playload_types.MQTTLogMessage]
 
 
+
+class MessagePriority(IntEnum):
+    """Priority lanes of the queue, the gateway drains each lane in id order
+    and schedules the lanes by weight (software/gateway/src/modules/sqlite.py).
+    BACKFILL is assigned by the gateway to live messages it received late."""
+    LIVE = 0
+    CALIBRATION = 1
+    LOG = 2
+    BACKFILL = 3
+
+
+MESSAGE_PRIORITIES: dict[type, MessagePriority] = {
+    mqtt_playload_types.MQTTCO2Data: MessagePriority.LIVE,
+    mqtt_playload_types.MQTTSystemData: MessagePriority.LIVE,
+    mqtt_playload_types.MQTTWindData: MessagePriority.LIVE,
+    mqtt_playload_types.MQTTWindSensorInfo: MessagePriority.LIVE,
+    mqtt_playload_types.MQTTCommunicationQueueData: MessagePriority.LIVE,
+    mqtt_playload_types.MQTTCO2CalibrationData: MessagePriority.CALIBRATION,
+    mqtt_playload_types.MQTTCalibrationCorrectionData:
+    MessagePriority.CALIBRATION,
+    mqtt_playload_types.MQTTLogMessage: MessagePriority.LOG,
+}
+
+# payloads sharing telemetry keys (`wxt532_last_update_time`) share a timestamp
+# series, so ThingsBoard doesn't overwrite the values of one with the other.
+# Other payloads are a series of their own.
+TIMESTAMP_SERIES: dict[type, str] = {
+    mqtt_playload_types.MQTTWindData: "wxt532",
+    mqtt_playload_types.MQTTWindSensorInfo: "wxt532",
+}
+
+# `payload` holds the JSON encoded values of the ThingsBoard telemetry message,
+# its timestamp is stored in `ts_ms` so the gateway does not need to parse it
+MESSAGES_TABLE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts_ms INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        priority INTEGER NOT NULL DEFAULT 0,
+        payload TEXT NOT NULL
+    );
+"""
+
+# stored as `user_version` of the db once the `messages` table has the current
+# schema. The gateway doesn't read the table before, because a migrated table
+# can't be written by a controller of a previous version.
+MESSAGES_SCHEMA_VERSION = 1
+
+# priority of messages written before the priority lanes were introduced
+LEGACY_PRIORITY_SQL = "CASE type WHEN 'log' THEN 2 ELSE 0 END"
+
+# eviction deletes messages in batches of this size until the usage of the
+# queue is below this ratio of its quota
+EVICTION_BATCH_SIZE = 1000
+EVICTION_TARGET_RATIO = 0.9
+
+# milliseconds to wait for a lock held by the gateway before failing a write
+BUSY_TIMEOUT_MS = 5000
+
+# seconds to wait before retrying a failed write, doubled up to the maximum
+WRITE_RETRY_DELAY_SECONDS = 0.5
+MAX_WRITE_RETRY_DELAY_SECONDS = 30
+# after this many failed attempts, a batch is written message by message and
+# messages which can't be written (e.g. an unknown payload type) are dropped
+WRITE_MAX_ATTEMPTS = 5
+
+# `shrink` is requested on every system check while the disk is full, but
+# the queue is not necessarily what fills it: it shrinks at most once per
+# interval and not below this ratio of its quota
+SHRINK_MIN_INTERVAL_SECONDS = 3600
+SHRINK_MIN_QUOTA_RATIO = 0.1
+
+
+def migrate_legacy_messages_table(con: sqlite3.Connection,
+                                  table: str = "messages") -> None:
+    """Migrates a table of a previous schema to the current one in a single
+    transaction: either (type, message) where message is the JSON encoded
+    {"ts": ..., "values": ...} or (ts_ms, type, payload) without priority.
+    Keeps the ids and the AUTOINCREMENT sequence."""
+    columns = [row[1] for row in con.execute(f"PRAGMA table_info({table});")]
+    if len(columns) == 0 or "priority" in columns:
+        return
+
+    con.execute("BEGIN IMMEDIATE;")
+    try:
+        if "message" not in columns:
+            con.execute(f"ALTER TABLE {table} ADD COLUMN "
+                        "priority INTEGER NOT NULL DEFAULT 0;")
+            con.execute(
+                f"UPDATE {table} SET priority = {LEGACY_PRIORITY_SQL};")
+        else:
+            con.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy;")
+            con.execute(MESSAGES_TABLE_SCHEMA.format(table=table))
+            con.execute(f"""
+                INSERT INTO {table} (id, ts_ms, type, priority, payload)
+                    SELECT id, json_extract(message, '$.ts'), type,
+                           {LEGACY_PRIORITY_SQL},
+                           json_extract(message, '$.values')
+                    FROM {table}_legacy
+                    WHERE json_valid(message)
+                      AND json_extract(message, '$.ts') IS NOT NULL
+                    ORDER BY id;
+            """)
+            # continue the id sequence of the legacy table
+            con.execute(
+                f"DELETE FROM sqlite_sequence WHERE name = '{table}';")
+            con.execute(f"""
+                INSERT INTO sqlite_sequence (name, seq)
+                    SELECT '{table}', seq FROM sqlite_sequence
+                    WHERE name = '{table}_legacy';
+            """)
+            con.execute(f"DROP TABLE {table}_legacy;")
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+
+
+@dataclasses.dataclass
+class EvictionCounts:
+    # messages merged into per-minute aggregates
+    compacted: int = 0
+    # DEBUG and INFO log messages
+    dropped_logs: int = 0
+    # other messages except for calibration messages
+    dropped: int = 0
+
+
+def get_queue_usage(con: sqlite3.Connection,
+                    table: str = "messages",
+                    max_bytes: Optional[int] = None) -> tuple[int, int]:
+    """Returns the number of rows and the payload bytes of the table.
+
+    The size of the database file is an upper bound of the payload bytes
+    and cheap to get. If it is below `max_bytes`, it is returned instead of
+    summing up the payloads."""
+    rows = con.execute(f"SELECT COUNT(*) FROM {table};").fetchone()[0]
+    page_size = con.execute("PRAGMA page_size;").fetchone()[0]
+    page_count = con.execute("PRAGMA page_count;").fetchone()[0]
+    freelist_count = con.execute("PRAGMA freelist_count;").fetchone()[0]
+    size = (page_count - freelist_count) * page_size
+    if max_bytes is None or size > max_bytes:
+        size = con.execute(
+            f"SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM {table};"
+        ).fetchone()[0]
+    return rows, size
+
+
+def _aggregate_values(values: list[dict[str, Any]]) -> dict[str, Any]:
+    """Merges the values of measurements into one: the minimum of `*_min`
+    keys, the maximum of `*_max` and `*_time` keys and the mean of other
+    numbers. Other values (e.g. booleans) are taken from the last one."""
+    aggregate = dict(values[-1])
+    for key in aggregate:
+        numbers = [
+            v[key] for v in values if isinstance(v.get(key), (int, float))
+            and not isinstance(v.get(key), bool)
+        ]
+        if len(numbers) == 0 or isinstance(aggregate[key], bool):
+            continue
+        if key.endswith("_min"):
+            aggregate[key] = min(numbers)
+        elif key.endswith("_max") or key.endswith("_time"):
+            aggregate[key] = max(numbers)
+        else:
+            aggregate[key] = sum(numbers) / len(numbers)
+    return aggregate
+
+
+def _compact_measurements(con: sqlite3.Connection, table: str,
+                          after_id: int) -> tuple[int, int, Optional[int]]:
+    """Merges the live measurements of the same kind (same keys) and the same
+    minute within the next batch after `after_id` into the first one of them.
+    Other message types like the queue statistics ("status") are kept.
+    Returns the number of deleted rows, the number of freed payload bytes and
+    the id to continue after (None if there are no more measurements)."""
+    rows = con.execute(
+        f"""
+        SELECT id, ts_ms, payload FROM {table}
+        WHERE type = 'measurement' AND id > ? AND priority IN (?, ?)
+        ORDER BY id LIMIT ?;
+    """, (after_id, MessagePriority.LIVE, MessagePriority.BACKFILL,
+          EVICTION_BATCH_SIZE)).fetchall()
+    if len(rows) == 0:
+        return 0, 0, None
+    if len(rows) == EVICTION_BATCH_SIZE:
+        # leave the last minute of a full batch for the next one
+        last_minute = rows[-1][1] // 60_000
+        complete_minutes = [r for r in rows if r[1] // 60_000 != last_minute]
+        if len(complete_minutes) > 0:
+            rows = complete_minutes
+
+    groups: dict[tuple[int, tuple[str, ...]], list[tuple[int, str]]] = {}
+    for id, ts_ms, payload in rows:
+        key = (ts_ms // 60_000, tuple(sorted(json.loads(payload).keys())))
+        groups.setdefault(key, []).append((id, payload))
+
+    updates: list[tuple[str, int]] = []
+    deleted_ids: list[int] = []
+    freed_bytes = 0
+    for group in groups.values():
+        if len(group) < 2:
+            continue
+        aggregate = json.dumps(
+            _aggregate_values([json.loads(p) for _, p in group]))
+        updates.append((aggregate, group[0][0]))
+        deleted_ids.extend(id for id, _ in group[1:])
+        freed_bytes += sum(len(p) for _, p in group) - len(aggregate)
+
+    if len(updates) > 0:
+        con.execute("BEGIN IMMEDIATE;")
+        try:
+            con.executemany(f"UPDATE {table} SET payload = ? WHERE id = ?;",
+                            updates)
+            con.execute(
+                f"DELETE FROM {table} WHERE id IN (SELECT value FROM json_each(?));",
+                (json.dumps(deleted_ids), ))
+            con.execute("COMMIT;")
+        except Exception:
+            con.execute("ROLLBACK;")
+            raise
+    return len(deleted_ids), freed_bytes, rows[-1][0]
+
+
+def evict_messages(con: sqlite3.Connection, table: str, max_rows: int,
+                   max_bytes: int) -> EvictionCounts:
+    """Enforces the row and payload byte quota of a messages table. If a quota
+    is exceeded, the usage is reduced below `EVICTION_TARGET_RATIO` of the
+    quota in stages, each stage only if the previous one did not suffice:
+
+    1. merge live measurements into per-minute aggregates
+    2. drop DEBUG and INFO log messages, oldest first
+    3. drop any other messages, oldest first
+
+    Calibration messages are never dropped."""
+    counts = EvictionCounts()
+    rows, size = get_queue_usage(con, table, max_bytes)
+    if rows <= max_rows and size <= max_bytes:
+        return counts
+
+    def is_above_target() -> bool:
+        return (rows > max_rows * EVICTION_TARGET_RATIO
+                or size > max_bytes * EVICTION_TARGET_RATIO)
+
+    cursor: Optional[int] = 0
+    while cursor is not None and is_above_target():
+        deleted, freed_bytes, cursor = _compact_measurements(
+            con, table, cursor)
+        counts.compacted += deleted
+        rows -= deleted
+        size -= freed_bytes
+
+    for stage, condition in [
+        ("dropped_logs", f"priority = {MessagePriority.LOG:d} AND "
+         "json_extract(payload, '$.severity') IN ('DEBUG', 'INFO')"),
+        ("dropped", f"priority != {MessagePriority.CALIBRATION:d}"),
+    ]:
+        while is_above_target():
+            freed = con.execute(f"""
+                DELETE FROM {table} WHERE id IN (
+                    SELECT id FROM {table} WHERE {condition}
+                    ORDER BY id LIMIT {EVICTION_BATCH_SIZE}
+                ) RETURNING LENGTH(payload);
+            """).fetchall()
+            if len(freed) == 0:
+                break
+            setattr(counts, stage, getattr(counts, stage) + len(freed))
+            rows -= len(freed)
+            size -= sum(length for length, in freed)
+
+    return counts
+
+
 class CommunicationQueue:
-    """Uses an SQLite database to store messages to be forwarded to the ThingsBoard server by the gateway"""
+    """Uses an SQLite database to store messages to be forwarded to the ThingsBoard server by the gateway
+
+    Enqueued messages are put into a bounded in-memory ring which is drained
+    by a dedicated writer thread, so callers never block on SQLite. The writer
+    owns the database connection and writes messages in a single transaction
+    (group commit) once `flush_max_messages` messages are pending or the
+    oldest pending message is older than `flush_interval_seconds`. The WAL
+    is checkpointed every `checkpoint_interval_seconds`.
+
+    When the ring holds `ring_size` messages, the `overflow_policy` decides
+    whether `enqueue_message` blocks until the writer caught up ("block") or
+    the oldest message is dropped ("drop").
+
+    Every `quota_check_interval_seconds`, the writer enforces the `max_rows`
+    and `max_bytes` quota of the messages table (see `evict_messages`), which
+    only grows while the gateway is not draining it."""
+
+    def __init__(self,
+                 flush_max_messages: int = 32,
+                 flush_interval_seconds: float = 5,
+                 checkpoint_interval_seconds: float = 60,
+                 ring_size: int = 4096,
+                 overflow_policy: Literal["block", "drop"] = "drop",
+                 max_rows: int = 1_000_000,
+                 max_bytes: int = 256_000_000,
+                 quota_check_interval_seconds: float = 60) -> None:
+        assert flush_max_messages > 0
+        assert ring_size > 0
+        self.db_path = os.path.join(ACROPOLIS_DATA_PATH,
+                                    "communication_queue.db")
+
+        self.flush_max_messages = flush_max_messages
+        self.flush_interval_seconds = flush_interval_seconds
+        self.checkpoint_interval_seconds = checkpoint_interval_seconds
+        self.ring_size = ring_size
+        self.overflow_policy = overflow_policy
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.quota_check_interval_seconds = quota_check_interval_seconds
+        # one-off eviction requested by `shrink`
+        self.shrink_factor: Optional[float] = None
+        self.last_shrink_time: Optional[float] = None
 
-    def __init__(self) -> None:
-        db_path = os.path.join(ACROPOLIS_DATA_PATH, "communication_queue.db")
+        # messages (type, timestamp_ms, payload) not yet written to the database
+        self.ring: deque[tuple[str, int, THINGSBOARD_PAYLOADS]] = deque()
+        self.condition = threading.Condition()
+        self.oldest_message_time: float = 0
+        self.flush_requested = False
+        self.pending_health_check_ts: Optional[int] = None
+        self.health_check_in_flight = False
+        self.closed = False
+        self.timestamp_allocator = timestamps.TimestampAllocator(
+            offset=timestamps.CONTROLLER_TIMESTAMP_OFFSET)
 
-        self.con = sqlite3.connect(db_path,
-                                   isolation_level=None,
-                                   autocommit=True)
+        # statistics
+        self.enqueued_count = 0
+        self.written_count = 0
+        self.dropped_count = 0
+        self.write_error_count = 0
+        self.last_write_error: Optional[str] = None
+        self.eviction_counts = EvictionCounts()
+
+        # create the tables upfront to surface schema errors on startup
+        con = self._connect()
+        migrate_legacy_messages_table(con)
         # Create queue_out for MQTT messages
-        self.con.execute("""
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    type text,
-                    message text
-                );
-            """)
+        con.execute(MESSAGES_TABLE_SCHEMA.format(table="messages"))
+        con.execute(
+            "CREATE INDEX IF NOT EXISTS messages_ts_ms_index ON messages (ts_ms);"
+        )
+        con.execute(
+            "CREATE INDEX IF NOT EXISTS messages_type_index ON messages (type, id);"
+        )
+        con.execute(
+            "CREATE INDEX IF NOT EXISTS messages_priority_index ON messages (priority, id);"
+        )
         # Create health_check_queue for health check messages
-        self.con.execute("""
+        con.execute("""
             CREATE TABLE IF NOT EXISTS health_check (
                 id INTEGER PRIMARY KEY,
-                timestamp_ms INTEGER            
+                timestamp_ms INTEGER
             );
         """)
-        self.con.execute("PRAGMA journal_mode=WAL;")
-
-    def enqueue_message(self, type: str,
-                        payload: THINGSBOARD_PAYLOADS) -> None:
-        new_message = {
-            "ts": int(time.time_ns() /
-                      1_000_000),  # ThingsBoard expects milliseconds
-            "values": dataclasses.asdict(payload),
-        }
-        try:
-            with self.con:
-                sql_statement: str = "INSERT INTO messages (type, message) VALUES(?, ?);"
-                self.con.execute(sql_statement,
-                                 (type, json.dumps(new_message)))
-                self.con.execute("PRAGMA wal_checkpoint(PASSIVE);")
+        con.execute("PRAGMA journal_mode=WAL;")
+        con.execute(f"PRAGMA user_version = {MESSAGES_SCHEMA_VERSION};")
+        con.close()
 
-            time.sleep(1 / 1000)  # sleep for 1ms to avoid duplicate timestamps
-        except Exception:
-            exit(0)
+        self.writer_thread = threading.Thread(
+            target=self._run_writer,
+            name="communication-queue-writer",
+            daemon=True)
+        self.writer_thread.start()
+
+    def enqueue_message(self,
+                        type: str,
+                        payload: THINGSBOARD_PAYLOADS,
+                        timestamp_ms: Optional[int] = None) -> None:
+        """Puts a message into the ring. Thread-safe, does not touch SQLite.
+
+        `timestamp_ms` is the acquisition time of the payload (default: now),
+        it is bumped by the allocator if it collides with a previous one."""
+        with self.condition:
+            self._append_message(type, payload, timestamp_ms)
+            # wake up the writer to schedule the flush of a new batch
+            if (len(self.ring) == 1
+                    or len(self.ring) >= self.flush_max_messages):
+                self.condition.notify_all()
+
+    def enqueue_many(
+            self, messages: list[tuple[str, THINGSBOARD_PAYLOADS]]) -> None:
+        """Puts all given (type, payload) messages into the ring and requests
+        the writer to commit them in one transaction."""
+        with self.condition:
+            for type, payload in messages:
+                self._append_message(type, payload)
+            self.flush_requested = True
+            self.condition.notify_all()
 
     def enqueue_health_check(self) -> None:
-        ts = int(time.time_ns() / 1_000_000)
+        """Schedules an update of the health check timestamp, written
+        together with the next batch of messages."""
+        with self.condition:
+            self.pending_health_check_ts = timestamps.now_ms()
+            self.condition.notify_all()
+
+    def flush(self, timeout: Optional[float] = 10) -> bool:
+        """Blocks until all messages enqueued before the call are written.
+        Returns False if the timeout expired before."""
+        with self.condition:
+            target_count = self.enqueued_count
+            self.flush_requested = True
+            self.condition.notify_all()
+            return self.condition.wait_for(
+                lambda: (self.written_count + self.dropped_count >=
+                         target_count) and self.pending_health_check_ts is
+                None and not self.health_check_in_flight, timeout)
+
+    def set_quota(self, max_rows: int, max_bytes: int) -> None:
+        """Sets the quota of the messages table, enforced by the writer."""
+        with self.condition:
+            self.max_rows = max_rows
+            self.max_bytes = max_bytes
+
+    def shrink(self, factor: float = 0.5) -> None:
+        """Requests the writer to evict messages until the messages table is
+        below `factor` of its current size, e.g. when the disk is full. Repeated
+        requests within `SHRINK_MIN_INTERVAL_SECONDS` are ignored, and the
+        table is not shrunk below `SHRINK_MIN_QUOTA_RATIO` of its quota."""
+        assert 0 < factor < 1
+        with self.condition:
+            if (self.last_shrink_time is not None
+                    and time.monotonic() - self.last_shrink_time
+                    < SHRINK_MIN_INTERVAL_SECONDS):
+                return
+            self.last_shrink_time = time.monotonic()
+            self.shrink_factor = factor
+            self.condition.notify_all()
+
+    def close(self, timeout: Optional[float] = 10) -> None:
+        """Writes all remaining messages and stops the writer thread."""
+        self.flush(timeout=timeout)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.writer_thread.join(timeout=timeout)
+
+    def _append_message(self,
+                        type: str,
+                        payload: THINGSBOARD_PAYLOADS,
+                        timestamp_ms: Optional[int] = None) -> None:
+        """Appends to the ring, the condition lock must be held by the caller."""
+        if len(self.ring) >= self.ring_size:
+            if self.overflow_policy == "drop":
+                self.ring.popleft()
+                self.dropped_count += 1
+            else:
+                self.condition.notify_all()
+                self.condition.wait_for(
+                    lambda: len(self.ring) < self.ring_size)
+
+        if len(self.ring) == 0:
+            self.oldest_message_time = time.monotonic()
+        ts = self.timestamp_allocator.allocate(
+            series=TIMESTAMP_SERIES.get(payload.__class__,
+                                        payload.__class__.__name__),
+            timestamp_ms=timestamp_ms)
+        self.ring.append((type, ts, payload))
+        self.enqueued_count += 1
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.db_path,
+                              isolation_level=None,
+                              autocommit=True)
+        # wait for the gateway to release its lock instead of failing
+        con.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS};")
+        # in WAL mode, NORMAL only syncs on checkpoints and not on every commit
+        con.execute("PRAGMA synchronous=NORMAL;")
+        return con
+
+    def _is_flush_due(self) -> bool:
+        """The condition lock must be held by the caller."""
+        if (self.pending_health_check_ts is not None
+                or self.shrink_factor is not None):
+            return True
+        if len(self.ring) == 0:
+            return False
+        return (self.flush_requested
+                or len(self.ring) >= self.flush_max_messages
+                or time.monotonic() - self.oldest_message_time
+                >= self.flush_interval_seconds)
+
+    def _seconds_until_flush_due(self) -> float:
+        """The condition lock must be held by the caller."""
+        if len(self.ring) == 0:
+            return self.checkpoint_interval_seconds
+        return max(
+            self.oldest_message_time + self.flush_interval_seconds -
+            time.monotonic(), 0)
+
+    def _run_writer(self) -> None:
+        con = self._connect()
+        last_checkpoint_time = time.monotonic()
+        last_quota_check_time = time.monotonic()
+        retry_delay = WRITE_RETRY_DELAY_SECONDS
+        failed_attempts = 0
+        batch: list[tuple[str, int, THINGSBOARD_PAYLOADS]] = []
+        health_check_ts: Optional[int] = None
+
+        while True:
+            with self.condition:
+                while (len(batch) == 0 and health_check_ts is None
+                       and not self._is_flush_due()):
+                    if self.closed:
+                        con.close()
+                        return
+                    self.condition.wait(self._seconds_until_flush_due())
+                    if (time.monotonic() - last_checkpoint_time
+                            >= self.checkpoint_interval_seconds):
+                        break
+
+                # keep a failed batch and fill it up to the batch size
+                while len(self.ring) > 0 and len(
+                        batch) < self.flush_max_messages * 4:
+                    batch.append(self.ring.popleft())
+                if len(self.ring) > 0:
+                    self.oldest_message_time = time.monotonic()
+                if self.pending_health_check_ts is not None:
+                    health_check_ts = self.pending_health_check_ts
+                    self.pending_health_check_ts = None
+                    self.health_check_in_flight = True
+                self.flush_requested = len(self.ring) > 0 and self.flush_requested
+                # wake up producers blocked on a full ring
+                self.condition.notify_all()
+
+            try:
+                if failed_attempts >= WRITE_MAX_ATTEMPTS:
+                    written_count = self._write_isolating_errors(
+                        con, batch, health_check_ts)
+                else:
+                    self._write(con, batch, health_check_ts)
+                    written_count = len(batch)
+            except Exception as e:
+                with self.condition:
+                    self.write_error_count += 1
+                    self.last_write_error = str(e)
+                failed_attempts += 1
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2,
+                                  MAX_WRITE_RETRY_DELAY_SECONDS)
+                continue
+            retry_delay = WRITE_RETRY_DELAY_SECONDS
+            failed_attempts = 0
+
+            with self.condition:
+                self.written_count += written_count
+                self.health_check_in_flight = False
+                shrink_factor, self.shrink_factor = self.shrink_factor, None
+                max_rows, max_bytes = self.max_rows, self.max_bytes
+                self.condition.notify_all()
+            batch = []
+            health_check_ts = None
+
+            if (time.monotonic() - last_checkpoint_time
+                    >= self.checkpoint_interval_seconds):
+                try:
+                    con.execute("PRAGMA wal_checkpoint(PASSIVE);")
+                except Exception:
+                    # a failed passive checkpoint is retried on the next schedule
+                    pass
+                last_checkpoint_time = time.monotonic()
+
+            if (shrink_factor is not None
+                    or time.monotonic() - last_quota_check_time
+                    >= self.quota_check_interval_seconds):
+                last_quota_check_time = time.monotonic()
+                try:
+                    if shrink_factor is not None:
+                        rows, size = get_queue_usage(con)
+                        max_rows = min(max_rows, max(
+                            int(rows * shrink_factor),
+                            int(max_rows * SHRINK_MIN_QUOTA_RATIO)))
+                        max_bytes = min(max_bytes, max(
+                            int(size * shrink_factor),
+                            int(max_bytes * SHRINK_MIN_QUOTA_RATIO)))
+                    counts = evict_messages(con, "messages", max_rows,
+                                            max_bytes)
+                except Exception as e:
+                    # the quota is enforced again on the next schedule
+                    with self.condition:
+                        self.last_write_error = str(e)
+                    continue
+                with self.condition:
+                    for field in dataclasses.fields(EvictionCounts):
+                        setattr(
+                            self.eviction_counts, field.name,
+                            getattr(self.eviction_counts, field.name) +
+                            getattr(counts, field.name))
+                    self.condition.notify_all()
+
+    def _write_isolating_errors(
+            self, con: sqlite3.Connection,
+            batch: list[tuple[str, int, THINGSBOARD_PAYLOADS]],
+            health_check_ts: Optional[int]
+    ) -> int:
+        """Writes the messages of a batch one by one and drops the messages
+        which fail, counted in `write_error_count` and `dropped_count`.
+        Written and dropped messages are removed from the batch, database
+        errors like a lock are raised, so the rest of the batch is retried.
+        Returns the number of written messages."""
+        written_count = 0
+        while len(batch) > 0:
+            try:
+                self._write(con, batch[:1], None)
+                written_count += 1
+            except sqlite3.OperationalError:
+                with self.condition:
+                    self.written_count += written_count
+                raise
+            except Exception as e:
+                with self.condition:
+                    self.write_error_count += 1
+                    self.dropped_count += 1
+                    self.last_write_error = (
+                        f"dropped {batch[0][0]} message: {e!r}")
+            batch.pop(0)
+        self._write(con, [], health_check_ts)
+        return written_count
+
+    def _write(self, con: sqlite3.Connection,
+               batch: list[tuple[str, int, THINGSBOARD_PAYLOADS]],
+               health_check_ts: Optional[int]) -> None:
+        """Writes a batch of messages and the health check in one transaction."""
+        if len(batch) == 0 and health_check_ts is None:
+            return
+        rows = [(ts, type, int(MESSAGE_PRIORITIES[payload.__class__]),
+                 json.dumps(dataclasses.asdict(payload)))
+                for type, ts, payload in batch]
+
+        con.execute("BEGIN IMMEDIATE;")
         try:
-            with self.con:
-                sql_statement: str = "INSERT OR REPLACE INTO health_check (id, timestamp_ms) VALUES(?, ?);"
-                self.con.execute(sql_statement, (1, ts))
-                self.con.execute("PRAGMA wal_checkpoint(PASSIVE);")
+            con.executemany(
+                "INSERT INTO messages (ts_ms, type, priority, payload) VALUES(?, ?, ?, ?);",
+                rows)
+            if health_check_ts is not None:
+                con.execute(
+                    "INSERT OR REPLACE INTO health_check (id, timestamp_ms) VALUES(?, ?);",
+                    (1, health_check_ts))
+            con.execute("COMMIT;")
         except Exception:
-            exit(0)
+            con.execute("ROLLBACK;")
+            raise
@@ -1,4 +1,3 @@
-import time
 import traceback
 from datetime import datetime
 from os.path import join
@@ -222,8 +221,6 @@ class Logger:
         assert (len(subject) <= 256)
         assert (len(details) <= 16384)
 
-        time.sleep(1)  # Ensure that log message has a unique timestamp
-
         self.communication_queue.enqueue_message(
             type="log",
             payload=mqtt_playload_types.MQTTLogMessage(
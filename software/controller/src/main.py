@@ -34,9 +34,13 @@ except Exception as e:
                 message=f"Failed to read config: {str(e)}",
             ),
     )
+    queue.flush()
     raise e
 
 
+queue.set_quota(max_rows=config.communication_queue.max_rows,
+                max_bytes=config.communication_queue.max_bytes)
+
 # initialize and check validity of state file
 state_interface.StateInterface.init()
 
@@ -74,6 +78,7 @@ except Exception as e:
     logger.exception(e,
                      label="Could not initialize hardware interface.",
                      forward=True)
+    queue.flush()
     raise e
 
 # -------------------------------------------------------------------------
@@ -104,6 +109,7 @@ def _graceful_teardown(*_args: Any) -> None:
     logger.info("Starting graceful teardown.")
     hardware.teardown()
     logger.info("Finished graceful teardown.")
+    queue.close()
     exit(0)
 
 
@@ -130,6 +136,7 @@ try:
         config=config, communication_queue=queue, hardware_interface=hardware)
 except Exception as e:
     logger.exception(e, label="Could not initialize procedures", forward=True)
+    queue.flush()
     raise e
 
 # -------------------------------------------------------------------------
@@ -178,12 +185,13 @@ while True:
     except (BrokenPipeError, ConnectionError) as e:
         logger.exception(e, label="exception in mainloop", forward=True)
         logger.info("GPIO Interface not available. Exiting.", forward=True)
+        queue.flush()
         exit(1)
         
     except (system_check.DiskUsageError) as e:
         logger.exception(e, label="exception in mainloop", forward=True)
         logger.info("Disk usage is too high.", forward=True)
-        # TODO: add handler for disk usage errors
+        # the system check shrinks the communication queue without raising
 
     except Exception as e:
         logger.exception(e, label="exception in mainloop", forward=True)
@@ -9,6 +9,10 @@ from custom_types import mqtt_playload_types
 from interfaces import hardware_interface, logging_interface, communication_queue
 from utils import system_info
 
+# disk usage ratio above which the communication queue is shrunk
+CRITICAL_DISK_USAGE = 0.9
+
+
 class DiskUsageError(Exception):
     """Custom exception for disk usage errors."""
     pass
@@ -28,6 +32,7 @@ class SystemCheckProcedure:
         self.hardware_interface = hardware_interface
         self.communication_queue = communication_queue
         self.simulate = config.active_components.simulation_mode
+        self.last_dropped_message_count = 0
 
     def run(self) -> None:
         """runs system check procedure
@@ -38,6 +43,8 @@ class SystemCheckProcedure:
         - log CPU/disk/memory usage
         - check whether CPU/disk/memory usage is above 80%
         - check hardware interfaces for errors
+        - check whether the communication queue dropped messages
+        - shrink the communication queue if the disk usage is above 90%
         """
 
         cpu_temperature = self.cpu_temperature()
@@ -64,11 +71,24 @@ class SystemCheckProcedure:
                 ups_battery_error_detected=ups_sate.ups_battery_error_detected,
                 ups_battery_above_voltage_threshold=ups_sate.
                 ups_battery_above_voltage_threshold),
+            timestamp_ms=self.hardware_interface.mainboard_sensor.
+            last_read_timestamp_ms,
         )
 
         # check for hardware errors
         self.hardware_interface.check_errors()
 
+        self.communication_queue_state()
+
+        # keep measuring, the measurements are evicted from the queue first
+        if disk_usage > CRITICAL_DISK_USAGE:
+            self.logger.warning(
+                f"disk usage is critical ({round(disk_usage * 100, 2)} %), "
+                "shrinking the communication queue",
+                forward=True,
+            )
+            self.communication_queue.shrink()
+
     def cpu_temperature(self) -> Optional[float]:
         cpu_temperature = system_info.get_cpu_temperature(self.simulate)
         self.logger.debug(f"raspi cpu temp. = {cpu_temperature} °C")
@@ -104,7 +124,6 @@ class SystemCheckProcedure:
             self.logger.warning(
                 f"CPU usage is very high ({cpu_usage_percent} %)",
                 forward=True)
-            raise DiskUsageError("Disk usage is too high.")
 
         return round(cpu_usage_percent / 100, 4)
 
@@ -121,6 +140,38 @@ class SystemCheckProcedure:
 
         return round(memory_usage_percent / 100, 4)
 
+    def communication_queue_state(self) -> None:
+        "Log and send the state of the communication queue writer"
+
+        queue = self.communication_queue
+        self.logger.debug(
+            f"communication queue: {queue.written_count} written, "
+            f"{len(queue.ring)} pending, {queue.dropped_count} dropped, "
+            f"{queue.write_error_count} write errors, evicted: "
+            f"{queue.eviction_counts}")
+
+        # not a measurement, so eviction doesn't average the counters
+        queue.enqueue_message(
+            type="status",
+            payload=mqtt_playload_types.MQTTCommunicationQueueData(
+                communication_queue_written=queue.written_count,
+                communication_queue_dropped=queue.dropped_count,
+                communication_queue_compacted=queue.eviction_counts.compacted,
+                communication_queue_evicted_logs=queue.eviction_counts.
+                dropped_logs,
+                communication_queue_evicted=queue.eviction_counts.dropped,
+            ),
+        )
+
+        if queue.dropped_count > self.last_dropped_message_count:
+            self.logger.warning(
+                f"communication queue dropped "
+                f"{queue.dropped_count - self.last_dropped_message_count} "
+                f"messages (last write error: {queue.last_write_error})",
+                forward=True,
+            )
+            self.last_dropped_message_count = queue.dropped_count
+
     def mainboard_sensor(self) -> Any:
 
         mainboard_sensor = self.hardware_interface.mainboard_sensor.read()
@@ -0,0 +1,44 @@
+import threading
+import time
+from typing import Optional
+
+# Controller and gateway both publish log messages with the same telemetry
+# keys, so each process only allocates timestamps with
+# `ts % TIMESTAMP_STRIDE == offset` to stay collision-free without any IPC.
+# The gateway runs from its own checkout and can't import this module,
+# software/gateway/src/utils/timestamps.py only implements its side of the
+# parity rule and must keep these constants.
+TIMESTAMP_STRIDE = 2
+CONTROLLER_TIMESTAMP_OFFSET = 0
+GATEWAY_TIMESTAMP_OFFSET = 1
+
+
+def now_ms() -> int:
+    return int(time.time_ns() / 1_000_000)
+
+
+class TimestampAllocator:
+    """Allocates unique, monotonically increasing millisecond timestamps
+    per series (a set of telemetry keys, e.g. one payload type).
+
+    ThingsBoard overwrites values of a key that are sent with the same
+    timestamp. A requested timestamp (default: now) is kept if it is newer
+    than the last timestamp of its series, otherwise it is bumped to the next
+    free one. Thread-safe."""
+
+    def __init__(self, offset: int = CONTROLLER_TIMESTAMP_OFFSET) -> None:
+        assert 0 <= offset < TIMESTAMP_STRIDE
+        self.offset = offset
+        self.lock = threading.Lock()
+        self.last_timestamps_ms: dict[str, int] = {}
+
+    def allocate(self,
+                 series: str,
+                 timestamp_ms: Optional[int] = None) -> int:
+        if timestamp_ms is None:
+            timestamp_ms = now_ms()
+        with self.lock:
+            ts = max(timestamp_ms, self.last_timestamps_ms.get(series, 0) + 1)
+            ts += (self.offset - ts) % TIMESTAMP_STRIDE
+            self.last_timestamps_ms[series] = ts
+            return ts
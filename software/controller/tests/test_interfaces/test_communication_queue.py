@@ -0,0 +1,375 @@
+import json
+import sqlite3
+import threading
+import pytest
+from typing import Optional
+from interfaces import communication_queue
+from custom_types import mqtt_playload_types
+
+
+# Fixture to create a queue with a database in a temporary directory
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(communication_queue, "ACROPOLIS_DATA_PATH",
+                        str(tmp_path))
+    monkeypatch.setattr(communication_queue, "BUSY_TIMEOUT_MS", 100)
+    queue = communication_queue.CommunicationQueue(flush_max_messages=3,
+                                                   flush_interval_seconds=60)
+    yield queue
+    queue.close()
+
+
+# Fixture to read the queue database from a separate connection
+@pytest.fixture
+def db(queue):
+    con = sqlite3.connect(queue.db_path)
+    yield con
+    con.close()
+
+
+def log_message(i: int) -> mqtt_playload_types.MQTTLogMessage:
+    return mqtt_playload_types.MQTTLogMessage(severity="INFO",
+                                              message=f"message {i}")
+
+
+def stored_messages(db) -> list:
+    return db.execute(
+        "SELECT type, ts_ms, payload FROM messages ORDER BY id").fetchall()
+
+
+def test_enqueue_message_is_buffered(queue, db):
+    """Test that messages are only written once the size threshold is reached."""
+    queue.enqueue_message("log", log_message(0))
+    queue.enqueue_message("log", log_message(1))
+    assert len(stored_messages(db)) == 0
+
+    queue.enqueue_message("log", log_message(2))
+    with queue.condition:
+        assert queue.condition.wait_for(lambda: queue.written_count == 3,
+                                        timeout=5)
+    assert len(stored_messages(db)) == 3
+
+
+def test_enqueue_message_flushes_after_interval(queue, db):
+    """Test that a pending message is written once the time threshold is reached."""
+    queue.flush_interval_seconds = 0
+    queue.enqueue_message("log", log_message(0))
+    with queue.condition:
+        assert queue.condition.wait_for(lambda: queue.written_count == 1,
+                                        timeout=5)
+    assert len(stored_messages(db)) == 1
+
+
+def test_enqueue_many(queue, db):
+    """Test that enqueue_many writes the pending buffer and all given messages."""
+    queue.enqueue_message("log", log_message(0))
+    queue.enqueue_many([("log", log_message(i)) for i in range(1, 6)])
+    assert queue.flush()
+
+    rows = stored_messages(db)
+    assert [json.loads(p)["message"] for _, _, p in rows] == [
+        f"message {i}" for i in range(6)
+    ]
+    # timestamps of a batch must not collide
+    timestamps = [ts for _, ts, _ in rows]
+    assert len(set(timestamps)) == len(timestamps)
+
+
+def test_health_check(queue, db):
+    """Test that the health check is written by the writer thread."""
+    queue.enqueue_health_check()
+    assert queue.flush()
+    assert db.execute("SELECT COUNT(*) FROM health_check").fetchone()[0] == 1
+
+
+def test_enqueue_from_other_thread(queue, db):
+    """Test that threads other than the main thread can enqueue messages."""
+    thread = threading.Thread(
+        target=lambda: queue.enqueue_message("log", log_message(0)))
+    thread.start()
+    thread.join()
+    assert queue.flush()
+    assert len(stored_messages(db)) == 1
+
+
+def test_overflow_policy_drop(queue, db):
+    """Test that the oldest messages are dropped when the ring is full."""
+    with queue.condition:
+        # hold the lock so the writer cannot drain the ring
+        queue.ring_size = 2
+        for i in range(4):
+            queue._append_message("log", log_message(i))
+    assert queue.flush()
+
+    rows = stored_messages(db)
+    assert queue.dropped_count == 2
+    assert [json.loads(p)["message"]
+            for _, _, p in rows] == ["message 2", "message 3"]
+
+
+def test_write_errors_are_retried(queue, db):
+    """Test that the writer keeps messages and retries when a write fails."""
+    db.execute("BEGIN EXCLUSIVE;")  # lock the database for the writer
+    queue.enqueue_many([("log", log_message(0))])
+    with queue.condition:
+        assert queue.condition.wait_for(
+            lambda: queue.write_error_count > 0, timeout=10)
+    db.execute("COMMIT;")
+
+    assert queue.flush(timeout=30)
+    assert len(stored_messages(db)) == 1
+
+
+def test_unwritable_messages_are_dropped(queue, db, monkeypatch):
+    """Test that a message which can't be written doesn't block the writer."""
+    monkeypatch.setattr(communication_queue, "WRITE_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(communication_queue, "WRITE_RETRY_DELAY_SECONDS", 0)
+    # the priority of an unknown payload type can't be determined
+    queue.enqueue_many([("log", log_message(0)), ("unknown", object()),
+                        ("log", log_message(1))])
+    assert queue.flush(timeout=10)
+
+    rows = stored_messages(db)
+    assert [json.loads(p)["message"]
+            for _, _, p in rows] == ["message 0", "message 1"]
+    assert queue.written_count == 2
+    assert queue.dropped_count == 1
+    assert queue.write_error_count == 3
+    assert "unknown" in queue.last_write_error
+
+
+def test_acquisition_timestamps(queue, db):
+    """Test that acquisition timestamps are kept and bumped on collisions."""
+    queue.enqueue_message("log", log_message(0), timestamp_ms=1_750_000_000_000)
+    queue.enqueue_message("log", log_message(1), timestamp_ms=1_750_000_000_000)
+    queue.enqueue_message("log", log_message(2), timestamp_ms=1_749_999_999_000)
+    assert queue.flush()
+
+    timestamps = [ts for _, ts, _ in stored_messages(db)]
+    assert timestamps == [
+        1_750_000_000_000, 1_750_000_000_002, 1_750_000_000_004
+    ]
+
+
+def test_payloads_sharing_keys_get_distinct_timestamps(queue, db):
+    """Test that wind data and wind status don't overwrite each other's keys."""
+    for payload in [
+            mqtt_playload_types.MQTTWindData(1.0, 2.0, 3.0, 4.0, 5.0, 6.0,
+                                             1_750_000_000.0),
+            mqtt_playload_types.MQTTWindSensorInfo(20.0, 24.0, 24.0, 3.5,
+                                                   1_750_000_000.0),
+    ]:
+        queue.enqueue_message("measurement",
+                              payload,
+                              timestamp_ms=1_750_000_000_000)
+    assert queue.flush()
+
+    timestamps = [ts for _, ts, _ in stored_messages(db)]
+    assert timestamps == [1_750_000_000_000, 1_750_000_000_002]
+
+
+def test_migrate_legacy_messages_table(tmp_path):
+    """Test that messages of the previous schema are migrated with their ids."""
+    con = sqlite3.connect(tmp_path / "legacy.db", autocommit=True)
+    con.execute("""
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type text,
+            message text
+        );
+    """)
+    for ts in [1_750_000_000_000, 1_750_000_000_002, 1_750_000_000_004]:
+        con.execute(
+            "INSERT INTO messages (type, message) VALUES(?, ?);",
+            ("log", json.dumps({"ts": ts, "values": {"message": "m"}})))
+    con.execute("DELETE FROM messages WHERE id = 3;")
+
+    communication_queue.migrate_legacy_messages_table(con)
+
+    rows = con.execute(
+        "SELECT id, ts_ms, type, priority, payload FROM messages ORDER BY id"
+    ).fetchall()
+    assert [row[:4] for row in rows] == [
+        (1, 1_750_000_000_000, "log", communication_queue.MessagePriority.LOG),
+        (2, 1_750_000_000_002, "log", communication_queue.MessagePriority.LOG),
+    ]
+    assert json.loads(rows[0][4]) == {"message": "m"}
+
+    # ids are never reused after the migration
+    con.execute(
+        "INSERT INTO messages (ts_ms, type, payload) VALUES(1, 'log', '{}');")
+    assert con.execute("SELECT MAX(id) FROM messages").fetchone()[0] == 4
+
+    # a second migration is a no-op
+    communication_queue.migrate_legacy_messages_table(con)
+    assert con.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 3
+    con.close()
+
+
+def test_schema_version(queue, db):
+    """Test that the queue stores the schema version of its table, which
+    the gateway waits for before reading the table."""
+    assert db.execute("PRAGMA user_version;").fetchone()[0] == \
+        communication_queue.MESSAGES_SCHEMA_VERSION
+
+
+def test_message_priorities(queue, db):
+    """Test that messages are written to the priority lane of their payload."""
+    calibration = mqtt_playload_types.MQTTCalibrationCorrectionData(
+        cal_gmp343_slope=1.0, cal_gmp343_intercept=0.0, cal_sht_45_offset=0.0)
+    queue.enqueue_many([("log", log_message(0)), ("measurement", calibration)])
+    assert queue.flush()
+
+    assert db.execute("SELECT priority FROM messages ORDER BY id").fetchall(
+    ) == [(communication_queue.MessagePriority.LOG, ),
+          (communication_queue.MessagePriority.CALIBRATION, )]
+
+
+# Fixture to create a standalone messages table
+@pytest.fixture
+def messages_db(tmp_path):
+    con = sqlite3.connect(tmp_path / "messages.db", autocommit=True)
+    con.execute(communication_queue.MESSAGES_TABLE_SCHEMA.format(
+        table="messages"))
+    yield con
+    con.close()
+
+
+def insert_message(con,
+                   ts_ms: int,
+                   priority: int,
+                   payload: dict,
+                   type: Optional[str] = None) -> None:
+    if type is None:
+        type = "log" if priority == communication_queue.MessagePriority.LOG else "measurement"
+    con.execute(
+        "INSERT INTO messages (ts_ms, type, priority, payload) VALUES(?, ?, ?, ?);",
+        (ts_ms, type, priority, json.dumps(payload)))
+
+
+def test_eviction_compacts_measurements(messages_db):
+    """Test that measurements are merged into per-minute aggregates first."""
+    live = communication_queue.MessagePriority.LIVE
+    for i in range(6):
+        # 3 measurements in each of 2 minutes
+        insert_message(messages_db, 1_750_000_020_000 + i * 20_000, live, {
+            "co2": float(i),
+            "speed_max": float(i),
+            "ok": i % 2 == 0
+        })
+    insert_message(messages_db, 1_750_000_020_000,
+                   communication_queue.MessagePriority.LOG, {
+                       "severity": "INFO",
+                       "message": "m"
+                   })
+
+    counts = communication_queue.evict_messages(messages_db, "messages",
+                                                max_rows=5,
+                                                max_bytes=10_000_000)
+    assert counts == communication_queue.EvictionCounts(compacted=4)
+
+    rows = messages_db.execute(
+        "SELECT ts_ms, payload FROM messages WHERE type = 'measurement' ORDER BY id"
+    ).fetchall()
+    assert [(ts, json.loads(p)) for ts, p in rows] == [
+        (1_750_000_020_000, {
+            "co2": 1.0,
+            "speed_max": 2.0,
+            "ok": True
+        }),
+        (1_750_000_080_000, {
+            "co2": 4.0,
+            "speed_max": 5.0,
+            "ok": False
+        }),
+    ]
+
+
+def test_eviction_keeps_status_messages(messages_db):
+    """Test that the counters of status messages are not averaged."""
+    live = communication_queue.MessagePriority.LIVE
+    for i in range(3):
+        insert_message(messages_db,
+                       1_750_000_020_000 + i * 10_000,
+                       live, {"communication_queue_written": i},
+                       type="status")
+
+    counts = communication_queue.evict_messages(messages_db, "messages",
+                                                max_rows=2,
+                                                max_bytes=10_000_000)
+    assert counts.compacted == 0
+    # the oldest status messages are dropped as a whole instead
+    assert counts.dropped > 0
+    rows = messages_db.execute("SELECT payload FROM messages").fetchall()
+    assert all(json.loads(p) in [{
+        "communication_queue_written": i
+    } for i in range(3)] for p, in rows)
+
+
+def test_eviction_never_drops_calibration(messages_db):
+    """Test that INFO logs are dropped before other messages and calibration messages are kept."""
+    priority = communication_queue.MessagePriority
+    insert_message(messages_db, 1, priority.CALIBRATION, {"cal": 1.0})
+    insert_message(messages_db, 2, priority.LOG, {
+        "severity": "WARNING",
+        "message": "w"
+    })
+    for i in range(3, 6):
+        insert_message(messages_db, i, priority.LOG, {
+            "severity": "INFO",
+            "message": "i"
+        })
+
+    counts = communication_queue.evict_messages(messages_db, "messages",
+                                                max_rows=3,
+                                                max_bytes=10_000_000)
+    assert counts == communication_queue.EvictionCounts(dropped_logs=3)
+
+    counts = communication_queue.evict_messages(messages_db, "messages",
+                                                max_rows=1,
+                                                max_bytes=10_000_000)
+    assert counts == communication_queue.EvictionCounts(dropped=1)
+    assert messages_db.execute(
+        "SELECT priority FROM messages").fetchall() == [(priority.CALIBRATION, )]
+
+    # calibration messages stay even if the quota is exceeded
+    counts = communication_queue.evict_messages(messages_db, "messages",
+                                                max_rows=1_000,
+                                                max_bytes=1)
+    assert counts == communication_queue.EvictionCounts()
+    assert messages_db.execute(
+        "SELECT COUNT(*) FROM messages").fetchone()[0] == 1
+
+
+def test_shrink(queue, db):
+    """Test that shrink evicts messages from the messages table."""
+    queue.set_quota(max_rows=20, max_bytes=1_000_000_000)
+    queue.enqueue_many([("log", log_message(i)) for i in range(10)])
+    assert queue.flush()
+
+    queue.shrink()
+    with queue.condition:
+        assert queue.condition.wait_for(
+            lambda: queue.eviction_counts.dropped_logs > 0, timeout=5)
+    assert len(stored_messages(db)) <= 5
+
+
+def test_shrink_is_rate_limited(queue, db, monkeypatch):
+    """Test that repeated shrinks neither run within the interval nor evict
+    the queue below the ratio of its quota."""
+    monkeypatch.setattr(communication_queue, "EVICTION_BATCH_SIZE", 1)
+    queue.set_quota(max_rows=100, max_bytes=1_000_000_000)
+    queue.enqueue_many([("log", log_message(i)) for i in range(20)])
+    assert queue.flush()
+
+    queue.shrink(factor=0.1)
+    with queue.condition:
+        assert queue.condition.wait_for(
+            lambda: queue.eviction_counts.dropped_logs > 0, timeout=5)
+    # not below 10% of the quota, instead of 10% of the 20 messages
+    assert len(stored_messages(db)) == 9
+
+    queue.enqueue_many([("log", log_message(i)) for i in range(20)])
+    assert queue.flush()
+    queue.shrink(factor=0.1)
+    assert queue.shrink_factor is None
@@ -0,0 +1,103 @@
+"""Benchmarks the cost (µs/loop) of the sqlite queries of one idle gateway main loop iteration.
+
+Compares the previous queries (no statement cache, a sqlite_master lookup plus a full COUNT(*) per
+existence check, every read behind the write lock) with the cached schema, EXISTS probes and the
+reader connections of `SqliteConnection`. Also measures reads while another thread holds the write
+lock. Runs against temporary databases with a filled log buffer.
+
+Usage: python scripts/benchmark_sqlite.py [--loops 5000] [--rows 10000]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+os.environ["ACROPOLIS_DATA_PATH"] = tempfile.mkdtemp(
+    prefix="acropolis-sqlite-benchmark-")
+os.environ.setdefault("ACROPOLIS_GATEWAY_GIT_PATH", os.environ["ACROPOLIS_DATA_PATH"])
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from modules import sqlite
+from modules.logging import LOG_BUFFER_TABLE_SCHEMA
+
+
+def legacy_loop(conn: sqlite3.Connection, lock: threading.Lock) -> None:
+    """Queries of the main loop before the overhaul"""
+    def execute(query: str) -> list:
+        with lock:
+            return conn.execute(query).fetchall()
+
+    for table in ["log_buffer", "health_check"]:
+        if len(execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table}'")) > 0:
+            execute(f"SELECT COUNT(*) FROM {table}")
+    execute("SELECT id, log_level, message, timestamp_ms FROM log_buffer ORDER BY id LIMIT 1")
+    execute("SELECT timestamp_ms FROM health_check WHERE id = 1")
+
+
+def current_loop(db: sqlite.SqliteConnection) -> None:
+    for table in ["log_buffer", "health_check"]:
+        db.do_table_values_exist(table)
+    db.read("SELECT id, log_level, message, timestamp_ms FROM log_buffer ORDER BY id LIMIT 1")
+    db.read("SELECT timestamp_ms FROM health_check WHERE id = 1")
+
+
+def run(label: str, fn: Callable[[], None], loops: int) -> float:
+    start = time.perf_counter()
+    for _ in range(loops):
+        fn()
+    cost_us = (time.perf_counter() - start) / loops * 1_000_000
+    print(f"{label:<36} {loops:>7} loops {cost_us:>10.1f} µs/loop")
+    return cost_us
+
+
+def hold_write_lock(lock: threading.Lock, stop: threading.Event) -> None:
+    """Simulates long writes of another thread"""
+    while not stop.is_set():
+        with lock:
+            time.sleep(0.002)
+        time.sleep(0.0001)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--loops", type=int, default=5000)
+    parser.add_argument("--rows", type=int, default=10_000)
+    args = parser.parse_args()
+
+    db = sqlite.SqliteConnection(os.path.join(os.environ["ACROPOLIS_DATA_PATH"], "benchmark.db"))
+    db.execute(LOG_BUFFER_TABLE_SCHEMA)
+    db.execute("CREATE TABLE IF NOT EXISTS health_check (id INTEGER PRIMARY KEY, timestamp_ms INTEGER);")
+    db.execute("INSERT INTO health_check (id, timestamp_ms) VALUES (1, 0);")
+    db.execute_transaction([(
+        "INSERT INTO log_buffer (log_level, message, timestamp_ms) VALUES (?, ?, ?);",
+        [("INFO", f"message {i}", i) for i in range(args.rows)])])
+    print(f"database: {db.path}")
+
+    legacy_conn = sqlite3.connect(db.path, cached_statements=0, isolation_level=None,
+                                  autocommit=True, check_same_thread=False)
+    legacy_lock = threading.Lock()
+
+    before = run("before", lambda: legacy_loop(legacy_conn, legacy_lock), args.loops)
+    after = run("after", lambda: current_loop(db), args.loops)
+
+    stop = threading.Event()
+    writers = [threading.Thread(target=hold_write_lock, args=(lock, stop))
+               for lock in [legacy_lock, db.write_lock]]
+    for writer in writers:
+        writer.start()
+    loops = max(args.loops // 50, 1)
+    before_contended = run("before (concurrent writes)", lambda: legacy_loop(legacy_conn, legacy_lock), loops)
+    after_contended = run("after (concurrent writes)", lambda: current_loop(db), loops)
+    stop.set()
+    for writer in writers:
+        writer.join()
+
+    print(f"speedup: {before / after:.1f}x, {before_contended / after_contended:.1f}x (concurrent writes)")
+    legacy_conn.close()
+    db.close()
@@ -8,14 +8,18 @@ from time import sleep, time_ns
 from typing import Any, Optional
 
 from modules.file_writer import GatewayFileWriter
-from modules.logging import info, warn, debug
+from modules.logging import info, warn, debug, LOG_BUFFER_TABLE_SCHEMA, spill_queued_logs, log_counters
 import utils.paths
 import utils.misc
 from args import parse_args
-from modules import sqlite
+from modules import sqlite, queue_quota
+from modules import archive
+from modules.archive import init_archive_db, compact_archive, drop_expired_partitions
+from modules.archive_republisher import ArchiveRepublisher
 from modules.docker_client import GatewayDockerClient
 from modules.git_client import GatewayGitClient
 from modules.mqtt import GatewayMqttClient
+from modules.outbox import ControllerOutbox
 from on_mqtt_msg.check_for_file_content_update import on_msg_check_for_file_content_update
 from on_mqtt_msg.check_for_file_hashes_update import on_msg_check_for_file_hashes_update, FILE_HASHES_TB_KEY
 from on_mqtt_msg.check_for_files_definition_update import on_msg_check_for_files_definition_update
@@ -24,6 +28,7 @@ from on_mqtt_msg.on_rpc_request import on_rpc_request
 from self_provisioning import self_provisioning_get_access_token
 from utils.controller_restart import restart_controller_if_needed
 from utils.misc import get_maybe
+from utils.wakeup import DataVersionWatcher, wait_for_wakeup
 
 global_mqtt_client : Optional[GatewayMqttClient] = None
 archive_sqlite_db = None
@@ -32,6 +37,12 @@ gateway_logs_buffer_db = None
 STOP_MAINLOOP = False
 AUX_DATA_PUBLISH_INTERVAL_MS = 20_000 # every 20 seconds
 aux_data_publish_ts = None
+QUEUE_QUOTA_CHECK_INTERVAL_MS = 60_000 # every minute
+queue_quota_check_ts = None
+CONTROLLER_CHECK_INTERVAL_MS = 5_000 # every 5 seconds
+controller_check_ts = None
+ARCHIVE_COMPACTION_CHECK_INTERVAL_MS = 600_000 # every 10 minutes
+archive_compaction_check_ts = None
 
 
 # Set up signal handling for safe shutdown
@@ -45,6 +56,7 @@ def shutdown_handler(sig: Any, _frame: Any) -> None:
     STOP_MAINLOOP = True
     if global_mqtt_client is not None:
         global_mqtt_client.graceful_exit()
+    spill_queued_logs()
     if archive_sqlite_db is not None:
         archive_sqlite_db.close()
     if communication_sqlite_db is not None:
@@ -64,11 +76,11 @@ def forced_shutdown_handler(_sig: Any, _frame: Any) -> None:
 
 
 def get_last_controller_health_check_ts():
-    if communication_sqlite_db.do_table_values_exist(sqlite.SqliteTables.HEALTH_CHECK.value):
-        last_controller_health_check_ts_result = communication_sqlite_db.execute(
-            "SELECT timestamp_ms FROM health_check WHERE id = 1")
-        if len(last_controller_health_check_ts_result) > 0:
-            return last_controller_health_check_ts_result[0][0]
+    last_controller_health_check_ts_result = communication_sqlite_db.read(
+        f"SELECT timestamp_ms FROM {sqlite.SqliteTables.HEALTH_CHECK.value} WHERE id = 1")
+    if last_controller_health_check_ts_result is not None and len(last_controller_health_check_ts_result) > 0 \
+            and len(last_controller_health_check_ts_result[0]) > 0:
+        return last_controller_health_check_ts_result[0][0]
 
     return 0
 
@@ -91,28 +103,16 @@ try:
         archive_sqlite_db = sqlite.SqliteConnection(utils.paths.GATEWAY_ARCHIVE_DB_PATH)
         communication_sqlite_db = sqlite.SqliteConnection(utils.paths.COMMUNICATION_QUEUE_DB_PATH)
         gateway_logs_buffer_db = sqlite.SqliteConnection(utils.paths.GATEWAY_LOGS_BUFFER_DB_PATH)
-        archive_sqlite_db.execute("""
-                CREATE TABLE IF NOT EXISTS controller_archive (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp_ms INTEGER,
-                    message TEXT
-                );
-            """)
-        archive_sqlite_db.execute("CREATE INDEX IF NOT EXISTS controller_archive_ts_index on controller_archive (timestamp_ms);")
-        communication_sqlite_db.execute(f"""
-            CREATE TABLE IF NOT EXISTS {sqlite.SqliteTables.CONTROLLER_MESSAGES.value} (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                type text,
-                message text
-            );
-        """)
-        communication_sqlite_db.execute(f"""      
-            CREATE TABLE IF NOT EXISTS {sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value} (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                type text,
-                message text
-            );
-        """)
+        init_archive_db(archive_sqlite_db)
+        sqlite.migrate_legacy_messages_table(communication_sqlite_db, sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value)
+        controller_outbox: Optional[ControllerOutbox] = None
+        if sqlite.read_controller_schema_version(communication_sqlite_db) < sqlite.CONTROLLER_MESSAGES_SCHEMA_VERSION:
+            warn("[MAIN] The controller's message queue has a previous schema, waiting for the controller update to migrate it")
+        ArchiveRepublisher().init(archive_sqlite_db)
+        gateway_logs_buffer_db.execute(LOG_BUFFER_TABLE_SCHEMA)
+
+        # wake up the main loop when the controller commits new messages
+        DataVersionWatcher(utils.paths.COMMUNICATION_QUEUE_DB_PATH).start()
 
 
         # create and run the mqtt client in a separate thread
@@ -134,22 +134,19 @@ try:
             info("Gateway is provisioned for first time, initializing attributes...")
             GatewayMqttClient().publish_message_raw("v1/devices/me/attributes", json.dumps({ FILE_HASHES_TB_KEY: {}}))
 
-        # daemon thread for updating file content client attributes every 30 seconds
-        def file_update_check_daemon():
-            """Daemon thread to check for file updates every 30 seconds."""
-            while True:
-                sleep(30)
-                try:
-                    debug("Checking for file changes...")
-                    file_definitions = GatewayFileWriter().get_files()
-                    for file_id in file_definitions:
-                        if GatewayFileWriter().did_file_change(get_maybe(file_definitions, file_id, "path")):
-                            info(f"File {file_definitions[file_id]} changed on disk - requesting update")
-                            GatewayMqttClient().request_attributes({"clientKeys": FILE_HASHES_TB_KEY})
-                except Exception as ex:
-                    warn(f"Error checking for file changes: {ex}")
-        file_update_thread = threading.Thread(target=file_update_check_daemon, daemon=True)
-        file_update_thread.start()
+        # update file content client attributes when a file changes on disk
+        def on_file_change():
+            try:
+                debug("Checking for file changes...")
+                file_definitions = GatewayFileWriter().get_files()
+                for file_id in file_definitions:
+                    file_path = GatewayFileWriter().expand_file_path(get_maybe(file_definitions, file_id, "path"))
+                    if file_path is not None and GatewayFileWriter().did_file_change(file_path):
+                        info(f"File {file_definitions[file_id]} changed on disk - requesting update")
+                        GatewayMqttClient().request_attributes({"clientKeys": FILE_HASHES_TB_KEY})
+            except Exception as ex:
+                warn(f"Error checking for file changes: {ex}")
+        GatewayFileWriter().start_watching(on_file_change)
 
         info("Entering main loop...")
         # *** main loop ***
@@ -184,6 +181,11 @@ try:
             if restart_controller_if_needed():
                 continue
 
+            # evict buffered messages if a queue exceeds its quota
+            if queue_quota_check_ts is None or int(time_ns() / 1_000_000) - queue_quota_check_ts > QUEUE_QUOTA_CHECK_INTERVAL_MS:
+                queue_quota_check_ts = int(time_ns() / 1_000_000)
+                queue_quota.enforce_queue_quotas(gateway_logs_buffer_db)
+
             if not mqtt_client_thread.is_alive() or not mqtt_client.is_connected():
                 if not mqtt_client.is_connected():
                     warn("MQTT client not connected, exiting in 30 seconds...")
@@ -192,63 +194,36 @@ try:
                 sleep(30)
                 utils.misc.fatal_error("MQTT client thread died")
 
-            # check if there is any buffered outgoing log message in the buffer sqlite db
-            if gateway_logs_buffer_db.do_table_values_exist("log_buffer"):
-                # fetch the next message (lowest `id`) from the queue and send it
-                message = gateway_logs_buffer_db.execute(
-                    f"SELECT id, log_level, message, timestamp_ms FROM {"log_buffer"} ORDER BY id LIMIT 1")
-                if len(message) > 0:
-                    debug('Sending buffered log message: ' + str(message[0]))
-                    if not mqtt_client.publish_log(message[0][1], message[0][2], message[0][3]):
-                        continue
-                    gateway_logs_buffer_db.execute(f"DELETE FROM {"log_buffer"} WHERE id = {message[0][0]}")
-                continue
 
+            # read the controller messages once the controller migrated its queue to the current schema
+            if controller_outbox is None and sqlite.read_controller_schema_version(communication_sqlite_db) >= sqlite.CONTROLLER_MESSAGES_SCHEMA_VERSION:
+                sqlite.create_messages_table(communication_sqlite_db, sqlite.SqliteTables.CONTROLLER_MESSAGES.value)
+                controller_outbox = ControllerOutbox(communication_sqlite_db, archive_sqlite_db)
+                controller_outbox.migrate_pending_mqtt_messages()
 
-            if communication_sqlite_db.do_table_values_exist(sqlite.SqliteTables.CONTROLLER_MESSAGES.value):
-                # fetch the next message (lowest `id`) from the queue and process it
-                message = communication_sqlite_db.execute(
-                    f"SELECT id, type, message FROM {sqlite.SqliteTables.CONTROLLER_MESSAGES.value} ORDER BY id LIMIT 1"
-                )
-                if len(message) > 0:
-                    message_type = message[0][1]
-                    message_obj = json.loads(message[0][2])
-                    message_timestamp_ms = message_obj["ts"]
-                    message_values = message_obj["values"]
-
-                    # archive controller messages in the archive sqlite db, except for log messages
-                    if not "log" in message_type:
-                        archive_sqlite_db.execute(
-                            "INSERT INTO controller_archive (timestamp_ms, message) VALUES (?, ?)",
-                            (message_timestamp_ms, json.dumps(message_values)))
-
-                    # add message to sqlite table containing pending outgoing mqtt messages
-                    communication_sqlite_db.execute(
-                        "INSERT INTO " + sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value + " (type, message) VALUES (?, ?)",
-                        (message[0][1], message[0][2]))
-
-                    # remove the published message from the queue
-                    communication_sqlite_db.execute(
-                        f"DELETE FROM {sqlite.SqliteTables.CONTROLLER_MESSAGES.value} WHERE id = {message[0][0]}")
-                continue
+            if controller_outbox is not None:
+                # delete the ranges of controller messages acknowledged by the broker
+                controller_outbox.process_acks(mqtt_client)
 
-            # check if there are any new outgoing mqtt messages in the sqlite db
-            if communication_sqlite_db.do_table_values_exist(sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value):
-                # fetch the next message (lowest `id`) from the queue and send it
-                message = communication_sqlite_db.execute(
-                    f"SELECT id, type, message FROM {sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value} ORDER BY id LIMIT 1"
-                )
-                if len(message) > 0:
-                    message_type = message[0][1]
-                    message_obj = json.loads(message[0][2])
-                    debug('Sending controller message: ' + str(message[0]))
-                    if not mqtt_client.publish_telemetry(message[0][2]):
-                        continue
+                # archive the next range of new controller messages
+                if controller_outbox.archive_next_range() > 0:
+                    continue
 
-                    # remove the published message from the queue
-                    communication_sqlite_db.execute(
-                        f"DELETE FROM {sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value} WHERE id = {message[0][0]}")
+                # publish the next range of archived controller messages if the publish window is not full
+                if controller_outbox.publish_next_range(mqtt_client) > 0:
+                    continue
+
+            # check the controller on a timer, not on every wakeup
+            if controller_check_ts is not None and int(time_ns() / 1_000_000) - controller_check_ts < CONTROLLER_CHECK_INTERVAL_MS:
+                # compact old archived messages while idle, one chunk per iteration
+                if archive_compaction_check_ts is None or int(time_ns() / 1_000_000) - archive_compaction_check_ts > ARCHIVE_COMPACTION_CHECK_INTERVAL_MS:
+                    drop_expired_partitions()
+                    if compact_archive(archive_sqlite_db) > 0:
+                        continue
+                    archive_compaction_check_ts = int(time_ns() / 1_000_000)
+                wait_for_wakeup((controller_check_ts + CONTROLLER_CHECK_INTERVAL_MS - int(time_ns() / 1_000_000)) / 1000)
                 continue
+            controller_check_ts = int(time_ns() / 1_000_000)
 
             controller_running_since_ts = docker_client.get_edge_startup_timestamp_ms() or 0
             last_controller_health_check_ts = get_last_controller_health_check_ts()
@@ -260,7 +235,11 @@ try:
                     "ts": aux_data_publish_ts,
                     "values": {
                         "ms_since_controller_startup": aux_data_publish_ts - controller_running_since_ts,
-                        "ms_since_last_controller_health_check": aux_data_publish_ts - last_controller_health_check_ts
+                        "ms_since_last_controller_health_check": aux_data_publish_ts - last_controller_health_check_ts,
+                        **queue_quota.eviction_counters,
+                        **log_counters,
+                        **archive.compaction_counters,
+                        **(controller_outbox.publish_window.stats() if controller_outbox is not None else {})
                     }
                 }))
 
@@ -271,8 +250,8 @@ try:
                 docker_client.stop_controller()
                 continue
 
-            # if nothing happened this iteration, sleep for a while
-            sleep(5)
+            # if nothing happened this iteration, sleep until the next mqtt message, controller commit or timer
+            wait_for_wakeup(CONTROLLER_CHECK_INTERVAL_MS / 1000)
 
 except Exception as e:
     utils.misc.fatal_error(f"An error occurred in gateway main loop: {e}")
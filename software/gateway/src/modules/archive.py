@@ -0,0 +1,646 @@
+import heapq
+import json
+import math
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from time import time_ns
+from typing import Any, Optional
+
+from modules import sqlite
+from modules.logging import debug, info, warn, error
+from utils.paths import GATEWAY_ARCHIVE_PARTITIONS_PATH
+
+ARCHIVE_STATE_TABLE = sqlite.SqliteTables.ARCHIVE_STATE.value
+# messages which don't match a typed table are stored as JSON, like all messages before the typed tables
+ARCHIVE_TABLE = "controller_archive"
+# all archived messages as (id, timestamp_ms, message), for reading the archive with other tools
+ARCHIVE_VIEW = "controller_archive_view"
+# the archive only accepts time ranges within these bounds
+MIN_ARCHIVE_TIMESTAMP_MS = 1735719469_000
+MAX_ARCHIVE_TIMESTAMP_MS = 2524637869_000
+
+REAL, INTEGER, BOOLEAN = "REAL", "INTEGER", "BOOLEAN"
+# typed tables of the controller payloads (software/controller/src/custom_types/mqtt_playload_types.py),
+# column -> kind. A message is stored in a typed table if its keys are the columns and all values are of
+# their kind or null, so the JSON of the message is restored exactly.
+ARCHIVE_MESSAGE_TYPES: dict[str, dict[str, str]] = {
+    "archive_co2": {  # MQTTCO2Data
+        "gmp343_raw": REAL, "gmp343_compensated": REAL, "gmp343_filtered": REAL, "gmp343_edge_corrected": REAL,
+        "gmp343_edge_dry": REAL, "gmp343_temperature": REAL, "bme280_temperature": REAL, "bme280_humidity": REAL,
+        "bme280_pressure": REAL, "sht45_temperature": REAL, "sht45_humidity": REAL,
+    },
+    "archive_co2_calibration": {  # MQTTCO2CalibrationData
+        "cal_bottle_id": INTEGER, "cal_gmp343_raw": REAL, "cal_gmp343_compensated": REAL,
+        "cal_gmp343_filtered": REAL, "cal_gmp343_temperature": REAL, "cal_bme280_temperature": REAL,
+        "cal_bme280_humidity": REAL, "cal_bme280_pressure": REAL, "cal_sht45_temperature": REAL,
+        "cal_sht45_humidity": REAL,
+    },
+    "archive_calibration_correction": {  # MQTTCalibrationCorrectionData
+        "cal_gmp343_slope": REAL, "cal_gmp343_intercept": REAL, "cal_sht_45_offset": REAL,
+    },
+    "archive_system": {  # MQTTSystemData
+        "enclosure_bme280_temperature": REAL, "enclosure_bme280_humidity": REAL,
+        "enclosure_bme280_pressure": REAL, "raspi_cpu_temperature": REAL, "raspi_disk_usage": REAL,
+        "raspi_cpu_usage": REAL, "raspi_memory_usage": REAL, "ups_powered_by_grid": BOOLEAN,
+        "ups_battery_is_fully_charged": BOOLEAN, "ups_battery_error_detected": BOOLEAN,
+        "ups_battery_above_voltage_threshold": BOOLEAN,
+    },
+    "archive_wind": {  # MQTTWindData
+        "wxt532_direction_min": REAL, "wxt532_direction_avg": REAL, "wxt532_direction_max": REAL,
+        "wxt532_speed_min": REAL, "wxt532_speed_avg": REAL, "wxt532_speed_max": REAL,
+        "wxt532_last_update_time": REAL,
+    },
+    "archive_wind_sensor_info": {  # MQTTWindSensorInfo
+        "wxt532_temperature": REAL, "wxt532_heating_voltage": REAL, "wxt532_supply_voltage": REAL,
+        "wxt532_reference_voltage": REAL, "wxt532_last_update_time": REAL,
+    },
+    "archive_communication_queue": {  # MQTTCommunicationQueueData
+        "communication_queue_written": INTEGER, "communication_queue_dropped": INTEGER,
+        "communication_queue_compacted": INTEGER, "communication_queue_evicted_logs": INTEGER,
+        "communication_queue_evicted": INTEGER,
+    },
+}
+ARCHIVE_TABLES = [ARCHIVE_TABLE] + list(ARCHIVE_MESSAGE_TYPES)
+# messages are ordered by (timestamp_ms, archive id), the archive id is the row id followed by the table index
+ARCHIVE_TABLE_INDEX_BITS = 4
+MAX_ARCHIVE_ID = 2**63 - 1
+MESSAGE_TYPES_BY_KEYS = {frozenset(columns): table for table, columns in ARCHIVE_MESSAGE_TYPES.items()}
+
+# messages are archived in one db file per UTC month (or day) in GATEWAY_ARCHIVE_PARTITIONS_PATH, so whole
+# partitions are discarded by deleting their files. The tables of the archive db are still read, discarded and
+# compacted, but not written anymore: they hold the messages archived before the partitions.
+PARTITION_NAME_FORMATS = {"month": "%Y-%m", "day": "%Y-%m-%d"}
+ARCHIVE_PARTITION = os.environ.get("ACROPOLIS_ARCHIVE_PARTITION") or "month"
+PARTITION_NAME_PATTERN = re.compile(r"^\d{4}-\d{2}(-\d{2})?\.db$")
+# partitions which ended this long ago are deleted, 0 keeps all partitions
+ARCHIVE_RETENTION_MS = int(os.environ.get("ACROPOLIS_ARCHIVE_RETENTION_DAYS") or 0) * 86400_000
+# the table indices of the archive db follow the ones of the partitions, so the archive ids stay unique
+LEGACY_TABLE_INDEX_OFFSET = len(ARCHIVE_TABLES)
+assert 2 * len(ARCHIVE_TABLES) <= 2**ARCHIVE_TABLE_INDEX_BITS
+
+# names of the partition files, their opened connections and the highest outbox message id archived in them
+partition_names: set[str] = set()
+partitions: dict[str, sqlite.SqliteConnection] = {}
+partition_watermarks: dict[str, int] = {}
+# held while messages are archived, compacted or discarded and while partitions are dropped, so no rows are
+# written into the file of a dropped partition and compaction doesn't restore discarded rows
+partitions_lock = threading.RLock()
+
+# messages older than this are moved from the tables into compressed chunks of one hour per table,
+# the chunks hold the rows of the table as zlib compressed JSON [[id, timestamp_ms, *values], ...]
+ARCHIVE_CHUNKS_TABLE = "archive_chunks"
+ARCHIVE_COMPACTION_AGE_MS = int(os.environ.get("ACROPOLIS_ARCHIVE_COMPACTION_AGE_DAYS") or 7) * 86400_000
+ARCHIVE_CHUNK_MS = 3600_000
+# decompressed chunks by (db path, chunk id) kept in memory
+CHUNK_CACHE_SIZE = 8
+chunk_cache: OrderedDict[tuple[str, int], list[list]] = OrderedDict()
+chunk_cache_lock = threading.Lock()
+# (raw bytes, compressed bytes) of the chunks per db path
+chunk_sizes: dict[str, tuple[int, int]] = {}
+# partitions which ended before the compaction cutoff and have nothing left to compact
+compacted_partitions: set[str] = set()
+
+# compacted messages since startup and the compression ratio of all chunks, published as telemetry
+compaction_counters = {
+    "archive_compacted_messages": 0,
+    "archive_compression_ratio": 0.0,
+}
+
+
+def _create_archive_tables(db: sqlite.SqliteConnection) -> None:
+    db.execute(f"""
+            CREATE TABLE IF NOT EXISTS {ARCHIVE_TABLE} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp_ms INTEGER,
+                message TEXT
+            );
+        """)
+    # the id is the rowid, so the index is ordered by (timestamp_ms, id)
+    db.execute(f"CREATE INDEX IF NOT EXISTS {ARCHIVE_TABLE}_ts_index on {ARCHIVE_TABLE} (timestamp_ms);")
+    for table, columns in ARCHIVE_MESSAGE_TYPES.items():
+        db.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp_ms INTEGER NOT NULL,
+                {', '.join(f'{column} {INTEGER if kind == BOOLEAN else kind}' for column, kind in columns.items())}
+            );
+        """)
+        db.execute(f"CREATE INDEX IF NOT EXISTS {table}_ts_index on {table} (timestamp_ms);")
+
+    db.execute(f"""
+        CREATE TABLE IF NOT EXISTS {ARCHIVE_CHUNKS_TABLE} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            min_timestamp_ms INTEGER NOT NULL,
+            max_timestamp_ms INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            raw_bytes INTEGER NOT NULL,
+            compressed_bytes INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+    """)
+    db.execute(f"CREATE INDEX IF NOT EXISTS {ARCHIVE_CHUNKS_TABLE}_ts_index "
+               f"on {ARCHIVE_CHUNKS_TABLE} (table_name, min_timestamp_ms);")
+    db.execute(f"CREATE TABLE IF NOT EXISTS {ARCHIVE_STATE_TABLE} (key TEXT PRIMARY KEY, value INTEGER NOT NULL);")
+
+    # recreated in case the tables changed
+    def json_value(column: str, kind: str) -> str:
+        return f"CASE {column} WHEN 1 THEN json('true') WHEN 0 THEN json('false') END" if kind == BOOLEAN else column
+    db.execute(f"DROP VIEW IF EXISTS {ARCHIVE_VIEW};")
+    db.execute(f"CREATE VIEW {ARCHIVE_VIEW} AS " + " UNION ALL ".join(
+        [f"SELECT id << {ARCHIVE_TABLE_INDEX_BITS} AS id, timestamp_ms, message FROM {ARCHIVE_TABLE}"] + [
+            f"SELECT id << {ARCHIVE_TABLE_INDEX_BITS} | {ARCHIVE_TABLES.index(table)}, timestamp_ms, json_object("
+            + ", ".join(f"'{column}', {json_value(column, kind)}" for column, kind in columns.items()) + f") FROM {table}"
+            for table, columns in ARCHIVE_MESSAGE_TYPES.items()
+        ]) + ";")
+    _update_chunk_sizes(db)
+
+
+def init_archive_db(archive_db: sqlite.SqliteConnection) -> None:
+    """Creates the tables of the archive db and lists the partitions"""
+    _create_archive_tables(archive_db)
+    if ARCHIVE_PARTITION not in PARTITION_NAME_FORMATS:
+        warn(f"[ARCHIVE] Unknown partition '{ARCHIVE_PARTITION}', expected one of {list(PARTITION_NAME_FORMATS)}")
+    os.makedirs(GATEWAY_ARCHIVE_PARTITIONS_PATH, exist_ok=True)
+    with partitions_lock:
+        partition_names.update(file_name[:-3] for file_name in os.listdir(GATEWAY_ARCHIVE_PARTITIONS_PATH)
+                               if PARTITION_NAME_PATTERN.match(file_name))
+    info(f"[ARCHIVE] {len(partition_names)} partitions in {GATEWAY_ARCHIVE_PARTITIONS_PATH}")
+
+
+def _partition_range(name: str) -> tuple[int, int]:
+    """Time range [start, end) of a partition in ms"""
+    if len(name) == len("YYYY-MM"):
+        start = datetime.strptime(name, PARTITION_NAME_FORMATS["month"]).replace(tzinfo=timezone.utc)
+        end = (start + timedelta(days=32)).replace(day=1)
+    else:
+        start = datetime.strptime(name, PARTITION_NAME_FORMATS["day"]).replace(tzinfo=timezone.utc)
+        end = start + timedelta(days=1)
+    return int(start.timestamp()) * 1000, int(end.timestamp()) * 1000
+
+
+def _partition_name(timestamp_ms: int) -> str:
+    """Partition of a new message. Months which already have partitions keep their granularity after changing
+    `ACROPOLIS_ARCHIVE_PARTITION`: a month file takes the messages of all its days and a month with day files
+    gets new day files. The partitions never overlap in time, which keeps the archive ids of a timestamp unique."""
+    date = datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc)
+    month_name = date.strftime(PARTITION_NAME_FORMATS["month"])
+    day_name = date.strftime(PARTITION_NAME_FORMATS["day"])
+    if month_name in partition_names:
+        return month_name
+    if day_name in partition_names or any(name.startswith(f"{month_name}-") for name in partition_names):
+        return day_name
+    return day_name if ARCHIVE_PARTITION == "day" else month_name
+
+
+def _partition_path(name: str) -> str:
+    return os.path.join(GATEWAY_ARCHIVE_PARTITIONS_PATH, f"{name}.db")
+
+
+def _get_partition(name: str, create: bool = False) -> Optional[sqlite.SqliteConnection]:
+    """Connection of a partition, None if it doesn't exist (anymore) unless it is created"""
+    with partitions_lock:
+        if name not in partition_names and not create:
+            return None
+        if name not in partitions:
+            db = sqlite.SqliteConnection(_partition_path(name))
+            _create_archive_tables(db)
+            partitions[name] = db
+            partition_names.add(name)
+            partition_watermarks[name] = _read_archived_up_to_id(db)
+        return partitions[name]
+
+
+def _archive_dbs(archive_db: sqlite.SqliteConnection, start_timestamp_ms: int,
+                 end_timestamp_ms: int) -> list[tuple[sqlite.SqliteConnection, int]]:
+    """(db, table index offset) of the archive db and of the partitions overlapping the time range (exclusive)"""
+    with partitions_lock:
+        names = sorted(partition_names)
+    dbs = [(archive_db, LEGACY_TABLE_INDEX_OFFSET)]
+    for name in names:
+        partition_start_timestamp_ms, partition_end_timestamp_ms = _partition_range(name)
+        if partition_start_timestamp_ms < end_timestamp_ms and partition_end_timestamp_ms > start_timestamp_ms + 1:
+            db = _get_partition(name)
+            if db is not None:
+                dbs.append((db, 0))
+    return dbs
+
+
+def _drop_partition(name: str) -> None:
+    """Closes the connection of a partition and deletes its files. Threads still reading the partition get no
+    rows, writers resolve the partition again and recreate it."""
+    with partitions_lock:
+        partition_names.discard(name)
+        db = partitions.pop(name, None)
+        if db is not None:
+            db.db_unavailable = True
+            db.close()
+        partition_watermarks.pop(name, None)
+        compacted_partitions.discard(name)
+        path = _partition_path(name)
+        for suffix in ["", "-wal", "-shm"]:
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+    chunk_sizes.pop(path, None)
+    with chunk_cache_lock:
+        for key in [key for key in chunk_cache if key[0] == path]:
+            del chunk_cache[key]
+    _update_compaction_ratio()
+
+
+def _read_archived_up_to_id(db: sqlite.SqliteConnection) -> int:
+    rows = db.execute(f"SELECT value FROM {ARCHIVE_STATE_TABLE} WHERE key = 'archived_up_to_id';")
+    if rows is not None and len(rows) > 0 and len(rows[0]) > 0:
+        return int(rows[0][0])
+    return 0
+
+
+def _archived_up_to_id_query(message_id: int) -> tuple[str, tuple]:
+    return (f"INSERT INTO {ARCHIVE_STATE_TABLE} (key, value) VALUES ('archived_up_to_id', ?) "
+            f"ON CONFLICT(key) DO UPDATE SET value = excluded.value;", (message_id,))
+
+
+def _columns(table: str) -> list[str]:
+    return ["message"] if table == ARCHIVE_TABLE else list(ARCHIVE_MESSAGE_TYPES[table])
+
+
+def _matches_kind(value: Any, kind: str) -> bool:
+    if value is None:
+        return True
+    if kind == BOOLEAN:
+        return isinstance(value, bool)
+    if kind == INTEGER:
+        return isinstance(value, int) and not isinstance(value, bool)
+    # sqlite stores NaN as null
+    return isinstance(value, float) and math.isfinite(value)
+
+
+def route_archive_message(message: str) -> tuple[str, tuple]:
+    """The table and the row values (after the timestamp) of an archived message"""
+    try:
+        values = json.loads(message)
+    except json.JSONDecodeError:
+        return ARCHIVE_TABLE, (message,)
+    table = MESSAGE_TYPES_BY_KEYS.get(frozenset(values)) if isinstance(values, dict) else None
+    if table is None:
+        return ARCHIVE_TABLE, (message,)
+    columns = ARCHIVE_MESSAGE_TYPES[table]
+    if not all(_matches_kind(values[column], kind) for column, kind in columns.items()):
+        return ARCHIVE_TABLE, (message,)
+    return table, tuple(values[column] for column in columns)
+
+
+def archive_insert_queries(messages: list[tuple[int, str]]) -> list[tuple[str, list[tuple]]]:
+    """Queries for `execute_transaction` archiving the (timestamp_ms, message) rows in their tables"""
+    rows: dict[str, list[tuple]] = {}
+    for timestamp_ms, message in messages:
+        table, values = route_archive_message(message)
+        rows.setdefault(table, []).append((timestamp_ms, *values))
+    queries = []
+    for table, table_rows in rows.items():
+        columns = _columns(table)
+        queries.append((f"INSERT INTO {table} (timestamp_ms, {', '.join(columns)}) "
+                        f"VALUES (?, {', '.join('?' * len(columns))});", table_rows))
+    return queries
+
+
+def archive_messages(messages: list[tuple[int, int, str]]) -> bool:
+    """Archives the (outbox message id, timestamp_ms, message) rows in their partitions, one transaction per
+    partition. Each partition stores the highest message id archived in it, so retrying the messages after a
+    failure or a restart doesn't archive them twice. Returns False if a partition could not be written."""
+    rows: dict[str, list[tuple[int, int, str]]] = {}
+    with partitions_lock:
+        for message_id, timestamp_ms, message in messages:
+            rows.setdefault(_partition_name(timestamp_ms), []).append((message_id, timestamp_ms, message))
+    for name, partition_rows in rows.items():
+        with partitions_lock:
+            db = _get_partition(name, create=True)
+            assert db is not None
+            partition_rows = [row for row in partition_rows if row[0] > partition_watermarks.get(name, 0)]
+            if len(partition_rows) == 0:
+                continue
+            if not db.execute_transaction([
+                *archive_insert_queries([(timestamp_ms, message) for _, timestamp_ms, message in partition_rows]),
+                _archived_up_to_id_query(partition_rows[-1][0]),
+            ]):
+                return False
+            partition_watermarks[name] = partition_rows[-1][0]
+    return True
+
+
+def reset_partition_watermarks() -> None:
+    """Resets the archived message ids of the partitions after the outbox message ids restarted"""
+    with partitions_lock:
+        names = sorted(partition_names)
+    for name in names:
+        with partitions_lock:
+            db = _get_partition(name)
+            if db is not None:
+                db.execute(*_archived_up_to_id_query(0))
+                partition_watermarks[name] = 0
+
+
+def _to_message(table: str, values: tuple) -> str:
+    if table == ARCHIVE_TABLE:
+        return values[0]
+    return json.dumps({column: bool(value) if kind == BOOLEAN and value is not None else value
+                       for (column, kind), value in zip(ARCHIVE_MESSAGE_TYPES[table].items(), values)})
+
+
+def _chunk_metas(db: sqlite.SqliteConnection, table: str, start_timestamp_ms: int,
+                 end_timestamp_ms: int) -> list[tuple[int, int, int, int]]:
+    """(chunk id, min timestamp_ms, max timestamp_ms, row count) of the chunks of the table overlapping the time
+    range (inclusive), ordered by their min timestamp. A chunk spans at most one hour."""
+    rows = db.read(f"""
+        SELECT id, min_timestamp_ms, max_timestamp_ms, row_count FROM {ARCHIVE_CHUNKS_TABLE}
+            WHERE table_name = ? AND min_timestamp_ms <= ? AND max_timestamp_ms >= ?
+                AND min_timestamp_ms > ? - {ARCHIVE_CHUNK_MS}
+            ORDER BY min_timestamp_ms;
+        """, (table, end_timestamp_ms, start_timestamp_ms, start_timestamp_ms)) or []
+    return [row for row in rows if len(row) > 0]
+
+
+def _read_chunk(db: sqlite.SqliteConnection, chunk_id: int) -> list[list]:
+    """[id, timestamp_ms, *values] rows of a chunk, ordered by (timestamp_ms, id). Chunks are immutable, so
+    the last decompressed ones are cached for paginating."""
+    key = (db.path, chunk_id)
+    with chunk_cache_lock:
+        if key in chunk_cache:
+            chunk_cache.move_to_end(key)
+            return chunk_cache[key]
+    data = db.read(f"SELECT data FROM {ARCHIVE_CHUNKS_TABLE} WHERE id = ?;", (chunk_id,)) or []
+    rows = json.loads(zlib.decompress(data[0][0])) if len(data) > 0 and len(data[0]) > 0 else []
+    with chunk_cache_lock:
+        chunk_cache[key] = rows
+        while len(chunk_cache) > CHUNK_CACHE_SIZE:
+            chunk_cache.popitem(last=False)
+    return rows
+
+
+def _chunk_insert_query(table: str, rows: list[list]) -> tuple[str, tuple]:
+    raw = json.dumps(rows, separators=(",", ":")).encode()
+    data = zlib.compress(raw, 9)
+    return (f"""INSERT INTO {ARCHIVE_CHUNKS_TABLE}
+                (table_name, min_timestamp_ms, max_timestamp_ms, row_count, raw_bytes, compressed_bytes, data)
+                VALUES (?, ?, ?, ?, ?, ?, ?);""",
+            (table, rows[0][1], rows[-1][1], len(rows), len(raw), len(data), data))
+
+
+def _read_page(db: sqlite.SqliteConnection, index_offset: int, end_timestamp_ms: int, after_timestamp_ms: int,
+               after_id: int, limit: int) -> list[tuple[int, int, str, tuple]]:
+    pages = []
+    for table_index, table in enumerate(ARCHIVE_TABLES):
+        index = index_offset + table_index
+        columns = _columns(table)
+        # id << bits | index > after_id
+        after_row_id = (after_id - index) >> ARCHIVE_TABLE_INDEX_BITS
+        rows = db.read(f"""
+            SELECT id, timestamp_ms, {', '.join(columns)} FROM {table}
+                WHERE timestamp_ms >= ? AND (timestamp_ms > ? OR id > ?) AND timestamp_ms < ?
+                ORDER BY timestamp_ms, id LIMIT ?;
+            """, (after_timestamp_ms, after_timestamp_ms, after_row_id, end_timestamp_ms, limit)) or []
+        pages.append([(row[1], row[0] << ARCHIVE_TABLE_INDEX_BITS | index, table, tuple(row[2:]))
+                      for row in rows if len(row) > 0])
+
+        cold_rows: list[tuple] = []
+        for chunk_id, min_timestamp_ms, _, _ in _chunk_metas(db, table, after_timestamp_ms, end_timestamp_ms - 1):
+            # the following chunks only contain later messages
+            if len(cold_rows) >= limit and min_timestamp_ms > cold_rows[limit - 1][0]:
+                break
+            cold_rows += [
+                (row[1], row[0] << ARCHIVE_TABLE_INDEX_BITS | index, table, tuple(row[2:]))
+                for row in _read_chunk(db, chunk_id)
+                if (row[1] > after_timestamp_ms or (row[1] == after_timestamp_ms and row[0] > after_row_id))
+                and row[1] < end_timestamp_ms
+            ]
+            cold_rows.sort(key=lambda row: (row[0], row[1]))
+        pages.append(cold_rows[:limit])
+    return list(heapq.merge(*pages))[:limit]
+
+
+def read_archive_page(archive_db: sqlite.SqliteConnection, end_timestamp_ms: int, after_timestamp_ms: int,
+                      after_id: int, limit: int) -> list[tuple[int, int, str]]:
+    """(archive id, timestamp_ms, message) of the archived messages after the key (`after_timestamp_ms`,
+    `after_id`) and before `end_timestamp_ms`, ordered by (timestamp_ms, archive id). Paginating on the full
+    key does not skip messages sharing a timestamp at a page boundary. Reads the tables and the chunks of the
+    archive db and of the partitions."""
+    pages = [_read_page(db, index_offset, end_timestamp_ms, after_timestamp_ms, after_id, limit)
+             for db, index_offset in _archive_dbs(archive_db, after_timestamp_ms - 1, end_timestamp_ms)]
+    return [(archive_id, timestamp_ms, _to_message(table, values))
+            for timestamp_ms, archive_id, table, values in list(heapq.merge(*pages))[:limit]]
+
+
+def _count(db: sqlite.SqliteConnection, start_timestamp_ms: int, end_timestamp_ms: int) -> int:
+    count = 0
+    for table in ARCHIVE_TABLES:
+        rows = db.read(f"SELECT COUNT(*) FROM {table} WHERE timestamp_ms > ? AND timestamp_ms < ?;",
+                       (start_timestamp_ms, end_timestamp_ms))
+        if rows is not None and len(rows) > 0 and len(rows[0]) > 0:
+            count += int(rows[0][0])
+        for chunk_id, min_timestamp_ms, max_timestamp_ms, row_count in _chunk_metas(
+                db, table, start_timestamp_ms, end_timestamp_ms):
+            if start_timestamp_ms < min_timestamp_ms and max_timestamp_ms < end_timestamp_ms:
+                count += row_count
+            else:
+                count += sum(1 for row in _read_chunk(db, chunk_id) if start_timestamp_ms < row[1] < end_timestamp_ms)
+    return count
+
+
+def count_archive_messages(archive_db: sqlite.SqliteConnection, start_timestamp_ms: int, end_timestamp_ms: int) -> int:
+    return sum(_count(db, start_timestamp_ms, end_timestamp_ms)
+               for db, _ in _archive_dbs(archive_db, start_timestamp_ms, end_timestamp_ms))
+
+
+def discard_archive_messages(archive_db: sqlite.SqliteConnection, start_timestamp_ms: int,
+                             end_timestamp_ms: int) -> Optional[int]:
+    """Deletes the archived messages within the time range (exclusive), returns the number of deleted messages
+    or None if deleting failed. Partitions within the range are deleted as a whole. In the partitions
+    overlapping its bounds and in the archive db, the rows are deleted, chunks within the range are deleted and
+    chunks overlapping its bounds are rewritten."""
+    count = 0
+    with partitions_lock:
+        names = sorted(partition_names)
+    for name in names:
+        partition_start_timestamp_ms, partition_end_timestamp_ms = _partition_range(name)
+        if start_timestamp_ms < partition_start_timestamp_ms and partition_end_timestamp_ms <= end_timestamp_ms:
+            with partitions_lock:
+                db = _get_partition(name)
+                if db is None:
+                    continue
+                count += _count(db, start_timestamp_ms, end_timestamp_ms)
+                _drop_partition(name)
+            info(f"[ARCHIVE] Deleted partition {name}")
+
+    for db, _ in _archive_dbs(archive_db, start_timestamp_ms, end_timestamp_ms):
+        # no messages are archived between counting and deleting
+        with partitions_lock:
+            count += _count(db, start_timestamp_ms, end_timestamp_ms)
+            queries: list[tuple[str, Any]] = []
+            for table in ARCHIVE_TABLES:
+                queries.append((f"DELETE FROM {table} WHERE timestamp_ms > ? AND timestamp_ms < ?;",
+                                (start_timestamp_ms, end_timestamp_ms)))
+                for chunk_id, _, _, _ in _chunk_metas(db, table, start_timestamp_ms, end_timestamp_ms):
+                    kept_rows = [row for row in _read_chunk(db, chunk_id)
+                                 if not start_timestamp_ms < row[1] < end_timestamp_ms]
+                    queries.append((f"DELETE FROM {ARCHIVE_CHUNKS_TABLE} WHERE id = ?;", (chunk_id,)))
+                    if len(kept_rows) > 0:
+                        queries.append(_chunk_insert_query(table, kept_rows))
+            if not db.execute_transaction(queries):
+                error(f"[ARCHIVE] Failed to discard archived messages in {db.path}")
+                return None
+        _update_chunk_sizes(db)
+    return count
+
+
+def drop_expired_partitions() -> int:
+    """Deletes the partitions which ended more than `ARCHIVE_RETENTION_MS` ago, returns the number of deleted
+    partitions"""
+    if ARCHIVE_RETENTION_MS <= 0:
+        return 0
+    cutoff_timestamp_ms = int(time_ns() / 1_000_000) - ARCHIVE_RETENTION_MS
+    with partitions_lock:
+        names = sorted(partition_names)
+    expired_names = [name for name in names if _partition_range(name)[1] <= cutoff_timestamp_ms]
+    for name in expired_names:
+        _drop_partition(name)
+        info(f"[ARCHIVE] Deleted partition {name}, older than the retention")
+    return len(expired_names)
+
+
+def get_field_tables(field: str) -> list[str]:
+    return [table for table, columns in ARCHIVE_MESSAGE_TYPES.items() if field in columns]
+
+
+def _add_to_bucket(buckets: dict[int, list], bucket: int, min_value: float, sum_value: float, max_value: float,
+                   count: int) -> None:
+    if bucket not in buckets:
+        buckets[bucket] = [min_value, sum_value, max_value, count]
+        return
+    values = buckets[bucket]
+    values[0], values[1], values[2], values[3] = \
+        min(values[0], min_value), values[1] + sum_value, max(values[2], max_value), values[3] + count
+
+
+def _query_buckets(db: sqlite.SqliteConnection, start_timestamp_ms: int, end_timestamp_ms: int, field: str,
+                   bucket_ms: int, buckets: dict[int, list]) -> None:
+    values_queries = [f"SELECT timestamp_ms, json_extract(message, ?) AS value FROM {ARCHIVE_TABLE} "
+                      f"WHERE timestamp_ms > ? AND timestamp_ms < ?"]
+    params: list[Any] = [f'$."{field}"', start_timestamp_ms, end_timestamp_ms]
+    for table in get_field_tables(field):
+        values_queries.append(f"SELECT timestamp_ms, {field} FROM {table} WHERE timestamp_ms > ? AND timestamp_ms < ?")
+        params += [start_timestamp_ms, end_timestamp_ms]
+    rows = db.read(f"""
+        SELECT timestamp_ms - timestamp_ms % ? AS bucket, MIN(value), SUM(value), MAX(value), COUNT(value)
+            FROM ({' UNION ALL '.join(values_queries)})
+            WHERE typeof(value) IN ('integer', 'real')
+            GROUP BY bucket;
+        """, (bucket_ms, *params)) or []
+    for row in rows:
+        if len(row) > 0:
+            _add_to_bucket(buckets, *row)
+
+    for table in [ARCHIVE_TABLE] + get_field_tables(field):
+        column_index = 0 if table == ARCHIVE_TABLE else list(ARCHIVE_MESSAGE_TYPES[table]).index(field)
+        for chunk_id, _, _, _ in _chunk_metas(db, table, start_timestamp_ms, end_timestamp_ms):
+            for row in _read_chunk(db, chunk_id):
+                if not start_timestamp_ms < row[1] < end_timestamp_ms:
+                    continue
+                value = row[2 + column_index]
+                if table == ARCHIVE_TABLE:
+                    try:
+                        value = json.loads(value).get(field)
+                    except (json.JSONDecodeError, AttributeError):
+                        continue
+                if not isinstance(value, (int, float)):
+                    continue
+                _add_to_bucket(buckets, row[1] - row[1] % bucket_ms, value, value, value, 1)
+
+
+def query_archive_buckets(archive_db: sqlite.SqliteConnection, start_timestamp_ms: int, end_timestamp_ms: int,
+                          field: str, bucket_ms: int) -> list[tuple[int, float, float, float, int]]:
+    """(bucket start, min, mean, max, count) of the numeric values of `field` per time bucket of the archived
+    messages within the time range (exclusive). The tables are aggregated in sqlite, reading the column of the
+    typed tables and the JSON of the untyped messages, and the values of the chunks are added."""
+    buckets: dict[int, list] = {}
+    for db, _ in _archive_dbs(archive_db, start_timestamp_ms, end_timestamp_ms):
+        _query_buckets(db, start_timestamp_ms, end_timestamp_ms, field, bucket_ms, buckets)
+    return [(bucket, min_value, sum_value / count, max_value, count)
+            for bucket, (min_value, sum_value, max_value, count) in sorted(buckets.items())]
+
+
+def _compact(db: sqlite.SqliteConnection, cutoff_timestamp_ms: int) -> int:
+    # a discard between reading the rows and deleting them by id would be undone by the chunk
+    with partitions_lock:
+        for table in ARCHIVE_TABLES:
+            first = db.read(f"SELECT MIN(timestamp_ms) FROM {table} WHERE timestamp_ms < ?;", (cutoff_timestamp_ms,))
+            if first is None or len(first) == 0 or len(first[0]) == 0 or first[0][0] is None:
+                continue
+            chunk_start_timestamp_ms = first[0][0] - first[0][0] % ARCHIVE_CHUNK_MS
+            rows = db.read(f"""
+                SELECT id, timestamp_ms, {', '.join(_columns(table))} FROM {table}
+                    WHERE timestamp_ms >= ? AND timestamp_ms < ? ORDER BY timestamp_ms, id;
+                """, (chunk_start_timestamp_ms, chunk_start_timestamp_ms + ARCHIVE_CHUNK_MS)) or []
+            rows = [list(row) for row in rows if len(row) > 0]
+            if len(rows) == 0:
+                continue
+            # delete by id, the chunk only holds the rows read above
+            if not db.execute_transaction([
+                _chunk_insert_query(table, rows),
+                (f"DELETE FROM {table} WHERE id = ?;", [(row[0],) for row in rows]),
+            ]):
+                return 0
+            compaction_counters["archive_compacted_messages"] += len(rows)
+            _update_chunk_sizes(db)
+            debug(f"[ARCHIVE] Compacted {len(rows)} messages of {table} at {chunk_start_timestamp_ms} in {db.path}")
+            return len(rows)
+        return 0
+
+
+def compact_archive(archive_db: sqlite.SqliteConnection) -> int:
+    """Moves the messages of the oldest hour of a table that is older than `ARCHIVE_COMPACTION_AGE_MS` into a
+    compressed chunk, in the archive db or the oldest partition. Returns the number of compacted messages, 0 if
+    there is nothing to compact."""
+    cutoff_timestamp_ms = int(time_ns() / 1_000_000) - ARCHIVE_COMPACTION_AGE_MS
+    cutoff_timestamp_ms -= cutoff_timestamp_ms % ARCHIVE_CHUNK_MS
+    compacted = _compact(archive_db, cutoff_timestamp_ms)
+    if compacted > 0:
+        return compacted
+    with partitions_lock:
+        names = sorted(partition_names - compacted_partitions)
+    for name in names:
+        partition_start_timestamp_ms, partition_end_timestamp_ms = _partition_range(name)
+        if partition_start_timestamp_ms >= cutoff_timestamp_ms:
+            break
+        db = _get_partition(name)
+        if db is None:
+            continue
+        compacted = _compact(db, cutoff_timestamp_ms)
+        if compacted > 0:
+            return compacted
+        if partition_end_timestamp_ms <= cutoff_timestamp_ms:
+            with partitions_lock:
+                if name in partition_names:
+                    compacted_partitions.add(name)
+    return 0
+
+
+def _update_chunk_sizes(db: sqlite.SqliteConnection) -> None:
+    sizes = db.read(f"SELECT SUM(raw_bytes), SUM(compressed_bytes) FROM {ARCHIVE_CHUNKS_TABLE};")
+    if sizes is not None and len(sizes) > 0 and len(sizes[0]) > 0 and sizes[0][1]:
+        chunk_sizes[db.path] = (int(sizes[0][0]), int(sizes[0][1]))
+    else:
+        chunk_sizes.pop(db.path, None)
+    _update_compaction_ratio()
+
+
+def _update_compaction_ratio() -> None:
+    sizes = list(chunk_sizes.values())
+    compressed_bytes = sum(compressed for _, compressed in sizes)
+    if compressed_bytes > 0:
+        compaction_counters["archive_compression_ratio"] = round(sum(raw for raw, _ in sizes) / compressed_bytes, 2)
@@ -0,0 +1,207 @@
+import json
+import os
+import threading
+from time import monotonic
+from typing import Any, Optional
+
+from modules import sqlite
+from modules.archive import read_archive_page, count_archive_messages, MAX_ARCHIVE_ID
+from modules.logging import info, warn, error
+from modules.mqtt import GatewayMqttClient
+from modules.outbox import TELEMETRY_BATCH_MAX_RECORDS, TELEMETRY_BATCH_MAX_BYTES
+from utils.timestamps import timestamp_allocator
+
+JOB_TABLE = sqlite.SqliteTables.ARCHIVE_REPUBLISH_JOB.value
+# republished messages share the link with live telemetry, so they are paced to this rate
+ARCHIVE_REPUBLISH_MAX_BYTES_PER_SECOND = int(os.environ.get("ACROPOLIS_ARCHIVE_REPUBLISH_MAX_BYTES_PER_SECOND") or 8000)
+# interval of the `archive_republish_*` progress telemetry
+PROGRESS_PUBLISH_INTERVAL_SECONDS = 10
+# interval in which the connection is checked while offline or after a failed publish
+RETRY_INTERVAL_SECONDS = 5
+
+singleton_instance : Optional["ArchiveRepublisher"] = None
+
+class ArchiveRepublisher:
+    """Republishes a time range of the archive as telemetry batches in a background thread.
+
+    The job and its cursor, the (timestamp_ms, archive id) key of the last republished message, are persisted in
+    the archive db after each batch, so a job resumes where it stopped after a gateway restart. Only one
+    job runs at a time."""
+    archive_db: Optional[sqlite.SqliteConnection] = None
+    job: Optional[dict[str, Any]] = None
+    job_thread: Optional[threading.Thread] = None
+    cancel_event = threading.Event()
+    lock = threading.Lock()
+
+    def __init__(self) -> None:
+        global singleton_instance
+        if singleton_instance is None:
+            super().__init__()
+            singleton_instance = self
+
+    # Singleton pattern
+    def __new__(cls: Any) -> Any:
+        global singleton_instance
+        if singleton_instance is not None:
+            return singleton_instance
+        return super(ArchiveRepublisher, cls).__new__(cls)
+
+    def init(self, archive_db: sqlite.SqliteConnection) -> "ArchiveRepublisher":
+        """Resumes the job of a previous run"""
+        self.archive_db = archive_db
+        archive_db.execute(f"""
+            CREATE TABLE IF NOT EXISTS {JOB_TABLE} (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                rpc_msg_id TEXT NOT NULL,
+                start_timestamp_ms INTEGER NOT NULL,
+                end_timestamp_ms INTEGER NOT NULL,
+                cursor_timestamp_ms INTEGER NOT NULL,
+                cursor_id INTEGER NOT NULL,
+                republished_count INTEGER NOT NULL,
+                total_count INTEGER NOT NULL
+            );
+        """)
+        rows = archive_db.read(f"""
+            SELECT rpc_msg_id, start_timestamp_ms, end_timestamp_ms, cursor_timestamp_ms, cursor_id,
+                republished_count, total_count FROM {JOB_TABLE} WHERE id = 1;
+        """) or []
+        if len(rows) > 0 and len(rows[0]) > 0:
+            keys = ["rpc_msg_id", "start_timestamp_ms", "end_timestamp_ms", "cursor_timestamp_ms", "cursor_id",
+                    "republished_count", "total_count"]
+            with self.lock:
+                self.job = dict(zip(keys, rows[0]))
+                info(f"[ARCHIVE-REPUBLISHER] Resuming republish job {self.job['rpc_msg_id']} at "
+                     f"{self.job['republished_count']}/{self.job['total_count']} messages")
+                self.__start_thread()
+        return self
+
+    def start(self, rpc_msg_id: str, start_timestamp_ms: int, end_timestamp_ms: int) -> Optional[str]:
+        """Starts republishing the messages within the time range (exclusive), returns the reason if the job
+        is rejected"""
+        if self.archive_db is None or self.archive_db.db_unavailable:
+            return "archive database unavailable"
+        with self.lock:
+            if self.job is not None:
+                return f"republish job {self.job['rpc_msg_id']} is running, cancel it first"
+            job = {
+                "rpc_msg_id": rpc_msg_id,
+                "start_timestamp_ms": start_timestamp_ms,
+                "end_timestamp_ms": end_timestamp_ms,
+                # the first key after the cursor has a timestamp > start_timestamp_ms
+                "cursor_timestamp_ms": start_timestamp_ms,
+                "cursor_id": MAX_ARCHIVE_ID,
+                "republished_count": 0,
+                "total_count": count_archive_messages(self.archive_db, start_timestamp_ms, end_timestamp_ms),
+            }
+            if not self.archive_db.execute_transaction([(
+                    f"INSERT OR REPLACE INTO {JOB_TABLE} (id, {', '.join(job.keys())}) VALUES (1, {', '.join('?' * len(job))});",
+                    tuple(job.values()))]):
+                return "failed to persist the job"
+            self.job = job
+            info(f"[ARCHIVE-REPUBLISHER] Republishing {job['total_count']} messages - {start_timestamp_ms} -> {end_timestamp_ms}")
+            self.__start_thread()
+        return None
+
+    def cancel(self) -> Optional[dict[str, Any]]:
+        """Stops the running job after the current batch, returns it or None if no job is running"""
+        with self.lock:
+            if self.job is None:
+                return None
+            self.cancel_event.set()
+            return dict(self.job)
+
+    def status(self) -> Optional[dict[str, Any]]:
+        with self.lock:
+            return dict(self.job) if self.job is not None else None
+
+    def __start_thread(self) -> None:
+        if self.job_thread is None:
+            self.cancel_event.clear()
+            self.job_thread = threading.Thread(target=self.__run_job, name="archive-republisher", daemon=True)
+            self.job_thread.start()
+
+    def __publish_progress(self, job: dict[str, Any], state: str) -> None:
+        GatewayMqttClient().publish_telemetry(json.dumps({
+            "ts": timestamp_allocator.allocate("archive_republish"),
+            "values": {
+                "archive_republish_rpc_msg_id": job["rpc_msg_id"],
+                "archive_republish_state": state,
+                "archive_republish_count": job["republished_count"],
+                "archive_republish_total": job["total_count"],
+                "archive_republish_cursor_ms": job["cursor_timestamp_ms"],
+            }
+        }))
+
+    def __next_batch(self, job: dict[str, Any]) -> tuple[list[str], tuple[int, int]]:
+        """Telemetry records of the next batch within the batch limits and the key of its last message"""
+        assert self.archive_db is not None
+        rows = read_archive_page(self.archive_db, job["end_timestamp_ms"], job["cursor_timestamp_ms"],
+                                 job["cursor_id"], TELEMETRY_BATCH_MAX_RECORDS)
+        records: list[str] = []
+        batch_bytes = 2
+        cursor = (job["cursor_timestamp_ms"], job["cursor_id"])
+        for message_id, timestamp_ms, message in rows:
+            record = f'{{"ts": {timestamp_ms}, "values": {message}}}'
+            if len(records) > 0 and batch_bytes + len(record) + 2 > TELEMETRY_BATCH_MAX_BYTES:
+                break
+            records.append(record)
+            batch_bytes += len(record) + 2
+            cursor = (timestamp_ms, message_id)
+        return records, cursor
+
+    def __finish_job(self, job: dict[str, Any], state: str) -> None:
+        assert self.archive_db is not None
+        self.archive_db.execute(f"DELETE FROM {JOB_TABLE} WHERE id = 1;")
+        with self.lock:
+            self.job = None
+            self.job_thread = None
+        info(f"[ARCHIVE-REPUBLISHER] Republish job {job['rpc_msg_id']} {state.lower()} - "
+             f"{job['republished_count']}/{job['total_count']} messages republished")
+        self.__publish_progress(job, state)
+
+    def __run_job(self) -> None:
+        assert self.archive_db is not None
+        with self.lock:
+            assert self.job is not None
+            job = dict(self.job)
+        progress_publish_ts = 0.0
+        # earliest time of the next publish within the bandwidth budget
+        next_publish_ts = monotonic()
+
+        while not self.cancel_event.is_set():
+            if not GatewayMqttClient().connected:
+                self.cancel_event.wait(RETRY_INTERVAL_SECONDS)
+                continue
+            if self.cancel_event.wait(max(next_publish_ts - monotonic(), 0)):
+                break
+
+            try:
+                records, (cursor_timestamp_ms, cursor_id) = self.__next_batch(job)
+            except Exception as e:
+                error(f"[ARCHIVE-REPUBLISHER] Failed to read archived messages: {e}")
+                self.cancel_event.wait(RETRY_INTERVAL_SECONDS)
+                continue
+            if len(records) == 0:
+                self.__finish_job(job, "DONE")
+                return
+
+            batch = "[" + ", ".join(records) + "]"
+            if not GatewayMqttClient().publish_telemetry(batch):
+                warn(f"[ARCHIVE-REPUBLISHER] Failed to publish {len(records)} messages, retrying in {RETRY_INTERVAL_SECONDS}s")
+                self.cancel_event.wait(RETRY_INTERVAL_SECONDS)
+                continue
+            next_publish_ts = max(next_publish_ts, monotonic() - 1) + len(batch) / ARCHIVE_REPUBLISH_MAX_BYTES_PER_SECOND
+
+            job["cursor_timestamp_ms"], job["cursor_id"] = cursor_timestamp_ms, cursor_id
+            job["republished_count"] += len(records)
+            self.archive_db.execute(
+                f"UPDATE {JOB_TABLE} SET cursor_timestamp_ms = ?, cursor_id = ?, republished_count = ? WHERE id = 1;",
+                (cursor_timestamp_ms, cursor_id, job["republished_count"]))
+            with self.lock:
+                self.job = dict(job)
+
+            if monotonic() - progress_publish_ts > PROGRESS_PUBLISH_INTERVAL_SECONDS:
+                progress_publish_ts = monotonic()
+                self.__publish_progress(job, "RUNNING")
+
+        self.__finish_job(job, "CANCELLED")
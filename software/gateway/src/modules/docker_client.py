@@ -1,9 +1,12 @@
 import datetime
+import json
 import os
-from time import sleep
+import threading
+from time import sleep, monotonic
 from typing import Any, Optional
 
 import docker
+from docker.errors import ContainerError, NotFound
 from docker.types import LogConfig
 
 from modules.git_client import GatewayGitClient
@@ -14,11 +17,36 @@ from utils.paths import CONTROLLER_GIT_PATH, GATEWAY_DATA_PATH, CONTROLLER_LOGS_
 
 CONTROLLER_CONTAINER_NAME = "acropolis_edge_controller"
 CONTROLLER_IMAGE_PREFIX = "teg-controller-"
+# label of the controller images built by the gateway, only these are pruned
+CONTROLLER_IMAGE_LABEL = "acropolis.controller"
+# the cached controller container state is reconciled with the docker daemon in this interval,
+# in case container events were missed
+CONTAINER_STATE_RECONCILE_INTERVAL_SECONDS = 60
+CONTAINER_EVENTS = ["start", "restart", "die", "stop", "kill", "destroy"]
+# a new controller has to be running this long after an update, otherwise the previous version is started
+CONTROLLER_SWAP_CHECK_SECONDS = 30
+# controller images are evicted least recently used first once they take more disk space than the budget,
+# the images of the running version and the previous versions kept for rollbacks are never evicted
+CONTROLLER_IMAGES_MAX_BYTES = int(os.environ.get("ACROPOLIS_CONTROLLER_IMAGES_MAX_BYTES") or 4_000_000_000)
+CONTROLLER_IMAGES_KEEP_PREVIOUS = int(os.environ.get("ACROPOLIS_CONTROLLER_IMAGES_KEEP_PREVIOUS") or 2)
+# version -> timestamp (ms) of the last time the image was started
+CONTROLLER_IMAGE_USAGE_PATH = os.path.join(GATEWAY_DATA_PATH, "controller_image_usage.json")
 
 singleton_instance : Optional["GatewayDockerClient"] = None
 
 class GatewayDockerClient:
+    """The state of the controller container is cached and kept up to date by a thread listening to
+    the docker events of the container, so the accessors don't call the docker daemon."""
     last_launched_version = None
+    # `attrs` of the running controller container, None if it is not running
+    controller_container_attrs: Optional[dict] = None
+    controller_state_reconcile_ts: Optional[float] = None
+    # serializes stopping and starting the controller container
+    controller_lock = threading.RLock()
+    # background update, see `start_controller_in_background`
+    ota_lock = threading.Lock()
+    ota_thread: Optional[threading.Thread] = None
+    ota_target_version: Optional[str] = None
 
     def __init__(self) -> None:
         global singleton_instance
@@ -28,6 +56,8 @@ class GatewayDockerClient:
             singleton_instance = self
             try:
                 self.docker_client = docker.from_env()
+                self.refresh_controller_state()
+                threading.Thread(target=self.__watch_controller_events, daemon=True).start()
             except Exception as e:
                 error("[DOCKER-CLIENT] Failed to initialize GatewayDockerClient: {}".format(e))
 
@@ -59,12 +89,124 @@ class GatewayDockerClient:
         except Exception as e:
             error("[DOCKER-CLIENT] Failed to write last launched controller version: {}".format(e))
 
+    def refresh_controller_state(self) -> None:
+        """Reads the state of the controller container from the docker daemon"""
+        try:
+            attrs = self.docker_client.containers.get(CONTROLLER_CONTAINER_NAME).attrs
+        except NotFound:
+            attrs = None
+        self.controller_container_attrs = attrs if attrs is not None and attrs["State"]["Running"] else None
+        self.controller_state_reconcile_ts = monotonic()
+
+    def __watch_controller_events(self) -> None:
+        while True:
+            try:
+                for event in self.docker_client.events(decode=True, filters={
+                    "type": "container",
+                    "container": CONTROLLER_CONTAINER_NAME,
+                    "event": CONTAINER_EVENTS,
+                }):
+                    debug(f"[DOCKER-CLIENT] Controller container event: {event.get('Action')}")
+                    self.refresh_controller_state()
+            except Exception as e:
+                warn(f"[DOCKER-CLIENT] Docker event stream failed, resubscribing in 10s: {e}")
+                sleep(10)
+                # events may have been missed while not subscribed
+                self.controller_state_reconcile_ts = None
+
+    def __get_controller_container_attrs(self) -> Optional[dict]:
+        if self.controller_state_reconcile_ts is None \
+                or monotonic() - self.controller_state_reconcile_ts > CONTAINER_STATE_RECONCILE_INTERVAL_SECONDS:
+            self.refresh_controller_state()
+        return self.controller_container_attrs
+
     def is_controller_running(self) -> bool:
-        containers = self.docker_client.containers.list()
-        for container in containers:
-            if container.name == CONTROLLER_CONTAINER_NAME:
-                return container.attrs["State"]["Running"]
-        return False
+        return self.__get_controller_container_attrs() is not None
+
+    def get_controller_image_tags(self) -> list[str]:
+        return [tag for image in self.docker_client.images.list() for tag in image.tags
+                if tag.startswith(CONTROLLER_IMAGE_PREFIX)]
+
+    def __read_image_usage(self) -> dict[str, int]:
+        try:
+            with open(CONTROLLER_IMAGE_USAGE_PATH, "r") as file:
+                usage = json.load(file)
+                return usage if isinstance(usage, dict) else {}
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def __write_image_usage(self, usage: dict[str, int]) -> None:
+        try:
+            with open(CONTROLLER_IMAGE_USAGE_PATH + ".tmp", "w") as file:
+                json.dump(usage, file)
+            os.replace(CONTROLLER_IMAGE_USAGE_PATH + ".tmp", CONTROLLER_IMAGE_USAGE_PATH)
+        except Exception as e:
+            error("[DOCKER-CLIENT] Failed to write controller image usage: {}".format(e))
+
+    def mark_image_used(self, version: str) -> None:
+        usage = self.__read_image_usage()
+        usage[version] = int(datetime.datetime.now().timestamp() * 1000)
+        self.__write_image_usage(usage)
+
+    def get_cached_controller_versions(self) -> dict[str, Any]:
+        """Versions with an image, mapped to the image"""
+        images: dict[str, Any] = {}
+        for image in self.docker_client.images.list():
+            for tag in image.tags:
+                if tag.startswith(CONTROLLER_IMAGE_PREFIX) and tag.endswith(":latest"):
+                    images[tag[len(CONTROLLER_IMAGE_PREFIX):-len(":latest")]] = image
+        return images
+
+    def get_previous_controller_versions(self) -> list[str]:
+        """Versions with an image that were started before the running one, most recently used first"""
+        usage = self.__read_image_usage()
+        running_version = self.get_controller_version()
+        return sorted([version for version in self.get_cached_controller_versions()
+                       if version != running_version and version in usage],
+                      key=lambda version: usage[version], reverse=True)
+
+    def evict_controller_images(self) -> None:
+        """Removes the least recently used controller images until they fit into the disk budget, keeps
+        the running version and the previous `CONTROLLER_IMAGES_KEEP_PREVIOUS` versions"""
+        usage = self.__read_image_usage()
+        images = self.get_cached_controller_versions()
+        running_version = self.get_controller_version()
+        protected = {running_version, self.ota_target_version}
+        protected.update(self.get_previous_controller_versions()[:CONTROLLER_IMAGES_KEEP_PREVIOUS])
+
+        # layers shared between the images are counted for each of them
+        total_bytes = sum(image.attrs.get("Size", 0) for image in images.values())
+        removed = []
+        for version in sorted(images, key=lambda version: usage.get(version, 0)):
+            if total_bytes <= CONTROLLER_IMAGES_MAX_BYTES:
+                break
+            if version in protected:
+                continue
+            try:
+                self.docker_client.images.remove(CONTROLLER_IMAGE_PREFIX + version + ":latest")
+            except Exception as e:
+                warn("[DOCKER-CLIENT] Failed to remove image of version '" + version + "': {}".format(e))
+                continue
+            total_bytes -= images[version].attrs.get("Size", 0)
+            usage.pop(version, None)
+            removed.append(version)
+
+        if len(removed) > 0:
+            # removing an image frees its own untagged layers. Only controller images that lost their tag to a
+            # rebuild are pruned, the intermediate build layers stay available as cache for the next update.
+            self.docker_client.images.prune(filters={"dangling": True, "label": CONTROLLER_IMAGE_LABEL})
+            self.__write_image_usage(usage)
+            info("[DOCKER-CLIENT] Evicted images of versions " + ", ".join(removed)
+                 + f", {total_bytes // 1_000_000}MB of controller images remaining")
+
+    def rollback_controller(self) -> Optional[str]:
+        """Restarts the most recently used previous version from its cached image, without rebuilding.
+        Returns the version or None if no previous image is cached."""
+        previous_versions = self.get_previous_controller_versions()
+        if len(previous_versions) == 0:
+            return None
+        self.start_controller_in_background(previous_versions[0])
+        return previous_versions[0]
 
     def is_image_available(self, image_tag: str) -> bool:
         for image in self.docker_client.images.list():
@@ -73,42 +215,47 @@ class GatewayDockerClient:
         return False
 
     def get_controller_version(self) -> Optional[str]:
-        if self.is_controller_running():
-            containers = self.docker_client.containers.list()
-            for container in containers:
-                if container.name == CONTROLLER_CONTAINER_NAME:
-                    version = container.attrs["Config"]["Image"].split("-")[-1]
-                    if version.__len__() > 0 and (version[0] == "v"
-                                                  or version.__len__() == 40):
-                        if version.endswith(":latest"):
-                            version = version[:-7]
-                        return version
+        attrs = self.__get_controller_container_attrs()
+        if attrs is not None:
+            version = attrs["Config"]["Image"].split("-")[-1]
+            if version.__len__() > 0 and (version[0] == "v"
+                                          or version.__len__() == 40):
+                if version.endswith(":latest"):
+                    version = version[:-7]
+                return version
         return None
 
     def get_edge_startup_timestamp_ms(self) -> Optional[int]:
-        if self.is_controller_running():
-            containers = self.docker_client.containers.list()
-            for container in containers:
-                if container.name == CONTROLLER_CONTAINER_NAME:
-                    return int(
-                        datetime.datetime.strptime(container.attrs["State"]["StartedAt"][:-4], "%Y-%m-%dT%H:%M:%S.%f" )
-                        .replace(tzinfo=datetime.timezone.utc)
-                        .timestamp() * 1000
-                    )
+        attrs = self.__get_controller_container_attrs()
+        if attrs is not None:
+            return int(
+                datetime.datetime.strptime(attrs["State"]["StartedAt"][:-4], "%Y-%m-%dT%H:%M:%S.%f" )
+                .replace(tzinfo=datetime.timezone.utc)
+                .timestamp() * 1000
+            )
         return None
 
     def stop_controller(self) -> None:
-        if self.is_controller_running():
-            containers = self.docker_client.containers.list()
-            for container in containers:
-                if container.name == CONTROLLER_CONTAINER_NAME:
-                    running_controller_version = self.get_controller_version()
-                    if running_controller_version is not None:
-                        self.set_last_launched_controller_version(running_controller_version)
-                    container.stop(timeout=60)
-                    info("[DOCKER-CLIENT] Stopped Controller container")
-        else:
-            info("[DOCKER-CLIENT] Controller container is not running")
+        with self.controller_lock:
+            if self.is_controller_running():
+                running_controller_version = self.get_controller_version()
+                if running_controller_version is not None:
+                    self.set_last_launched_controller_version(running_controller_version)
+                self.docker_client.containers.get(CONTROLLER_CONTAINER_NAME).stop(timeout=60)
+                self.refresh_controller_state()
+                info("[DOCKER-CLIENT] Stopped Controller container")
+            else:
+                info("[DOCKER-CLIENT] Controller container is not running")
+
+    def remove_controller_container(self) -> None:
+        """Removes the controller container, also if it is restarting after a failure"""
+        with self.controller_lock:
+            try:
+                self.docker_client.containers.get(CONTROLLER_CONTAINER_NAME).remove(force=True)
+                info("[DOCKER-CLIENT] Removed controller container")
+            except NotFound:
+                pass
+            self.refresh_controller_state()
 
     def prune_containers(self) -> None:
         self.docker_client.containers.prune()
@@ -119,50 +266,157 @@ class GatewayDockerClient:
             self.start_controller(version_to_launch)
         except Exception as e:
             warn("[DOCKER-CLIENT] Failed to start controller: {}".format(e))
+            GatewayMqttClient().publish_sw_state(version_to_launch, "FAILED", str(e))
+
+    def start_controller_in_background(self, version_to_launch: str) -> None:
+        """Stages and starts the version in a background thread while the current controller keeps running.
+        If another version is requested meanwhile, it is started once the current update is done."""
+        with self.ota_lock:
+            self.ota_target_version = version_to_launch
+            if self.ota_thread is not None:
+                info("[DOCKER-CLIENT] Update in progress, version '" + version_to_launch + "' is started afterwards")
+                return
+            self.ota_thread = threading.Thread(target=self.__run_ota, daemon=True)
+            self.ota_thread.start()
+
+    def is_update_in_progress(self) -> bool:
+        with self.ota_lock:
+            return self.ota_thread is not None
+
+    def __run_ota(self) -> None:
+        while True:
+            with self.ota_lock:
+                version_to_launch = self.ota_target_version
+            if version_to_launch is not None:
+                self.start_controller_safely(version_to_launch)
+            with self.ota_lock:
+                if self.ota_target_version == version_to_launch:
+                    self.ota_thread = None
+                    return
 
     def start_controller(self, version_to_launch: str) -> None:
-        if self.is_controller_running():
-            running_controller_version = self.get_controller_version()
-            if running_controller_version != version_to_launch:
-                self.stop_controller()
-                self.start_controller(version_to_launch)
-            else:
-                info("[DOCKER-CLIENT] Software already running with version " + version_to_launch)
-                self.set_last_launched_controller_version(running_controller_version)
+        if self.get_controller_version() == version_to_launch:
+            info("[DOCKER-CLIENT] Software already running with version " + version_to_launch)
+            self.set_last_launched_controller_version(version_to_launch)
+            return
+
+        # blue/green: the running controller keeps measuring until the new image is built and verified
+        if not self.stage_controller_image(version_to_launch):
             return
+        self.swap_controller(version_to_launch)
 
+    def stage_controller_image(self, version_to_launch: str) -> bool:
+        """Builds and verifies the image of the version if it is not cached yet"""
         image_tag : str = CONTROLLER_IMAGE_PREFIX + version_to_launch + ":latest"
 
-        # edge container is not running
-        # check if the image is available already, if not build it
-        if not self.is_image_available(image_tag):
-            error("[DOCKER-CLIENT] Image '" + image_tag + "' not available")
-            info("[DOCKER-CLIENT] Building image for version '" + version_to_launch + "'")
-            GatewayMqttClient().publish_sw_state(version_to_launch, "DOWNLOADING")
-            GatewayGitClient().execute_fetch()
-            commit_hash = GatewayGitClient().get_commit_from_hash_or_tag(version_to_launch)
-            if commit_hash is None:
-                error("[DOCKER-CLIENT] Unable to get commit hash for version '" + version_to_launch + "'")
-                return
-            info("[DOCKER-CLIENT] Building image for commit " + commit_hash)
+        # cached images were verified when they were built, so a rollback only swaps the container
+        if self.is_image_available(image_tag):
+            info("[DOCKER-CLIENT] Using cached image '" + image_tag + "'")
+            return True
 
-            if GatewayGitClient().execute_reset_to_commit(commit_hash) \
-                and GatewayGitClient().get_current_commit() == commit_hash:
-                info("[DOCKER-CLIENT] Successfully reset to commit " + commit_hash)
-            else:
-                error("[DOCKER-CLIENT] Unable to reset to commit " + commit_hash)
-                return
-            GatewayMqttClient().publish_sw_state(version_to_launch, "DOWNLOADED")
+        error("[DOCKER-CLIENT] Image '" + image_tag + "' not available")
+        info("[DOCKER-CLIENT] Building image for version '" + version_to_launch + "'")
+        GatewayMqttClient().publish_sw_state(version_to_launch, "DOWNLOADING")
+        fetch_start = monotonic()
+        if not GatewayGitClient().execute_fetch(version_to_launch):
+            error("[DOCKER-CLIENT] Unable to fetch version '" + version_to_launch + "'")
+            GatewayMqttClient().publish_sw_state(version_to_launch, "FAILED", "Unable to fetch version")
+            return False
+        fetch_duration_ms = int((monotonic() - fetch_start) * 1000)
+        commit_hash = GatewayGitClient().get_commit_from_hash_or_tag(version_to_launch)
+        if commit_hash is None:
+            error("[DOCKER-CLIENT] Unable to get commit hash for version '" + version_to_launch + "'")
+            GatewayMqttClient().publish_sw_state(version_to_launch, "FAILED", "Unknown version")
+            return False
+        info("[DOCKER-CLIENT] Building image for commit " + commit_hash)
+
+        if GatewayGitClient().execute_reset_to_commit(commit_hash):
+            info("[DOCKER-CLIENT] Successfully reset to commit " + commit_hash)
+        else:
+            error("[DOCKER-CLIENT] Unable to reset to commit " + commit_hash)
+            GatewayMqttClient().publish_sw_state(version_to_launch, "FAILED", "Unable to check out " + commit_hash)
+            return False
+        GatewayMqttClient().publish_sw_state(version_to_launch, "DOWNLOADED")
+        # an image that failed to build or verify must not be tagged, the cache treats tagged images as verified
+        try:
+            build_start = monotonic()
             self.docker_client.images.build(
                 path=CONTROLLER_PROJECT_PATH,
                 dockerfile="./docker/Dockerfile",
-                tag=CONTROLLER_IMAGE_PREFIX + version_to_launch + ":latest"
+                tag=CONTROLLER_IMAGE_PREFIX + version_to_launch + ":latest",
+                labels={CONTROLLER_IMAGE_LABEL: version_to_launch},
+                # reuse the layers of previous versions, e.g. the dependencies if poetry.lock did not change
+                cache_from=self.get_controller_image_tags(),
             )
-            info("[DOCKER-CLIENT] Built image for commit " + commit_hash + " with tag " + CONTROLLER_IMAGE_PREFIX + version_to_launch)
+            build_duration_ms = int((monotonic() - build_start) * 1000)
+            info("[DOCKER-CLIENT] Built image for commit " + commit_hash + " with tag " + CONTROLLER_IMAGE_PREFIX + version_to_launch
+                 + f" (fetch: {fetch_duration_ms}ms, build: {build_duration_ms}ms)")
+            GatewayMqttClient().publish_telemetry(json.dumps({
+                "ota_version": version_to_launch,
+                "ota_fetch_duration_ms": fetch_duration_ms,
+                "ota_build_duration_ms": build_duration_ms,
+            }))
 
-        GatewayMqttClient().publish_sw_state(version_to_launch, "UPDATING")
+            # the sources of the image must compile with its python environment, no hardware is accessed
+            GatewayMqttClient().publish_sw_state(version_to_launch, "VERIFYING")
+            self.docker_client.containers.run(
+                image_tag,
+                entrypoint=["/root/.venv/bin/python3", "-m", "compileall", "-q", "/root/src"],
+                network_disabled=True,
+                remove=True,
+            )
+        except Exception as e:
+            reason = "Verification failed" if isinstance(e, ContainerError) else "Build failed"
+            error("[DOCKER-CLIENT] " + reason + " for image '" + image_tag + "': {}".format(e))
+            GatewayMqttClient().publish_sw_state(version_to_launch, "FAILED", reason)
+            try:
+                self.docker_client.images.remove(image_tag, force=True)
+            except NotFound:
+                pass
+            except Exception as remove_error:
+                warn("[DOCKER-CLIENT] Failed to remove image '" + image_tag + "': {}".format(remove_error))
+            return False
+        GatewayMqttClient().publish_sw_state(version_to_launch, "VERIFIED")
+        info("[DOCKER-CLIENT] Verified image '" + image_tag + "'")
+        return True
+
+    def swap_controller(self, version_to_launch: str) -> bool:
+        """Replaces the running controller with the staged version, rolls back if it does not keep running"""
+        with self.controller_lock:
+            previous_version = self.get_controller_version()
+            if previous_version == version_to_launch:
+                return True  # swapped by a concurrent update
+            GatewayMqttClient().publish_sw_state(version_to_launch, "UPDATING")
+            if previous_version is not None:
+                self.stop_controller()
+            self.__run_controller_container(version_to_launch)
+
+        # the lock is not held while waiting, the main loop stops and starts the controller synchronously
+        sleep(CONTROLLER_SWAP_CHECK_SECONDS)
+        with self.controller_lock:
+            self.refresh_controller_state()
+            if not self.is_controller_running() or self.get_controller_version() != version_to_launch:
+                error("[DOCKER-CLIENT] Controller version '" + version_to_launch + "' stopped after the update")
+                GatewayMqttClient().publish_sw_state(version_to_launch, "FAILED", "Controller stopped after the update")
+                if previous_version is not None:
+                    info("[DOCKER-CLIENT] Rolling back to version '" + previous_version + "'")
+                    self.remove_controller_container()
+                    self.__run_controller_container(previous_version)
+                return False
+
+        GatewayMqttClient().publish_sw_state(version_to_launch, "UPDATED")
+        info("[DOCKER-CLIENT] Started container with version '" + version_to_launch + "'")
+        try:
+            self.evict_controller_images()
+        except Exception as e:
+            warn("[DOCKER-CLIENT] Failed to evict controller images: {}".format(e))
+        return True
+
+    def __run_controller_container(self, version_to_launch: str) -> None:
+        image_tag : str = CONTROLLER_IMAGE_PREFIX + version_to_launch + ":latest"
         # remove old containers and start the new one
         self.prune_containers()
+        self.mark_image_used(version_to_launch)
         self.docker_client.containers.run(
             image_tag,
             detach=True,
@@ -201,6 +455,4 @@ class GatewayDockerClient:
             }
         )
         self.set_last_launched_controller_version(version_to_launch)
-
-        GatewayMqttClient().publish_sw_state(version_to_launch, "UPDATED")
-        info("[DOCKER-CLIENT] Started container with version '" + version_to_launch + "'")
\ No newline at end of file
+        self.refresh_controller_state()
\ No newline at end of file
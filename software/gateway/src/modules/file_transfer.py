@@ -0,0 +1,106 @@
+import json
+import os
+import shutil
+from hashlib import md5
+from typing import Any, Optional
+
+from modules.file_writer import GatewayFileWriter, write_file_atomically
+from modules.logging import info, error, warn
+from modules.mqtt import GatewayMqttClient
+from utils.file_delta import apply_delta
+from utils.misc import get_maybe
+from utils.paths import FILE_TRANSFERS_PATH
+
+FILE_TRANSFER_PREFIX = "FILE_TRANSFER_"
+# marks the parts of a chunked transfer, so the content of JSON files is never mistaken for one
+FILE_TRANSFER_FORMAT = "acropolis-file-transfer-v1"
+TRANSFER_KEYS = ["transfer_id", "part", "parts", "hash", "block_size", "ops"]
+
+
+def is_file_transfer_part(file_content: Any) -> bool:
+    """A FILE_CONTENT_ value is either the whole content or one part of a chunked transfer:
+    {"format": FILE_TRANSFER_FORMAT, "transfer_id": ..., "part": n, "parts": N, "hash": md5 of the file,
+    "base_hash": md5 of the file the delta is based on, "block_size": ...,
+    "ops": [["copy", first block, blocks] | ["data", base64], ...]}"""
+    return (isinstance(file_content, dict) and file_content.get("format") == FILE_TRANSFER_FORMAT
+            and all(key in file_content for key in TRANSFER_KEYS))
+
+
+def _publish_transfer_state(file_id: str, transfer_id: str, state: str, missing_parts: list[int],
+                            msg: Optional[str] = None) -> None:
+    GatewayMqttClient().publish_message_raw("v1/devices/me/attributes", json.dumps({
+        FILE_TRANSFER_PREFIX + file_id: {
+            "transfer_id": transfer_id,
+            "state": state,
+            "missing_parts": missing_parts,
+            "error": msg or "",
+        }
+    }))
+
+
+def receive_file_transfer_part(file_id: str, file_path: str, part: dict) -> bool:
+    """Stages a part of a chunked transfer on disk, so transfers resume after a restart, and reports
+    the missing parts as `FILE_TRANSFER_<id>`. Once all parts are received, the delta is applied to the
+    current file and the result replaces it atomically. Returns True if the file was written."""
+    transfer_id = str(part["transfer_id"])
+    staging_path = os.path.join(FILE_TRANSFERS_PATH, file_id)
+    manifest_path = os.path.join(staging_path, "transfer.json")
+    manifest = {key: part.get(key) for key in ["transfer_id", "parts", "hash", "base_hash", "block_size"]}
+    manifest["transfer_id"] = transfer_id
+
+    # a new transfer replaces an unfinished one
+    try:
+        with open(manifest_path, "r") as f:
+            staged_manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        staged_manifest = None
+    if staged_manifest != manifest:
+        if staged_manifest is not None:
+            warn(f"[FILE-TRANSFER] Discarding unfinished transfer {get_maybe(staged_manifest, 'transfer_id')} of {file_id}")
+        shutil.rmtree(staging_path, ignore_errors=True)
+        os.makedirs(staging_path)
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+
+    parts = int(part["parts"])
+    ops = json.dumps(part["ops"]).encode()
+    write_file_atomically(os.path.join(staging_path, f"part_{int(part['part'])}.json"), lambda f: f.write(ops))
+    missing_parts = [n for n in range(parts) if not os.path.exists(os.path.join(staging_path, f"part_{n}.json"))]
+    if len(missing_parts) > 0:
+        info(f"[FILE-TRANSFER] Received part {part['part']} of {parts} of {file_id}, {len(missing_parts)} missing")
+        _publish_transfer_state(file_id, transfer_id, "RECEIVING", missing_parts)
+        return False
+
+    # the delta was computed against the signature of the current file
+    base_hash = part.get("base_hash")
+    if base_hash not in [None, ""] and GatewayFileWriter().calc_file_hash(file_path) != base_hash:
+        error(f"[FILE-TRANSFER] File {file_path} changed during transfer {transfer_id}")
+        shutil.rmtree(staging_path, ignore_errors=True)
+        _publish_transfer_state(file_id, transfer_id, "FAILED", [], "base file changed")
+        return False
+
+    def write(target) -> None:
+        with open(file_path if os.path.exists(file_path) else os.devnull, "rb") as base:
+            for n in range(parts):
+                with open(os.path.join(staging_path, f"part_{n}.json"), "r") as f:
+                    apply_delta(base, json.load(f), int(part["block_size"]), target)
+        target.flush()
+        target.seek(0)
+        file_hash = md5()
+        while chunk := target.read(1024 * 1024):
+            file_hash.update(chunk)
+        if file_hash.hexdigest() != part["hash"]:
+            raise ValueError(f"hash mismatch, expected {part['hash']}, got {file_hash.hexdigest()}")
+
+    try:
+        write_file_atomically(file_path, write)
+    except Exception as e:
+        error(f"[FILE-TRANSFER] Failed to assemble transfer {transfer_id} of {file_id}: {e}")
+        shutil.rmtree(staging_path, ignore_errors=True)
+        _publish_transfer_state(file_id, transfer_id, "FAILED", [], str(e))
+        return False
+
+    shutil.rmtree(staging_path, ignore_errors=True)
+    info(f"[FILE-TRANSFER] Wrote {file_path} from transfer {transfer_id}")
+    _publish_transfer_state(file_id, transfer_id, "COMPLETE", [])
+    return True
@@ -1,22 +1,101 @@
 import json
+import os
 from hashlib import md5
 from typing import Optional, Any
 
 from modules.mqtt import GatewayMqttClient
 from modules.logging import debug, info, error
+from utils.file_delta import block_signatures, get_block_size
+from utils.file_watcher import FileWatcher
+from utils.misc import get_maybe
 from utils.paths import CONTROLLER_DATA_PATH
 
+# files are hashed in chunks of this size, so they don't have to fit into memory
+HASH_CHUNK_SIZE = 1024 * 1024
+# FILE_READ_ attributes longer than this are sent in chunks, only changed chunks are sent again
+FILE_READ_CHUNK_SIZE = 32_000
+
+# file id -> hashes of the FILE_READ_ chunks published last
+published_file_read_chunks: dict[str, list[str]] = {}
+
 singleton_instance : Optional["GatewayFileWriter"] = None
 
 
+def _stat_key(stat: os.stat_result) -> tuple[int, int, int]:
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
 def write_file_content_to_client_attribute(file_identifier: str, file_content: str) -> None:
-    GatewayMqttClient().publish_message_raw("v1/devices/me/attributes", json.dumps({("FILE_READ_" + file_identifier): file_content}))
+    """Publishes the (encoded) file content as `FILE_READ_<id>`. Long contents are split into
+    `FILE_READ_<id>_<n>` chunk attributes and `FILE_READ_<id>` holds the manifest
+    {"chunks": ..., "chunk_size": ..., "hashes": [...], "hash": ...} to reassemble them."""
+    previous_chunk_hashes = published_file_read_chunks.pop(file_identifier, [])
+    attributes: dict[str, Any] = {}
+    if len(file_content) <= FILE_READ_CHUNK_SIZE:
+        attributes["FILE_READ_" + file_identifier] = file_content
+        chunk_hashes = []
+    else:
+        chunks = [file_content[i:i + FILE_READ_CHUNK_SIZE] for i in range(0, len(file_content), FILE_READ_CHUNK_SIZE)]
+        chunk_hashes = [md5(chunk.encode()).hexdigest() for chunk in chunks]
+        for index, chunk in enumerate(chunks):
+            if index >= len(previous_chunk_hashes) or previous_chunk_hashes[index] != chunk_hashes[index]:
+                if not GatewayMqttClient().publish_message_raw("v1/devices/me/attributes", json.dumps({
+                    f"FILE_READ_{file_identifier}_{index}": chunk
+                })):
+                    return  # all chunks are sent again next time
+        attributes["FILE_READ_" + file_identifier] = {
+            "chunks": len(chunks),
+            "chunk_size": FILE_READ_CHUNK_SIZE,
+            "hashes": chunk_hashes,
+            "hash": md5(file_content.encode()).hexdigest(),
+        }
+    # clear chunks of a previous, longer content
+    for index in range(len(chunk_hashes), len(previous_chunk_hashes)):
+        attributes[f"FILE_READ_{file_identifier}_{index}"] = ""
+    if GatewayMqttClient().publish_message_raw("v1/devices/me/attributes", json.dumps(attributes)) and len(chunk_hashes) > 0:
+        published_file_read_chunks[file_identifier] = chunk_hashes
+
+
+def publish_file_signature(file_identifier: str, file_path: str) -> None:
+    """Publishes the block signatures of the file as `FILE_SIGNATURE_<id>`, used by the sender of a
+    FILE_CONTENT_ transfer to only send the blocks which changed"""
+    try:
+        with open(file_path, "rb") as f:
+            content = f.read()
+    except FileNotFoundError:
+        content = b""
+    block_size = get_block_size(len(content))
+    GatewayMqttClient().publish_message_raw("v1/devices/me/attributes", json.dumps({
+        "FILE_SIGNATURE_" + file_identifier: {
+            "hash": md5(content).hexdigest(),
+            "block_size": block_size,
+            "blocks": block_signatures(content, block_size),
+        }
+    }))
+
+
+def write_file_atomically(file_path: str, write) -> None:
+    """Calls `write` with a temporary file next to `file_path` and replaces the file with it once written,
+    so readers never see a partially written file"""
+    temporary_path = file_path + ".tmp"
+    try:
+        with open(temporary_path, "w+b") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, file_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
 
 
 class GatewayFileWriter:
     files: Optional[dict] = None
     hashes: dict[str, str] = {}
     tb_hashes: Optional[dict] = None
+    # path -> ((st_mtime_ns, st_size, st_ino), hash), files are only read again if their stat changed
+    hash_cache: dict[str, tuple[tuple[int, int, int], str]] = {}
+    watcher: Optional[FileWatcher] = None
 
     def __init__(self) -> None:
         global singleton_instance
@@ -43,6 +122,21 @@ class GatewayFileWriter:
 
     def set_files(self, files: dict) -> None:
         self.files = files
+        if self.watcher is not None:
+            self.watcher.refresh()
+
+    def get_file_paths(self) -> set[str]:
+        file_paths = set()
+        for file_id in self.files or {}:
+            file_path = self.expand_file_path(get_maybe(self.files, file_id, "path"))
+            if file_path is not None:
+                file_paths.add(os.path.abspath(file_path))
+        return file_paths
+
+    def start_watching(self, on_change) -> None:
+        """Calls `on_change` from a daemon thread when a defined file changes on disk"""
+        self.watcher = FileWatcher(self.get_file_paths, on_change)
+        self.watcher.start()
 
     def set_tb_hashes(self, hashes: dict) -> None:
         self.tb_hashes = hashes
@@ -51,13 +145,15 @@ class GatewayFileWriter:
     def read_file_raw(self, file_path: str) -> bytes | None:
         try:
             with open(file_path, "rb") as f:
+                stat = os.fstat(f.fileno())
                 file_content = f.read()
-                file_hash = md5(file_content).hexdigest()
-                if file_path not in self.hashes:
-                    self.hashes[file_path] = file_hash
-                return file_content
         except FileNotFoundError:
             return None
+        file_hash = md5(file_content).hexdigest()
+        self.hash_cache[file_path] = (_stat_key(stat), file_hash)
+        if file_path not in self.hashes:
+            self.hashes[file_path] = file_hash
+        return file_content
 
     # Read file contents into string
     def read_file(self, file_path: str, file_encoding: str) -> str | None:
@@ -75,10 +171,20 @@ class GatewayFileWriter:
             return file_content.decode("utf-8")
 
     def calc_file_hash(self, path: str) -> str:
-        file_content = self.read_file_raw(path)
-        if file_content is None:
+        try:
+            with open(path, "rb") as f:
+                stat_key = _stat_key(os.fstat(f.fileno()))
+                cached = self.hash_cache.get(path)
+                if cached is not None and cached[0] == stat_key:
+                    return cached[1]
+                file_hash = md5()
+                while chunk := f.read(HASH_CHUNK_SIZE):
+                    file_hash.update(chunk)
+        except FileNotFoundError:
+            self.hash_cache.pop(path, None)
             return "E_NOFILE"
-        return md5(file_content).hexdigest()
+        self.hash_cache[path] = (stat_key, file_hash.hexdigest())
+        return file_hash.hexdigest()
 
     def did_file_change(self, path: str) -> bool:
         file_hash = self.calc_file_hash(path)
@@ -1,5 +1,6 @@
+import re
 import subprocess
-from modules.logging import debug, error
+from modules.logging import debug, error, warn
 from os.path import dirname
 from typing import Optional, Any
 
@@ -22,48 +23,64 @@ class GatewayGitClient:
             return singleton_instance
         return super(GatewayGitClient, cls).__new__(cls)
 
-    def get_commit_from_hash_or_tag(self, hash_or_tag: str) -> Optional[str]:
-        commit_for_tag = self.get_commit_for_tag(hash_or_tag)
-        if commit_for_tag is not None:
-            return commit_for_tag
-        elif self.verify_commit_hash_or_tag_exists(hash_or_tag):
-            return hash_or_tag
-        else:
-            return None
+    @staticmethod
+    def _is_commit_hash(hash_or_tag: str) -> bool:
+        return re.fullmatch(r"[0-9a-f]{40}", hash_or_tag) is not None
 
-    def get_current_commit(self) -> Optional[str]:
+    def _is_shallow_repository(self) -> bool:
         try:
-            return subprocess.check_output(["git", "rev-parse", "HEAD"], encoding='utf-8', cwd=dirname(CONTROLLER_GIT_PATH)).strip()
+            return subprocess.check_output(["git", "rev-parse", "--is-shallow-repository"],
+                                           encoding='utf-8', cwd=dirname(CONTROLLER_GIT_PATH)).strip() == "true"
         except subprocess.CalledProcessError as e:
-            error(f"[GIT-CLIENT] Unable to determine current commit hash: : {e} {e.stderr} {e.stdout}")
-            return None
+            error(f"[GIT-CLIENT] Unable to determine if the repository is shallow: {e} {e.stderr} {e.stdout}")
+            return False
 
-    def get_commit_for_tag(self, tag) -> Optional[str]:
+    def get_commit_from_hash_or_tag(self, hash_or_tag: str) -> Optional[str]:
+        """Resolves a tag or full commit hash to the commit hash with a single git process.
+        Branches and abbreviated hashes are not resolved, they can point to different commits over time."""
+        ref = hash_or_tag if self._is_commit_hash(hash_or_tag) else f"refs/tags/{hash_or_tag}"
         try:
-            return subprocess.check_output(["git", "rev-list", "-n 1", "tags/" + tag], encoding='utf-8', cwd=dirname(CONTROLLER_GIT_PATH)).strip()
+            return subprocess.check_output(["git", "rev-parse", "--verify", "--quiet", ref + "^{commit}"],
+                                           encoding='utf-8', cwd=dirname(CONTROLLER_GIT_PATH)).strip()
         except subprocess.CalledProcessError as e:
-            error(f"[GIT-CLIENT] Unable to find commit hash for tag '{tag}': {e} {e.stderr} {e.stdout}")
+            debug(f"[GIT-CLIENT] Unable to find commit for '{hash_or_tag}': {e}")
             return None
 
-    def verify_commit_hash_or_tag_exists(self, commit_hash: str) -> bool:
+    def get_current_commit(self) -> Optional[str]:
         try:
-            return (subprocess.check_output(["git", "cat-file", "-t", commit_hash], cwd=dirname(CONTROLLER_GIT_PATH))
-                    .strip() == b'commit')
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], encoding='utf-8', cwd=dirname(CONTROLLER_GIT_PATH)).strip()
         except subprocess.CalledProcessError as e:
-            error(f"[GIT-CLIENT] Unable to verify commit hash: {e} {e.stderr} {e.stdout}")
-            return False
+            error(f"[GIT-CLIENT] Unable to determine current commit hash: : {e} {e.stderr} {e.stdout}")
+            return None
 
     def execute_reset_to_commit(self, commit_hash: str) -> bool:
+        # a forced checkout resets the index and the working tree, only untracked files are left to clean
         try:
-            if subprocess.run(["git", "checkout", "-f", commit_hash], cwd=dirname(CONTROLLER_GIT_PATH)).returncode == 0\
-                and subprocess.run(["git", "reset", "HEAD", "--hard"], cwd=dirname(CONTROLLER_GIT_PATH)).returncode == 0\
-                and subprocess.run(["git", "clean", "-f", "-d"], cwd=dirname(CONTROLLER_GIT_PATH)).returncode == 0:
+            if subprocess.run(["git", "checkout", "-f", "--detach", commit_hash], cwd=dirname(CONTROLLER_GIT_PATH)).returncode == 0\
+                and subprocess.run(["git", "clean", "-f", "-d", "-q"], cwd=dirname(CONTROLLER_GIT_PATH)).returncode == 0:
                 return True
         except subprocess.CalledProcessError as e:
             error(f"[GIT-CLIENT] Unable to reset to commit hash: {e} {e.stderr} {e.stdout}")
         return False
 
-    def execute_fetch(self) -> bool:
+    def execute_fetch(self, hash_or_tag: Optional[str] = None) -> bool:
+        """Fetches only the given tag or commit, falls back to fetching everything. The history of the
+        commit is only left out if the repository is already shallow, a full clone is kept complete."""
+        if hash_or_tag is not None:
+            if self.get_commit_from_hash_or_tag(hash_or_tag) is not None:
+                return True  # already available locally
+            if self._is_commit_hash(hash_or_tag):
+                refspec = hash_or_tag
+            else:
+                refspec = f"refs/tags/{hash_or_tag}:refs/tags/{hash_or_tag}"
+            depth = ["--depth", "1"] if self._is_shallow_repository() else []
+            try:
+                if subprocess.run(["git", "fetch", *depth, "--no-tags", "origin", refspec],
+                                  cwd=dirname(CONTROLLER_GIT_PATH)).returncode == 0:
+                    return True
+            except subprocess.CalledProcessError as e:
+                error(f"[GIT-CLIENT] Unable to fetch '{hash_or_tag}' from remote: {e} {e.stderr} {e.stdout}")
+            warn(f"[GIT-CLIENT] Fetch of '{hash_or_tag}' failed, fetching all refs")
         try:
             if subprocess.run(["git", "fetch"], cwd=dirname(CONTROLLER_GIT_PATH)).returncode == 0:
                 return True
@@ -1,67 +1,177 @@
 import importlib
+import json
 import os
-import time
+import threading
+from queue import Queue, Empty, Full
+from typing import Any
+
+from utils.timestamps import timestamp_allocator
 
 # get log level from env var
 LOG_LEVEL = os.getenv('LOG_LEVEL') or 'INFO'
+LOG_LEVELS = {'DEBUG': 0, 'INFO': 1, 'WARN': 2, 'ERROR': 3}
+
+# log records waiting for the shipper, records are dropped if it falls this far behind
+LOG_QUEUE_MAX_RECORDS = 10_000
+# log records per telemetry message
+LOG_BATCH_MAX_RECORDS = 100
+# interval in which the shipper checks if buffered log records can be published
+LOG_SHIPPER_IDLE_SECONDS = 5
+
+LOG_BUFFER_TABLE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS log_buffer (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        log_level text,
+        message text,
+        timestamp_ms INTEGER
+    );
+"""
+
+Sqlite: Any = None
+GatewayMqttClient: Any = None
+UtilsPaths: Any = None
+gateway_logs_buffer_db: Any = None
+
+log_queue: Queue = Queue(maxsize=LOG_QUEUE_MAX_RECORDS)
+log_shipper_thread = None
+log_shipper_lock = threading.Lock()
+# number of log records dropped since startup because the shipper fell behind, published as telemetry
+log_counters = {
+    "gateway_dropped_logs": 0,
+}
 
-Sqlite = None
-GatewayMqttClient = None
-UtilsPaths = None
-gateway_logs_buffer_db = None
 
 def log(level: str, message: str):
+    if LOG_LEVELS.get(level, LOG_LEVELS['ERROR']) < LOG_LEVELS.get(LOG_LEVEL, LOG_LEVELS['INFO']):
+        return
     print(f'[{level}] {message}')
-    if level == 'DEBUG' and LOG_LEVEL != 'DEBUG':
+
+    # logs of the shipper itself (e.g. of the MQTT client) are not shipped to avoid a feedback loop
+    if threading.current_thread() is log_shipper_thread:
         return
+    _start_log_shipper()
 
-    # import GatewayMqttClient at runtime to avoid circular imports
-    global GatewayMqttClient
+    # allocate a unique timestamp, also used when the message is buffered
+    timestamp_ms = timestamp_allocator.allocate("log")
+    try:
+        log_queue.put_nowait((level, message, timestamp_ms))
+    except Full:
+        log_counters["gateway_dropped_logs"] += 1
+
+
+def _start_log_shipper() -> None:
+    global log_shipper_thread
+    if log_shipper_thread is not None:
+        return
+    with log_shipper_lock:
+        if log_shipper_thread is None:
+            log_shipper_thread = threading.Thread(target=_ship_logs, name="log-shipper", daemon=True)
+            log_shipper_thread.start()
+
+
+def _init_logs_buffer_db() -> None:
+    # import modules at runtime to avoid circular imports
+    global GatewayMqttClient, UtilsPaths, Sqlite, gateway_logs_buffer_db
     if GatewayMqttClient is None:
         GatewayMqttClient = importlib.import_module('modules.mqtt').GatewayMqttClient
-
-    # import UtilsPaths at runtime to avoid circular imports
-    global UtilsPaths
     if UtilsPaths is None:
         UtilsPaths = importlib.import_module('utils.paths')
-
-    # import sqlite at runtime to avoid circular imports
-    global Sqlite
     if Sqlite is None:
         Sqlite = importlib.import_module('modules.sqlite')
 
     # initialize gateway_logs_buffer_db if not already initialized
-    global gateway_logs_buffer_db
     if gateway_logs_buffer_db is None:
         gateway_logs_buffer_db = Sqlite.SqliteConnection(UtilsPaths.GATEWAY_LOGS_BUFFER_DB_PATH, dont_retry=True)
         if gateway_logs_buffer_db.db_unavailable:
             gateway_logs_buffer_db = None
+        else:
+            gateway_logs_buffer_db.execute(LOG_BUFFER_TABLE_SCHEMA)
 
-    # attempt to publish log message via MQTT
-    publish_failure = False
+
+def _next_batch(timeout: float) -> list:
+    """Blocks until a log record is queued or the timeout expires, returns the queued records up to
+    the batch size"""
+    try:
+        batch = [log_queue.get(timeout=timeout)]
+    except Empty:
+        return []
+    while len(batch) < LOG_BATCH_MAX_RECORDS:
+        try:
+            batch.append(log_queue.get_nowait())
+        except Empty:
+            break
+    return batch
+
+
+def _publish_batch(batch: list) -> bool:
+    if not GatewayMqttClient().connected:
+        return False
     try:
-        if not GatewayMqttClient().publish_log(level, message):
-            publish_failure = True
-            print(f'Failed to publish log message via MQTT.')
+        return GatewayMqttClient().publish_telemetry(json.dumps([{
+            "ts": timestamp_ms,
+            "values": {
+                "severity": level,
+                "message": "GATEWAY - " + message
+            }
+        } for level, message, timestamp_ms in batch]))
     except Exception as e:
-        publish_failure = True
-        print(f'Failed to publish log message via MQTT: {e}')
-
-    # buffer unpublished message in sqlite db to be published later
-    if publish_failure and gateway_logs_buffer_db is not None:
-        print(f'Buffering unpublished message.')
-        gateway_logs_buffer_db.execute("""
-            CREATE TABLE IF NOT EXISTS log_buffer (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                log_level text,
-                message text,
-                timestamp_ms INTEGER
-            );
-        """)
-        gateway_logs_buffer_db.execute(
-            "INSERT INTO log_buffer (log_level, message, timestamp_ms) VALUES (?, ?, ?)",
-            (level, message, int(time.time_ns() / 1000_000))
-        )
+        print(f'Failed to publish log messages via MQTT: {e}')
+        return False
+
+
+def _spill_batch(batch: list) -> None:
+    """Writes unpublished log records to the buffer sqlite db, to be published once connected"""
+    if gateway_logs_buffer_db is None or len(batch) == 0:
+        return
+    print(f'Buffering {len(batch)} unpublished log messages.')
+    gateway_logs_buffer_db.execute_transaction([(
+        "INSERT INTO log_buffer (log_level, message, timestamp_ms) VALUES (?, ?, ?)", batch)])
+
+
+def _publish_buffered_batch() -> tuple[bool, bool]:
+    """Publishes the oldest buffered log records, returns if records are still buffered and if the batch
+    was published"""
+    if gateway_logs_buffer_db is None:
+        return False, False
+    if not GatewayMqttClient().connected:
+        return True, False
+    rows = gateway_logs_buffer_db.read(
+        "SELECT id, log_level, message, timestamp_ms FROM log_buffer ORDER BY id LIMIT ?", (LOG_BATCH_MAX_RECORDS,))
+    if rows is None or len(rows) == 0 or len(rows[0]) == 0:
+        return False, False
+    if not _publish_batch([row[1:] for row in rows]):
+        return True, False
+    gateway_logs_buffer_db.execute("DELETE FROM log_buffer WHERE id <= ?", (rows[-1][0],))
+    return True, True
+
+
+def _ship_logs() -> None:
+    """Publishes queued log records in batches. While offline, they are buffered in sqlite and published
+    once the connection is back."""
+    _init_logs_buffer_db()
+    buffer_pending = True  # there may be buffered records of a previous run
+    # False after publishing buffered records failed, they are retried after the next interval
+    drain_buffer = True
+    while True:
+        # drain the buffer without waiting while connected
+        draining = (buffer_pending and drain_buffer and gateway_logs_buffer_db is not None
+                    and GatewayMqttClient().connected)
+        batch = _next_batch(0 if draining else LOG_SHIPPER_IDLE_SECONDS)
+        if len(batch) > 0 and not _publish_batch(batch):
+            _spill_batch(batch)
+            buffer_pending = True
+        elif buffer_pending:
+            buffer_pending, drain_buffer = _publish_buffered_batch()
+
+
+def spill_queued_logs() -> None:
+    """Buffers all queued log records in sqlite, called on shutdown"""
+    _init_logs_buffer_db()
+    batch = _next_batch(0)
+    while len(batch) > 0:
+        _spill_batch(batch)
+        batch = _next_batch(0)
+
 
 def debug(message: str):
     log('DEBUG', message)
@@ -73,4 +183,4 @@ def error(message: str):
     log('ERROR', message)
 
 def warn(message: str):
-    log('WARN', message)
\ No newline at end of file
+    log('WARN', message)
@@ -4,9 +4,12 @@ import time
 from queue import Queue
 from typing import Any, Optional, Union
 
-from paho.mqtt.client import Client
+from paho.mqtt.client import Client, MQTT_ERR_SUCCESS
 
 from modules.logging import info, error, debug, warn
+from utils.timestamps import timestamp_allocator
+from utils.publish_window import PUBLISH_WINDOW_MAX
+from utils.wakeup import wake_up
 
 singleton_instance : Optional["GatewayMqttClient"] = None
 
@@ -15,6 +18,8 @@ class GatewayMqttClient(Client):
     initialized = False
     connected = False
     message_queue : Queue = Queue()
+    # (mid, monotonic ack time) of publishes acknowledged by the broker
+    ack_queue : Queue = Queue()
 
     def __init__(self):
         global singleton_instance
@@ -41,6 +46,10 @@ class GatewayMqttClient(Client):
         self.on_connect = self.__on_connect
         self.on_message = self.__on_message
         self.on_disconnect = self.__on_disconnect
+        self.on_publish = self.__on_publish
+
+        # the publish window is managed by the caller of `publish_qos1`, don't queue in paho
+        self.max_inflight_messages_set(PUBLISH_WINDOW_MAX)
 
         self.initialized = True
         self.connected = False
@@ -68,17 +77,24 @@ class GatewayMqttClient(Client):
         self.connected = True
         self.request_attributes({"sharedKeys": "sw_title,sw_url,sw_version,FILES"})
         self.update_sys_info_attribute()
+        wake_up()  # publish the buffered messages
 
     def __on_disconnect(self, _client, _userdata, result_code) -> None:
         self.connected = False
         info(f"[MQTT] Disconnected from ThingsBoard with result code: {result_code}")
         self.graceful_exit()
 
+    def __on_publish(self, _client, _userdata, mid) -> None:
+        # called from the network thread, the acks are matched to the publishes by the main thread
+        self.ack_queue.put((mid, time.monotonic()))
+        wake_up()
+
     def __on_message(self, _client, _userdata, msg) -> None:
         self.message_queue.put({
             "topic": msg.topic,
             "payload": json.loads(msg.payload)
         })
+        wake_up()
 
     def publish_sw_state(self, version: str, state: str, msg : Optional[str]=None) -> None:
         self.publish_telemetry(json.dumps({
@@ -104,15 +120,29 @@ class GatewayMqttClient(Client):
 
         return True
 
+    def publish_qos1(self, topic: str, message: str) -> Optional[int]:
+        """Publishes with QoS 1 without waiting for the broker ack. Returns the mid of the publish, which
+        is put into `ack_queue` once acknowledged, or None if the message could not be sent."""
+        if not self.initialized or not self.connected:
+            return None
+        try:
+            message_info = self.publish(topic, message, qos=1)
+        except Exception as e:
+            warn(f'[MQTT] Failed to publish message to topic "{topic}": {e}')
+            return None
+        if message_info.rc != MQTT_ERR_SUCCESS:
+            warn(f'[MQTT] Failed to publish message to topic "{topic}" with result code: {message_info.rc}')
+            return None
+        return message_info.mid
+
     def request_attributes(self, request_dict: dict) -> bool:
         self.attribute_request_id += 1
         return self.publish_message_raw(f"v1/devices/me/attributes/request/{str(self.attribute_request_id)}",
                                  json.dumps(request_dict))
 
     def publish_log(self, log_level, log_message, timestamp_ms = None) -> bool:
-        time.sleep(1/1000) # sleep for 1ms to avoid duplicate timestamps
         return self.publish_telemetry(json.dumps({
-            "ts": timestamp_ms or int(time.time_ns() / 1000_000),
+            "ts": timestamp_ms or timestamp_allocator.allocate("log"),
             "values": {
                 "severity": log_level,
                 "message": "GATEWAY - " + log_message
@@ -0,0 +1,281 @@
+import os
+import queue
+import time
+from collections import deque
+from time import time_ns
+from typing import Optional
+
+from modules import sqlite
+from modules.archive import archive_messages, reset_partition_watermarks
+from modules.logging import debug, info, warn
+from utils.publish_window import AdaptivePublishWindow
+from utils.weighted_fair_scheduler import WeightedFairScheduler
+
+MESSAGES_TABLE = sqlite.SqliteTables.CONTROLLER_MESSAGES.value
+
+# number of messages archived per main loop iteration
+ARCHIVE_BATCH_SIZE = 500
+# limits of the telemetry batches (JSON arrays of {ts, values} records) per link type, larger
+# batches save per message MQTT/TLS overhead. ThingsBoard rejects MQTT payloads above 64 KiB by default.
+TELEMETRY_BATCH_LIMITS = {
+    "cellular": {"max_records": 100, "max_bytes": 16_000},
+    "wifi": {"max_records": 500, "max_bytes": 60_000},
+    "ethernet": {"max_records": 500, "max_bytes": 60_000},
+}
+LINK_TYPE = os.environ.get("ACROPOLIS_LINK_TYPE") or "cellular"
+TELEMETRY_BATCH_MAX_RECORDS = int(os.environ.get("ACROPOLIS_TELEMETRY_BATCH_MAX_RECORDS")
+                                  or TELEMETRY_BATCH_LIMITS.get(LINK_TYPE, TELEMETRY_BATCH_LIMITS["cellular"])["max_records"])
+TELEMETRY_BATCH_MAX_BYTES = int(os.environ.get("ACROPOLIS_TELEMETRY_BATCH_MAX_BYTES")
+                                or TELEMETRY_BATCH_LIMITS.get(LINK_TYPE, TELEMETRY_BATCH_LIMITS["cellular"])["max_bytes"])
+# live messages older than this are published in the backfill lane
+LIVE_MESSAGE_MAX_AGE_MS = 5 * 60_000
+# share of published messages per priority lane if all lanes are busy
+PRIORITY_LANE_WEIGHTS = {
+    sqlite.MessagePriority.LIVE: 8,
+    sqlite.MessagePriority.CALIBRATION: 4,
+    sqlite.MessagePriority.LOG: 2,
+    sqlite.MessagePriority.BACKFILL: 1,
+}
+# seconds to wait for the broker ack of a telemetry batch before it is sent again
+PUBLISH_ACK_TIMEOUT_SECONDS = 30
+# messages of the legacy pending_mqtt_messages table are moved into the outbox with negative ids
+MIN_MESSAGE_ID = -(2**63)
+
+
+class ControllerOutbox:
+    """Archives and publishes the messages written by the controller to the `messages` table in place.
+
+    Messages are processed in id ranges and never copied between tables. Two watermarks are persisted:
+    - "archived up to id" in the archive db, committed together with the archived range, so every message
+      is archived exactly once. Only archived messages are published.
+    - "acked up to id" per priority lane in the communication queue db, committed together with the
+      deletion of the published range in a single statement.
+
+    Telemetry batches are published with QoS 1 in a sliding window of unacknowledged publishes, so
+    throughput is not capped at one batch per round trip. A range is only deleted once it and all
+    ranges before it in its lane are acknowledged by the broker. If an ack times out, the lane is sent
+    again from its acked watermark, which is idempotent as ThingsBoard overwrites values with the same ts."""
+
+    def __init__(self, communication_db: sqlite.SqliteConnection, archive_db: sqlite.SqliteConnection) -> None:
+        self.communication_db = communication_db
+        self.archive_db = archive_db
+        self.lane_scheduler = WeightedFairScheduler(PRIORITY_LANE_WEIGHTS)
+        self.publish_window = AdaptivePublishWindow()
+        # published ranges per lane: [first id, last id, mid, acked]
+        self.in_flight_ranges: dict[int, deque[list]] = {}
+        self.in_flight_lanes: dict[int, int] = {}  # mid -> lane
+        self.sent_up_to_ids: dict[int, int] = {}
+
+        # highest archived id per lane, advanced when archiving so publishing doesn't scan the queue
+        self.lane_tails: dict[int, int] = {}
+        self.communication_db_reset_count = communication_db.reset_count
+
+        for db, table in [(communication_db, sqlite.SqliteTables.OUTBOX_STATE.value),
+                          (archive_db, sqlite.SqliteTables.ARCHIVE_STATE.value)]:
+            db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value INTEGER NOT NULL);")
+
+        self.archived_up_to_id = self._read_state(archive_db, sqlite.SqliteTables.ARCHIVE_STATE.value, "archived_up_to_id", 0)
+        # the ids restart if the communication queue db was recreated
+        last_id = communication_db.execute(f"SELECT seq FROM sqlite_sequence WHERE name = '{MESSAGES_TABLE}';")
+        if len(last_id) == 0 or len(last_id[0]) == 0 or last_id[0][0] < self.archived_up_to_id:
+            self.archived_up_to_id = 0
+            reset_partition_watermarks()
+        self.acked_up_to_ids: dict[int, int] = {
+            lane: self._read_state(communication_db, sqlite.SqliteTables.OUTBOX_STATE.value, f"acked_up_to_id_{lane:d}", MIN_MESSAGE_ID)
+            for lane in sqlite.MessagePriority
+        }
+        self.lane_tails = self._read_lane_tails() or {}
+        info(f"[OUTBOX] Archived up to id {self.archived_up_to_id}, acked up to ids {list(self.acked_up_to_ids.values())}")
+
+    def _read_lane_tails(self) -> Optional[dict[int, int]]:
+        lane_tails = self.communication_db.read(
+            f"SELECT priority, MAX(id) FROM {MESSAGES_TABLE} WHERE id <= ? GROUP BY priority;",
+            (self.archived_up_to_id,))
+        if lane_tails is None or any(len(row) < 2 for row in lane_tails):
+            return None
+        return {lane: last_id for lane, last_id in lane_tails if last_id is not None}
+
+    def _check_communication_db_reset(self) -> None:
+        """The message ids restart if the communication queue db was recreated at runtime,
+        the watermarks and in flight ranges restart with them"""
+        if self.communication_db.reset_count == self.communication_db_reset_count:
+            return
+        self.communication_db_reset_count = self.communication_db.reset_count
+        warn("[OUTBOX] Communication queue db was recreated, resetting the watermarks")
+
+        sqlite.create_messages_table(self.communication_db, MESSAGES_TABLE)
+        self.communication_db.execute(f"PRAGMA user_version = {sqlite.CONTROLLER_MESSAGES_SCHEMA_VERSION};")
+        self.communication_db.execute(
+            f"CREATE TABLE IF NOT EXISTS {sqlite.SqliteTables.OUTBOX_STATE.value} (key TEXT PRIMARY KEY, value INTEGER NOT NULL);")
+        self.archive_db.execute_transaction([
+            self._write_state_query(sqlite.SqliteTables.ARCHIVE_STATE.value, "archived_up_to_id", 0),
+        ])
+        self.archived_up_to_id = 0
+        reset_partition_watermarks()
+        self.acked_up_to_ids = {lane: MIN_MESSAGE_ID for lane in sqlite.MessagePriority}
+        for ranges in self.in_flight_ranges.values():
+            for published_range in ranges:
+                self.publish_window.forget(published_range[2])
+        self.in_flight_ranges.clear()
+        self.in_flight_lanes.clear()
+        self.sent_up_to_ids.clear()
+        self.lane_tails.clear()
+
+    @staticmethod
+    def _read_state(db, table, key, default) -> int:
+        value = db.execute(f"SELECT value FROM {table} WHERE key = ?;", (key,))
+        if value is not None and len(value) > 0 and len(value[0]) > 0:
+            return int(value[0][0])
+        return default
+
+    @staticmethod
+    def _write_state_query(table, key, value):
+        return (f"INSERT INTO {table} (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value;",
+                (key, value))
+
+    def migrate_pending_mqtt_messages(self) -> None:
+        """Moves the messages of the legacy `pending_mqtt_messages` table, which are already archived, into
+        the outbox. They get negative ids to stay below the archive watermark and to be published first."""
+        pending_table = sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value
+        if not self.communication_db.does_table_exist(pending_table):
+            return
+        info(f"[OUTBOX] Moving messages of the legacy '{pending_table}' table into the outbox")
+        self.communication_db.execute_transaction([
+            (f"""
+                INSERT INTO {MESSAGES_TABLE} (id, ts_ms, type, priority, payload)
+                    SELECT id - (SELECT MAX(id) FROM {pending_table}) - 1, ts_ms, type, priority, payload
+                    FROM {pending_table};
+            """, ()),
+            (f"DROP TABLE {pending_table};", ()),
+        ])
+
+    def archive_next_range(self) -> int:
+        """Archives the next range of messages after the archive watermark, except for log messages.
+        Returns the number of processed messages."""
+        self._check_communication_db_reset()
+        messages = self.communication_db.read(
+            f"SELECT id, ts_ms, type, priority, payload FROM {MESSAGES_TABLE} WHERE id > ? ORDER BY id LIMIT ?;",
+            (self.archived_up_to_id, ARCHIVE_BATCH_SIZE)) or []
+        if len(messages) == 0 or len(messages[0]) == 0:
+            return 0
+        first_id, last_id = messages[0][0], messages[-1][0]
+
+        # the partitions skip messages they already archived if the watermark is not written
+        if not archive_messages([(message_id, ts_ms, payload) for message_id, ts_ms, message_type, _, payload in messages
+                                 if "log" not in message_type]):
+            return 0
+        if not self.archive_db.execute_transaction([
+            self._write_state_query(sqlite.SqliteTables.ARCHIVE_STATE.value, "archived_up_to_id", last_id),
+        ]):
+            return 0
+        previous_archived_up_to_id, self.archived_up_to_id = self.archived_up_to_id, last_id
+
+        # do not delay fresh measurements with a backlog of live messages
+        live_cutoff_ms = int(time_ns() / 1_000_000) - LIVE_MESSAGE_MAX_AGE_MS
+        self.communication_db.execute(
+            f"UPDATE {MESSAGES_TABLE} SET priority = ? WHERE id > ? AND id <= ? AND priority = ? AND ts_ms < ?;",
+            (int(sqlite.MessagePriority.BACKFILL), previous_archived_up_to_id, last_id,
+             int(sqlite.MessagePriority.LIVE), live_cutoff_ms))
+        for message_id, ts_ms, _, priority, _ in messages:
+            if priority == sqlite.MessagePriority.LIVE and ts_ms < live_cutoff_ms:
+                priority = int(sqlite.MessagePriority.BACKFILL)
+            self.lane_tails[priority] = max(self.lane_tails.get(priority, MIN_MESSAGE_ID), message_id)
+        debug(f"[OUTBOX] Archived messages {first_id} to {last_id}")
+        return len(messages)
+
+    def _lane_cursor(self, lane: int) -> int:
+        return max(self.sent_up_to_ids.get(lane, MIN_MESSAGE_ID), self.acked_up_to_ids.get(lane, MIN_MESSAGE_ID))
+
+    def publish_next_range(self, mqtt_client) -> int:
+        """Publishes the next range of archived messages of the scheduled priority lane as one telemetry
+        batch if the publish window is not full. Returns the number of published messages."""
+        self._check_communication_db_reset()
+        if self.publish_window.is_full():
+            return 0
+        # lanes with messages which have not been sent yet
+        lanes = [lane for lane, last_id in self.lane_tails.items() if last_id > self._lane_cursor(lane)]
+        if len(lanes) == 0:
+            return 0
+        lane: Optional[int] = self.lane_scheduler.next_lane(lanes)
+        if lane is None:
+            # messages of unknown lanes are sent once all known lanes are empty
+            lane = min(lanes)
+
+        messages = self.communication_db.read(
+            f"SELECT id, ts_ms, payload FROM {MESSAGES_TABLE} WHERE priority = ? AND id > ? AND id <= ? ORDER BY id LIMIT ?;",
+            (lane, self._lane_cursor(lane), self.archived_up_to_id, TELEMETRY_BATCH_MAX_RECORDS)) or []
+        if len(messages) == 0:
+            # the tails are off if the priority update after archiving failed, read them from the queue
+            lane_tails = self._read_lane_tails()
+            if lane_tails is not None:
+                self.lane_tails = lane_tails
+            return 0
+
+        # the payloads are already JSON encoded, wrap them without parsing them
+        records: list[str] = []
+        batch_bytes = 2
+        for _, ts_ms, payload in messages:
+            record = f'{{"ts": {ts_ms}, "values": {payload}}}'
+            if len(records) > 0 and batch_bytes + len(record) + 1 > TELEMETRY_BATCH_MAX_BYTES:
+                break
+            records.append(record)
+            batch_bytes += len(record) + 1
+
+        mid = mqtt_client.publish_qos1("v1/devices/me/telemetry", "[" + ",".join(records) + "]")
+        if mid is None:
+            return 0
+        # acks are only matched on this thread, after the mid has been registered
+        self.publish_window.on_send(mid, time.monotonic())
+        self.in_flight_lanes[mid] = lane
+        self.in_flight_ranges.setdefault(lane, deque()).append([messages[0][0], messages[len(records) - 1][0], mid, False])
+        self.sent_up_to_ids[lane] = messages[len(records) - 1][0]
+        return len(records)
+
+    def process_acks(self, mqtt_client) -> int:
+        """Handles the broker acks received so far, the main loop is woken up by each ack. Deletes the acked
+        ranges at the head of each lane and resends lanes with timed out publishes. Returns the number of
+        acked publishes."""
+        self._check_communication_db_reset()
+        acked_count = 0
+        acked_lanes = set()
+        try:
+            mid, ack_time = mqtt_client.ack_queue.get_nowait()
+            while True:
+                if self.publish_window.on_ack(mid, ack_time):
+                    lane = self.in_flight_lanes.pop(mid)
+                    for published_range in self.in_flight_ranges[lane]:
+                        if published_range[2] == mid:
+                            published_range[3] = True
+                    acked_lanes.add(lane)
+                    acked_count += 1
+                mid, ack_time = mqtt_client.ack_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+        for lane in acked_lanes:
+            ranges = self.in_flight_ranges[lane]
+            if not ranges[0][3]:
+                continue
+            first_id = ranges[0][0]
+            while len(ranges) > 0 and ranges[0][3]:
+                acked_up_to_id = ranges.popleft()[1]
+            # the ids of a lane are consecutive in the acked ranges, delete them in a single statement
+            if self.communication_db.execute_transaction([
+                (f"DELETE FROM {MESSAGES_TABLE} WHERE priority = ? AND id >= ? AND id <= ?;",
+                 (lane, first_id, acked_up_to_id)),
+                self._write_state_query(sqlite.SqliteTables.OUTBOX_STATE.value, f"acked_up_to_id_{lane:d}", acked_up_to_id),
+            ]):
+                self.acked_up_to_ids[lane] = acked_up_to_id
+
+        for mid in self.publish_window.expire(time.monotonic(), PUBLISH_ACK_TIMEOUT_SECONDS):
+            if mid not in self.in_flight_lanes:
+                continue  # the lane was already reset by another expired publish
+            expired_lane = self.in_flight_lanes.pop(mid)
+            warn(f"[OUTBOX] Publish {mid} was not acknowledged within {PUBLISH_ACK_TIMEOUT_SECONDS}s, resending lane {expired_lane}")
+            # acks of the other publishes of the lane are ignored, the lane is sent again from its acked watermark
+            for published_range in self.in_flight_ranges.pop(expired_lane, deque()):
+                self.publish_window.forget(published_range[2])
+                self.in_flight_lanes.pop(published_range[2], None)
+            self.sent_up_to_ids.pop(expired_lane, None)
+
+        return acked_count
@@ -0,0 +1,71 @@
+import os
+
+from modules import sqlite
+from modules.logging import info, warn
+
+# quota of the gateway logs buffered while ThingsBoard is not reachable, the quota of the
+# controller messages is enforced by the controller (software/controller/src/interfaces/communication_queue.py)
+LOGS_BUFFER_MAX_ROWS = int(os.environ.get("ACROPOLIS_LOGS_BUFFER_MAX_ROWS") or 100_000)
+LOGS_BUFFER_MAX_BYTES = int(os.environ.get("ACROPOLIS_LOGS_BUFFER_MAX_BYTES") or 32_000_000)
+
+# eviction deletes messages in batches of this size until the usage of the queue is below this ratio of its quota
+EVICTION_BATCH_SIZE = 1000
+EVICTION_TARGET_RATIO = 0.9
+
+# number of evicted messages since startup, published as telemetry
+eviction_counters = {
+    "gateway_queue_evicted_logs": 0,    # DEBUG and INFO log messages
+    "gateway_queue_evicted": 0,         # other log messages
+}
+
+
+def get_queue_usage(db: sqlite.SqliteConnection, table: str, size_column: str, max_bytes: int) -> tuple[int, int]:
+    """Returns the number of rows and the bytes of `size_column` of the table. The size of the database file
+    is an upper bound of the bytes and cheap to get, the column is only summed up if it exceeds `max_bytes`."""
+    rows = db.read(f"SELECT COUNT(*) FROM {table};")[0][0]
+    page_size = db.read("PRAGMA page_size;")[0][0]
+    used_pages = db.read("PRAGMA page_count;")[0][0] - db.read("PRAGMA freelist_count;")[0][0]
+    size = used_pages * page_size
+    if size > max_bytes:
+        size = db.read(f"SELECT COALESCE(SUM(LENGTH({size_column})), 0) FROM {table};")[0][0]
+    return rows, size
+
+
+def evict(db: sqlite.SqliteConnection, table: str, size_column: str, max_rows: int, max_bytes: int, stages) -> None:
+    """Reduces the usage of a queue which exceeds its quota below `EVICTION_TARGET_RATIO` of the quota.
+    `stages` is a list of (counter, condition) of the messages to drop, oldest first. Each stage is only
+    run if the previous ones did not suffice."""
+    rows, size = get_queue_usage(db, table, size_column, max_bytes)
+    if rows <= max_rows and size <= max_bytes:
+        return
+    warn(f"[QUEUE_QUOTA] Table '{table}' exceeds its quota ({rows}/{max_rows} rows, {size}/{max_bytes} bytes), evicting messages")
+
+    def is_above_target():
+        return rows > max_rows * EVICTION_TARGET_RATIO or size > max_bytes * EVICTION_TARGET_RATIO
+
+    for counter, condition in stages:
+        evicted = 0
+        while is_above_target():
+            freed = db.execute(f"""
+                DELETE FROM {table} WHERE id IN (
+                    SELECT id FROM {table} WHERE {condition} ORDER BY id LIMIT {EVICTION_BATCH_SIZE}
+                ) RETURNING LENGTH({size_column});
+            """) or []
+            if len(freed) == 0:
+                break
+            rows -= len(freed)
+            size -= sum(length for length, in freed)
+            evicted += len(freed)
+        if evicted > 0:
+            eviction_counters[counter] += evicted
+            info(f"[QUEUE_QUOTA] Evicted {evicted} messages from '{table}' ({counter})")
+
+
+def enforce_queue_quotas(logs_buffer_db: sqlite.SqliteConnection) -> None:
+    """Enforces the quota of the gateway logs buffer: DEBUG and INFO logs are dropped first, then any
+    other logs. The controller enforces the quota of the `messages` table (the outbox) itself."""
+    if logs_buffer_db.does_table_exist("log_buffer"):
+        evict(logs_buffer_db, "log_buffer", "message", LOGS_BUFFER_MAX_ROWS, LOGS_BUFFER_MAX_BYTES, [
+            ("gateway_queue_evicted_logs", "log_level IN ('DEBUG', 'INFO')"),
+            ("gateway_queue_evicted", "1"),
+        ])
@@ -1,27 +1,91 @@
 import os
 import sqlite3
-from enum import Enum
+from enum import Enum, IntEnum
 from typing import Any
-from threading import Lock
+from threading import Lock, RLock, local
 
 
 from utils.misc import fatal_error
-from modules.logging import info
+from modules.logging import info, warn
 
 
 class SqliteTables(Enum):
     CONTROLLER_MESSAGES = "messages"
     HEALTH_CHECK = "health_check"
-    PENDING_MQTT_MESSAGES = "pending_mqtt_messages"
+    PENDING_MQTT_MESSAGES = "pending_mqtt_messages"  # legacy, migrated into the outbox
+    OUTBOX_STATE = "outbox_state"
+    ARCHIVE_STATE = "archive_state"
+    ARCHIVE_REPUBLISH_JOB = "archive_republish_job"
+
+
+class MessagePriority(IntEnum):
+    """Priority lanes of controller messages, assigned by the controller
+    (software/controller/src/interfaces/communication_queue.py)"""
+    LIVE = 0
+    CALIBRATION = 1
+    LOG = 2
+    BACKFILL = 3  # live messages that were received too late by the gateway
+
+
+# the controller stores the schema version of its `messages` table as `user_version` of the communication queue
+# db after migrating it. The gateway doesn't touch the table before: a controller of a previous version still
+# running after a gateway update can't write to a migrated table, it migrates the table once it is updated.
+CONTROLLER_MESSAGES_SCHEMA_VERSION = 1
+
+# controller messages: `payload` holds the JSON encoded values of the
+# ThingsBoard telemetry message, its timestamp is stored in `ts_ms`
+MESSAGES_TABLE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts_ms INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        priority INTEGER NOT NULL DEFAULT 0,
+        payload TEXT NOT NULL
+    );
+"""
+
+# priority of messages written before the priority lanes were introduced
+LEGACY_PRIORITY_SQL = "CASE type WHEN 'log' THEN 2 ELSE 0 END"
+
+
+# number of prepared statements kept per connection
+STATEMENT_CACHE_SIZE = 128
+# statements which change the schema and invalidate the schema cache
+DDL_KEYWORDS = ("CREATE", "DROP", "ALTER")
+
+
+def _is_ddl(query: str) -> bool:
+    return query.lstrip()[:6].upper().startswith(DDL_KEYWORDS)
+
+
+# errors after which the db file is deleted and recreated, all other errors (e.g. "database is locked" after
+# the busy timeout) fail the statement and leave the db as it is
+CORRUPTION_ERRORS = ("malformed", "not a database", "corrupt")
+
+
+def _is_corruption(e: Exception) -> bool:
+    return isinstance(e, sqlite3.DatabaseError) and any(text in str(e).lower() for text in CORRUPTION_ERRORS)
 
 
 class SqliteConnection:
+    """Writes are serialized on a single connection. Reads via `read` use a read-only connection per
+    thread, so threads like the file check daemon or RPC handlers don't wait for writes (WAL)."""
+
     def __init__(self, path : str, nr_retries : int = 3, dont_retry : bool = False) -> None:
         self.path = path
         self.db_unavailable = True
-        self.write_lock = Lock()
+        # number of times the db was deleted and recreated, lets users reset state derived from it
+        self.reset_count = getattr(self, "reset_count", 0)
+        # reentrant, so an error while holding it can reset the connection
+        self.write_lock = RLock()
+        # tables known to exist, invalidated on DDL statements of this connection
+        self.known_tables: set[str] = set()
+        self.readers = local()
+        # reader connections and the locks held while they are used, so `close` waits for running reads
+        self.reader_conns: list[tuple[sqlite3.Connection, Lock]] = []
+        self.reader_conns_lock = Lock()
         try:
-            self.conn = sqlite3.connect(path, cached_statements=0, isolation_level=None, autocommit=True, check_same_thread=False)
+            self.conn = sqlite3.connect(path, cached_statements=STATEMENT_CACHE_SIZE, isolation_level=None, autocommit=True, check_same_thread=False)
             self.conn.execute("PRAGMA journal_mode=WAL;")       # enable write-ahead logging
             self.conn.execute("PRAGMA busy_timeout = 5000;")    # 5 seconds timeout for when the db is locked
             self.conn.execute("PRAGMA auto_vacuum  = FULL;")    # shrink the db file size when possible
@@ -37,13 +101,15 @@ class SqliteConnection:
             self.reset_db_conn(e, nr_retries - 1)
 
     def does_table_exist(self, table) -> bool:
-        return len(
-            self.execute(
-                f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table}'"
-            )) > 0
+        if table in self.known_tables:
+            return True
+        if self.read("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?;", (table,)) == [(1,)]:
+            self.known_tables.add(table)
+            return True
+        return False
 
     def is_table_empty(self, table) -> bool:
-        return self.execute(f"SELECT COUNT(*) FROM {table}")[0][0] == 0
+        return self.read(f"SELECT EXISTS (SELECT 1 FROM {table});") != [(1,)]
 
     def do_table_values_exist(self, table):
         return self.does_table_exist(table) and not self.is_table_empty(table)
@@ -57,18 +123,85 @@ class SqliteConnection:
             return None
         with self.write_lock:
             try:
+                if _is_ddl(query):
+                    self.known_tables.clear()
                 cursor = self.conn.cursor()
                 cursor.execute(query, params)
                 fetch = cursor.fetchall()
             except Exception as e:
                 if "no such table" in str(e):
                     return [()]
+                if not _is_corruption(e):
+                    warn(f"[SQLITE]: Query failed at '{self.path}': {e}")
+                    return []
                 self.reset_db_conn(e)
-                return self.execute(query)
+                return self.execute(query, params)
             return fetch
 
+    def _reader_conn(self) -> tuple[sqlite3.Connection, Lock]:
+        conn = getattr(self.readers, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, cached_statements=STATEMENT_CACHE_SIZE,
+                                   isolation_level=None, autocommit=True, check_same_thread=False)
+            conn.execute("PRAGMA busy_timeout = 5000;")
+            self.readers.conn = conn
+            self.readers.lock = Lock()
+            with self.reader_conns_lock:
+                self.reader_conns.append((conn, self.readers.lock))
+        return conn, self.readers.lock
+
+    def read(self, query, params=()) -> Any:
+        """Executes a read-only query on the connection of the calling thread without taking the write lock"""
+        if self.db_unavailable:
+            return None
+        try:
+            conn, lock = self._reader_conn()
+            with lock:
+                return conn.execute(query, params).fetchall()
+        except Exception as e:
+            if "no such table" in str(e):
+                return [()]
+            # errors are handled (and the db reset if needed) by the writer connection
+            return self.execute(query, params)
+
+    def execute_transaction(self, queries) -> bool:
+        """Executes a list of (query, params) in a single transaction, a list of params executes the query for each"""
+        if self.db_unavailable:
+            return False
+        with self.write_lock:
+            try:
+                self.conn.execute("BEGIN IMMEDIATE;")
+                for query, params in queries:
+                    if _is_ddl(query):
+                        self.known_tables.clear()
+                    if isinstance(params, list):
+                        self.conn.executemany(query, params)
+                    else:
+                        self.conn.execute(query, params)
+                self.conn.execute("COMMIT;")
+            except Exception as e:
+                try:
+                    if self.conn.in_transaction:
+                        self.conn.execute("ROLLBACK;")
+                except sqlite3.Error:
+                    pass
+                if not _is_corruption(e):
+                    # retried by the caller
+                    warn(f"[SQLITE]: Transaction failed at '{self.path}': {e}")
+                    return False
+                self.reset_db_conn(e)
+                return False
+            return True
+
     def close(self) -> None:
-        self.conn.close()
+        """Closes all connections, waiting for the reads and writes running in other threads"""
+        with self.reader_conns_lock:
+            for conn, lock in self.reader_conns:
+                with lock:
+                    conn.close()
+            self.reader_conns.clear()
+        with self.write_lock:
+            self.conn.close()
 
     def reset_db_conn(self, error_msg, nr_retries=3) -> None:
         self.db_unavailable = True
@@ -80,7 +213,60 @@ class SqliteConnection:
         except Exception as e:
             fatal_error(f'Failed to reset sqlite db at "{self.path}": {e}')
 
+        self.reset_count += 1
         try:
             self.__init__(self.path, nr_retries - 1)  # type: ignore[misc]
         except Exception as e:
             fatal_error(f'Failed to reset sqlite db at "{self.path}": {e}')
+
+
+def read_controller_schema_version(db: SqliteConnection) -> int:
+    version = db.execute("PRAGMA user_version;")
+    if version is None or len(version) == 0 or len(version[0]) == 0:
+        return 0
+    return int(version[0][0])
+
+
+def create_messages_table(db: SqliteConnection, table: str) -> None:
+    db.execute(MESSAGES_TABLE_SCHEMA.format(table=table))
+    db.execute(f"CREATE INDEX IF NOT EXISTS {table}_ts_ms_index ON {table} (ts_ms);")
+    db.execute(f"CREATE INDEX IF NOT EXISTS {table}_type_index ON {table} (type, id);")
+    db.execute(f"CREATE INDEX IF NOT EXISTS {table}_priority_index ON {table} (priority, id);")
+
+
+def migrate_legacy_messages_table(db: SqliteConnection, table: str) -> None:
+    """Migrates a table of a previous schema to the current one in a single transaction:
+    either (type, message) where message is the JSON encoded {"ts": ..., "values": ...}
+    or (ts_ms, type, payload) without priority. Keeps ids and the AUTOINCREMENT sequence.
+    The controller migrates its `messages` table the same way, the gateway only migrates its own tables."""
+    columns = [row[1] for row in db.execute(f"PRAGMA table_info({table});") or [] if len(row) > 1]
+    if len(columns) == 0 or "priority" in columns:
+        return
+
+    info(f"[SQLITE]: migrating table '{table}' at '{db.path}' to the current schema")
+    if "message" not in columns:
+        db.execute_transaction([
+            (f"ALTER TABLE {table} ADD COLUMN priority INTEGER NOT NULL DEFAULT 0;", ()),
+            (f"UPDATE {table} SET priority = {LEGACY_PRIORITY_SQL};", ()),
+        ])
+        return
+
+    db.execute_transaction([
+        (f"ALTER TABLE {table} RENAME TO {table}_legacy;", ()),
+        (MESSAGES_TABLE_SCHEMA.format(table=table), ()),
+        (f"""
+            INSERT INTO {table} (id, ts_ms, type, priority, payload)
+                SELECT id, json_extract(message, '$.ts'), type, {LEGACY_PRIORITY_SQL},
+                       json_extract(message, '$.values')
+                FROM {table}_legacy
+                WHERE json_valid(message) AND json_extract(message, '$.ts') IS NOT NULL
+                ORDER BY id;
+        """, ()),
+        # continue the id sequence of the legacy table
+        (f"DELETE FROM sqlite_sequence WHERE name = '{table}';", ()),
+        (f"""
+            INSERT INTO sqlite_sequence (name, seq)
+                SELECT '{table}', seq FROM sqlite_sequence WHERE name = '{table}_legacy';
+        """, ()),
+        (f"DROP TABLE {table}_legacy;", ()),
+    ])
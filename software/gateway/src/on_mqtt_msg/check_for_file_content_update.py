@@ -1,7 +1,9 @@
 import json
 
 from modules.docker_client import GatewayDockerClient
-from modules.file_writer import GatewayFileWriter, write_file_content_to_client_attribute
+from modules.file_transfer import is_file_transfer_part, receive_file_transfer_part
+from modules.file_writer import GatewayFileWriter, write_file_content_to_client_attribute, write_file_atomically, \
+    publish_file_signature
 from modules.logging import info, error
 from typing import Any
 
@@ -34,7 +36,10 @@ def on_msg_check_for_file_content_update(msg_payload: Any) -> bool:
 
     # encode file content to bytes based on content encoding (defaults to "text")
     file_encoding = get_maybe(file_definition, "encoding") or "text"
-    if file_encoding == "json":
+    file_content_bytes = b""
+    if is_file_transfer_part(input_file_content):
+        pass  # the parts of a chunked transfer are assembled when written
+    elif file_encoding == "json":
         if isinstance(input_file_content, dict):
             file_content_bytes = json.dumps(input_file_content).encode("utf-8")
         else:
@@ -77,8 +82,13 @@ def on_msg_check_for_file_content_update(msg_payload: Any) -> bool:
         info(f"Writing file {file_id} at path: {file_path}")
         try:
             # write content to file
-            with open(file_path, "wb") as f:
-                f.write(file_content_bytes)
+            if is_file_transfer_part(input_file_content):
+                if not receive_file_transfer_part(file_id, file_path, input_file_content):
+                    return True  # waiting for the remaining parts
+                input_file_content = GatewayFileWriter().read_file(file_path, file_encoding) or "E_EMPTYFILE"
+            else:
+                write_file_atomically(file_path, lambda f: f.write(file_content_bytes))
+            publish_file_signature(file_id, file_path)
             # calculate new file hash and update it to ThingsBoard
             file_content_hash = GatewayFileWriter().calc_file_hash(file_path)
             file_hashes = GatewayFileWriter().get_tb_file_hashes()
@@ -1,7 +1,7 @@
 import json
 import os
 from modules.logging import info, error, warn
-from modules.file_writer import GatewayFileWriter, write_file_content_to_client_attribute
+from modules.file_writer import GatewayFileWriter, write_file_content_to_client_attribute, publish_file_signature
 from typing import Any
 import utils
 from modules.mqtt import GatewayMqttClient
@@ -55,6 +55,7 @@ def on_msg_check_for_file_hashes_update(msg_payload: Any) -> bool:
             if previous_file_hash != current_file_hash:
                 info(f"File {file_path} has changed, updating id '{file_id}'")
                 write_file_content_to_client_attribute(file_id, GatewayFileWriter().read_file(file_path, file_encoding) or "E_EMPTYFILE")
+                publish_file_signature(file_id, file_path)
 
                 # request which (if) content should be written to it
                 info(f"Requesting file content update for '{file_id}'")
@@ -18,11 +18,11 @@ def on_msg_check_for_ota_update(msg_payload: Optional[Any]) -> bool:
         if current_version is None or current_version != sw_version:
             info("Software update available: " + (sw_title or "?") + " from " + (
                         current_version or "UNKNOWN") + " to " + sw_version)
-            docker_client.start_controller_safely(sw_version)
+            docker_client.start_controller_in_background(sw_version)
         else:
             info("Software is up to date (version '" + current_version + "')")
             docker_client.set_last_launched_controller_version(current_version)
     else:
         info("Launching latest edge-software: " + sw_version + " (" + (sw_title or "?") + ")")
-        docker_client.start_controller_safely(sw_version)
+        docker_client.start_controller_in_background(sw_version)
     return True
\ No newline at end of file
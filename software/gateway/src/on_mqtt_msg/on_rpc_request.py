@@ -1,22 +1,60 @@
 import json
 import os
 import queue
+import re
 import signal
 import subprocess
 import threading
+from collections import deque
 from time import sleep, monotonic
 from typing import Any, Optional
 
 import utils.paths
 from modules import sqlite
+from modules.archive import discard_archive_messages, query_archive_buckets, MIN_ARCHIVE_TIMESTAMP_MS, MAX_ARCHIVE_TIMESTAMP_MS
+from modules.archive_republisher import ArchiveRepublisher
 from modules.docker_client import GatewayDockerClient
 from modules.file_writer import GatewayFileWriter
 from modules.mqtt import GatewayMqttClient
 
-from modules.logging import info, error, debug
+from modules.logging import info, warn, error
 from on_mqtt_msg.check_for_file_hashes_update import FILE_HASHES_TB_KEY
 
 import utils.controller_restart
+from utils.rpc_worker_pool import RpcWorkerPool
+from utils.timestamps import timestamp_allocator
+
+# RPC handlers run on worker threads, so slow ones (e.g. run_command) don't block the main loop
+RPC_WORKERS = int(os.environ.get("ACROPOLIS_RPC_WORKERS") or 4)
+RPC_MAX_QUEUED = int(os.environ.get("ACROPOLIS_RPC_MAX_QUEUED") or 16)
+rpc_worker_pool: Optional[RpcWorkerPool] = None
+
+# output of `run_command` is streamed in chunks of this size or age (both can be overridden per command)
+RUN_COMMAND_CHUNK_BYTES = int(os.environ.get("ACROPOLIS_RUN_COMMAND_CHUNK_BYTES") or 4000)
+RUN_COMMAND_CHUNK_INTERVAL_SECONDS = int(os.environ.get("ACROPOLIS_RUN_COMMAND_CHUNK_INTERVAL_SECONDS") or 2)
+RUN_COMMAND_MAX_OUTPUT_BYTES = int(os.environ.get("ACROPOLIS_RUN_COMMAND_MAX_OUTPUT_BYTES") or 1_000_000)
+# the response contains the end of the output, up to this size
+RUN_COMMAND_TAIL_BYTES = 16_000
+RUN_COMMAND_QUEUED_LINES = 1000
+# time to collect the remaining output after the command exited
+RUN_COMMAND_DRAIN_SECONDS = 1
+# max. number of time buckets returned by `archive_query`
+ARCHIVE_QUERY_MAX_BUCKETS = 5000
+# max. time range of `archive_query`, every archived row in the range is read
+ARCHIVE_QUERY_MAX_SPAN_MS = 366 * 24 * 3600 * 1000
+
+
+def get_rpc_worker_pool() -> RpcWorkerPool:
+    global rpc_worker_pool
+    if rpc_worker_pool is None:
+        rpc_worker_pool = RpcWorkerPool(RPC_WORKERS, RPC_MAX_QUEUED)
+    return rpc_worker_pool
+
+
+def is_rpc_cancelled(rpc_msg_id: str) -> bool:
+    """Long-running handlers check this to stop early after a `cancel` RPC"""
+    return get_rpc_worker_pool().is_cancelled(rpc_msg_id)
+
 
 def rpc_reboot(rpc_msg_id: str, _method: Any, _params: Any):
     """Reboot the device"""
@@ -45,6 +83,33 @@ def rpc_restart_controller(rpc_msg_id: str, _method: Any, _params: Any):
     GatewayDockerClient().stop_controller()
     utils.controller_restart.last_container_restart_ts = 0 # restart the container immediately
 
+def rpc_rollback_controller(rpc_msg_id: str, _method: Any, _params: Any):
+    version = GatewayDockerClient().rollback_controller()
+    if version is None:
+        send_rpc_method_error(rpc_msg_id, "No image of a previous controller version cached")
+        return
+    info("[RPC] Rolling back controller to version '" + version + "'...")
+    send_rpc_response(rpc_msg_id, "OK - Rolling back controller to version '" + version + "'")
+
+def rpc_cancel(rpc_msg_id: str, _method: Any, params: Any):
+    if type(params) is not dict or type(params.get("rpc_msg_id")) not in [str, int]:
+        return send_rpc_method_error(rpc_msg_id, "Cancelling failed: missing 'rpc_msg_id' in params")
+    cancelled_rpc_msg_id = str(params["rpc_msg_id"])
+    started = get_rpc_worker_pool().cancel(cancelled_rpc_msg_id)
+    if started is None:
+        return send_rpc_method_error(rpc_msg_id, f"Cancelling failed: request {cancelled_rpc_msg_id} is not running")
+    info(f"[RPC] Cancelled request {cancelled_rpc_msg_id}")
+    if not started:
+        send_rpc_response(cancelled_rpc_msg_id, "Error - Cancelled before it started")
+    send_rpc_response(rpc_msg_id, f"OK - Cancelled request {cancelled_rpc_msg_id}")
+    return None
+
+def rpc_jobs(rpc_msg_id: str, _method: Any, _params: Any):
+    send_rpc_response(rpc_msg_id, [
+        {"rpc_msg_id": job_rpc_msg_id, "method": method, "state": "RUNNING" if started else "QUEUED"}
+        for job_rpc_msg_id, method, started in get_rpc_worker_pool().running_jobs()
+    ])
+
 def rpc_ping(rpc_msg_id: str, _method: Any, _params: Any):
     info("[RPC] Pong")
     send_rpc_response(rpc_msg_id, "Pong")
@@ -63,7 +128,15 @@ def rpc_init_files(rpc_msg_id: str, _method: Any, _params: Any):
     GatewayMqttClient().request_attributes({"sharedKeys": f"FILES"})
     send_rpc_response(rpc_msg_id, "Files client attributes initialized")
 
+def verify_int_param(params: dict, key: str, minimum: int) -> Optional[str]:
+    if key in params and (type(params[key]) is not int or params[key] < minimum):
+        return f"'{key}' must be an integer >= {minimum}"
+    return None
+
 def rpc_run_command(rpc_msg_id: str, _method: Any, params: Any):
+    """Runs the command and streams its output as `run_command_output` telemetry whenever `chunk_bytes` are
+    collected or `chunk_interval_s` passed. Output beyond `max_output_bytes` is not streamed anymore, and
+    the response only contains the last `RUN_COMMAND_TAIL_BYTES` of the output."""
     # Read command parameters
     if type(params) is not dict:
         return send_rpc_method_error(rpc_msg_id, "Running command failed: params is not a dictionary")
@@ -71,9 +144,14 @@ def rpc_run_command(rpc_msg_id: str, _method: Any, params: Any):
         return send_rpc_method_error(rpc_msg_id, "Running command failed: missing 'command' in params")
     if type(params["command"]) is not list or any(type(cmd) is not str for cmd in params["command"]):
         return send_rpc_method_error(rpc_msg_id, "Running command failed: 'command' must be a list of strings")
-    if "timeout_s" in params and type(params["timeout_s"]) is not int:
-        return send_rpc_method_error(rpc_msg_id, "Running command failed: 'timeout_s' must be an integer")
+    for key, minimum in [("timeout_s", 0), ("chunk_bytes", 1), ("chunk_interval_s", 0), ("max_output_bytes", 0)]:
+        params_verify_err = verify_int_param(params, key, minimum)
+        if params_verify_err is not None:
+            return send_rpc_method_error(rpc_msg_id, f"Running command failed: {params_verify_err}")
     timeout_s = params["timeout_s"] if "timeout_s" in params else 30
+    chunk_bytes = params.get("chunk_bytes", RUN_COMMAND_CHUNK_BYTES)
+    chunk_interval_s = params.get("chunk_interval_s", RUN_COMMAND_CHUNK_INTERVAL_SECONDS)
+    max_output_bytes = params.get("max_output_bytes", RUN_COMMAND_MAX_OUTPUT_BYTES)
     command = params["command"]
 
     info(f"[RPC] Running command: ['{command}']")
@@ -81,7 +159,7 @@ def rpc_run_command(rpc_msg_id: str, _method: Any, params: Any):
         """Continuously read lines from `stream` and put them on a queue."""
         with stream:  # closes the pipe on exit
             for line in iter(stream.readline, ''):   # '' ⇒ EOF in text mode
-                out_q.put(line)
+                out_q.put(line)  # blocks the command if its output is not consumed
     def read_lines_from_queue(line_queue: queue.Queue[str]) -> list[str]:
         collected_lines = []
         while True:
@@ -104,34 +182,99 @@ def rpc_run_command(rpc_msg_id: str, _method: Any, params: Any):
         errors='replace' # replace invalid characters with placeholder char during utf-8 decoding
     )
 
-    stdout_line_queue: queue.Queue[str] = queue.Queue()
+    stdout_line_queue: queue.Queue[str] = queue.Queue(maxsize=RUN_COMMAND_QUEUED_LINES)
     pipe_reading_thread = threading.Thread(target=read_stream_to_queue, args=(sub_process.stdout, stdout_line_queue),
                                            daemon=True)
     pipe_reading_thread.start()
 
-    output_lines: list[str] = []
+    # the last `RUN_COMMAND_TAIL_BYTES` of the output for the response, older lines are dropped
+    output_tail: deque[str] = deque()
+    output_tail_bytes = 0
+    output_bytes = 0
+    streamed_bytes = 0
+    chunk_seq = 0
+    pending_output = ""
+    last_chunk_timestamp = monotonic()
+
+    def collect_output(lines: list[str]) -> None:
+        nonlocal output_tail_bytes, output_bytes, pending_output
+        for line in lines:
+            line_bytes = len(line.encode())
+            output_bytes += line_bytes
+            output_tail.append(line)
+            output_tail_bytes += line_bytes
+            while output_tail_bytes > RUN_COMMAND_TAIL_BYTES and len(output_tail) > 1:
+                output_tail_bytes -= len(output_tail.popleft().encode())
+            if streamed_bytes + len(pending_output) < max_output_bytes:
+                pending_output += line
+
+    def publish_output_chunk(final: bool) -> None:
+        nonlocal streamed_bytes, chunk_seq, pending_output, last_chunk_timestamp
+        if len(pending_output) == 0 and not final:
+            return
+        chunk = pending_output.encode()[:max(max_output_bytes - streamed_bytes, 0)].decode(errors="ignore")
+        GatewayMqttClient().publish_telemetry(json.dumps({
+            "ts": timestamp_allocator.allocate("run_command_output"),
+            "values": {
+                "run_command_rpc_msg_id": rpc_msg_id,
+                "run_command_seq": chunk_seq,
+                "run_command_output": chunk,
+                "run_command_final": final,
+                "run_command_truncated": output_bytes > max_output_bytes,
+            }
+        }))
+        streamed_bytes += len(chunk.encode())
+        chunk_seq += 1
+        pending_output = ""
+        last_chunk_timestamp = monotonic()
+
+    def get_output() -> str:
+        dropped_bytes = output_bytes - output_tail_bytes
+        return (f"[{dropped_bytes} bytes truncated] " if dropped_bytes > 0 else "") + ''.join(output_tail)
+
+    reader_join_timeout_s = 1
     try:
         while sub_process.poll() is None:
             # Drain any lines that are already waiting
-            output_lines.extend(read_lines_from_queue(stdout_line_queue))
+            collect_output(read_lines_from_queue(stdout_line_queue))
+            if len(pending_output.encode()) >= chunk_bytes or monotonic() - last_chunk_timestamp >= chunk_interval_s:
+                publish_output_chunk(final=False)
+
+            if is_rpc_cancelled(rpc_msg_id):
+                sub_process.kill()
+                sub_process.wait()
+                publish_output_chunk(final=True)
+                return send_rpc_method_error(rpc_msg_id, f"Command '{command}' cancelled. Output: {get_output()}")
 
             if monotonic() - start_timestamp >= timeout_s:
                 sub_process.kill()
                 sub_process.wait()  # ensure process has ended
-                result = f"Error running command '{command}': Timeout after {timeout_s} seconds. Output: {'\n'.join(output_lines)}"
+                publish_output_chunk(final=True)
+                result = f"Error running command '{command}': Timeout after {timeout_s} seconds. Output: {get_output()}"
                 return send_rpc_method_error(rpc_msg_id, result)
 
             sleep(0.05)  # small sleep: reduce CPU without blocking
         sub_process.wait()
+
+        # read any remaining lines from the queue until the reader thread reached EOF, children which keep
+        # the pipe open (e.g. `sleep 15 &`) must not block the worker beyond the timeout
+        drain_deadline = min(start_timestamp + timeout_s, monotonic() + RUN_COMMAND_DRAIN_SECONDS)
+        while pipe_reading_thread.is_alive() or not stdout_line_queue.empty():
+            collect_output(read_lines_from_queue(stdout_line_queue))
+            if monotonic() >= drain_deadline or is_rpc_cancelled(rpc_msg_id):
+                break
+            pipe_reading_thread.join(timeout=0.05)
+        collect_output(read_lines_from_queue(stdout_line_queue))
+        if pipe_reading_thread.is_alive():
+            warn(f"[RPC] Output of command '{command}' is held open by a child process, not waiting for it")
+            collect_output(["[output of child processes truncated]\n"])
+        reader_join_timeout_s = 0
     finally:
         # If we exit early (timeout or exception) make sure the reader thread ends
-        pipe_reading_thread.join(timeout=1)
-
-    # read any remaining lines from the queue
-    while not stdout_line_queue.empty():
-        output_lines.extend(read_lines_from_queue(stdout_line_queue))
+        pipe_reading_thread.join(timeout=reader_join_timeout_s)
 
-    result = f"Command '{command}' exited with code {sub_process.returncode}. Output: {''.join(output_lines)}"
+    publish_output_chunk(final=True)
+    result = f"Command '{command}' exited with code {sub_process.returncode}. Output: {get_output()}"
     send_rpc_response(rpc_msg_id, f"OK - Command executed - {result}")
     return None
 
@@ -157,31 +300,68 @@ def rpc_archive_republish_messages(rpc_msg_id: str, _method: Any, params: Any):
 
     start_timestamp_ms = params["start_timestamp_ms"]
     end_timestamp_ms = params["end_timestamp_ms"]
-    if start_timestamp_ms <= 1735719469_000 or end_timestamp_ms >= 2524637869_000:
-        return send_rpc_method_error(rpc_msg_id, "Republishing archived messages failed: 'start_timestamp_ms' and 'end_timestamp_ms' must be within the range of 1735719469_000 and 2524637869_000")
+    if start_timestamp_ms <= MIN_ARCHIVE_TIMESTAMP_MS or end_timestamp_ms >= MAX_ARCHIVE_TIMESTAMP_MS:
+        return send_rpc_method_error(rpc_msg_id, f"Republishing archived messages failed: 'start_timestamp_ms' and 'end_timestamp_ms' must be within the range of {MIN_ARCHIVE_TIMESTAMP_MS} and {MAX_ARCHIVE_TIMESTAMP_MS}")
+
+    rejection = ArchiveRepublisher().start(rpc_msg_id, start_timestamp_ms, end_timestamp_ms)
+    if rejection is not None:
+        return send_rpc_method_error(rpc_msg_id, f"Republishing archived messages failed: {rejection}")
+    job = ArchiveRepublisher().status() or {}
+    info(f"[RPC] Republishing messages - {start_timestamp_ms} -> {end_timestamp_ms}")
+    send_rpc_response(rpc_msg_id, f"OK - Republishing {job.get('total_count')} messages in the background as job {rpc_msg_id} - {start_timestamp_ms} -> {end_timestamp_ms}")
+    return None
+
+
+def rpc_archive_republish_status(rpc_msg_id: str, _method: Any, _params: Any):
+    send_rpc_response(rpc_msg_id, ArchiveRepublisher().status())
+
+
+def rpc_archive_republish_cancel(rpc_msg_id: str, _method: Any, _params: Any):
+    job = ArchiveRepublisher().cancel()
+    if job is None:
+        return send_rpc_method_error(rpc_msg_id, "Cancelling republish failed: no republish job running")
+    info(f"[RPC] Cancelling republish job {job['rpc_msg_id']}")
+    send_rpc_response(rpc_msg_id, f"OK - Cancelling republish job {job['rpc_msg_id']} after {job['republished_count']}/{job['total_count']} messages")
+    return None
+
+
+def rpc_archive_query(rpc_msg_id: str, _method: Any, params: Any):
+    params_verify_err = verify_start_end_timestamp_params(params)
+    if params_verify_err is not None:
+        return send_rpc_method_error(rpc_msg_id, f"Querying archive failed: {params_verify_err}")
+    if type(params.get("field")) is not str or not re.fullmatch(r"[A-Za-z0-9_]+", params["field"]):
+        return send_rpc_method_error(rpc_msg_id, "Querying archive failed: 'field' must be a telemetry key")
+    if "bucket_ms" not in params:
+        return send_rpc_method_error(rpc_msg_id, "Querying archive failed: missing 'bucket_ms' in params")
+    params_verify_err = verify_int_param(params, "bucket_ms", 1000)
+    if params_verify_err is not None:
+        return send_rpc_method_error(rpc_msg_id, f"Querying archive failed: {params_verify_err}")
+
+    start_timestamp_ms = params["start_timestamp_ms"]
+    end_timestamp_ms = params["end_timestamp_ms"]
+    field = params["field"]
+    bucket_ms = params["bucket_ms"]
+    if start_timestamp_ms <= MIN_ARCHIVE_TIMESTAMP_MS or end_timestamp_ms >= MAX_ARCHIVE_TIMESTAMP_MS:
+        return send_rpc_method_error(rpc_msg_id, f"Querying archive failed: 'start_timestamp_ms' and 'end_timestamp_ms' must be within the range of {MIN_ARCHIVE_TIMESTAMP_MS} and {MAX_ARCHIVE_TIMESTAMP_MS}")
+    if end_timestamp_ms - start_timestamp_ms > ARCHIVE_QUERY_MAX_SPAN_MS:
+        return send_rpc_method_error(rpc_msg_id, f"Querying archive failed: time range longer than {ARCHIVE_QUERY_MAX_SPAN_MS}ms")
+    if (end_timestamp_ms - start_timestamp_ms) / bucket_ms > ARCHIVE_QUERY_MAX_BUCKETS:
+        return send_rpc_method_error(rpc_msg_id, f"Querying archive failed: more than {ARCHIVE_QUERY_MAX_BUCKETS} buckets, increase 'bucket_ms'")
 
     archive_sqlite_db = sqlite.SqliteConnection(utils.paths.GATEWAY_ARCHIVE_DB_PATH)
     if archive_sqlite_db.db_unavailable:
-        return send_rpc_method_error(rpc_msg_id, "Republishing archived messages failed: archive database unavailable")
+        return send_rpc_method_error(rpc_msg_id, "Querying archive failed: archive database unavailable")
 
-    info(f"[RPC] Republishing messages - {start_timestamp_ms} -> {end_timestamp_ms}")
-    message_count = 0
-    while start_timestamp_ms < end_timestamp_ms:
-        messages = archive_sqlite_db.execute("""SELECT id, timestamp_ms, message 
-            FROM controller_archive 
-            WHERE timestamp_ms > ? AND timestamp_ms < ? 
-            ORDER BY timestamp_ms ASC LIMIT 200""",
-            (start_timestamp_ms, end_timestamp_ms)
-        )
-        for message in messages:
-            message_count += 1
-            debug(f"Republishing message with timestamp {message[1]}")
-            GatewayMqttClient().publish_telemetry(json.dumps({"ts": message[1], "values": json.loads(message[2])}))
-            start_timestamp_ms = message[1]
-        if len(messages) < 200:
-            break
+    info(f"[RPC] Querying archive - {field} per {bucket_ms}ms - {start_timestamp_ms} -> {end_timestamp_ms}")
+    buckets = query_archive_buckets(archive_sqlite_db, start_timestamp_ms, end_timestamp_ms, field, bucket_ms)
     archive_sqlite_db.close()
-    send_rpc_response(rpc_msg_id, f"OK - {message_count} messages republished - {start_timestamp_ms} -> {end_timestamp_ms}")
+    send_rpc_response(rpc_msg_id, {
+        "field": field,
+        "bucket_ms": bucket_ms,
+        "columns": ["ts", "min", "mean", "max", "count"],
+        "rows": [[bucket, round(min_value, 4), round(mean_value, 4), round(max_value, 4), count]
+                 for bucket, min_value, mean_value, max_value, count in buckets],
+    })
     return None
 
 
@@ -192,17 +372,18 @@ def rpc_archive_discard_messages(rpc_msg_id: str, _method: Any, params: Any):
 
     start_timestamp_ms = params["start_timestamp_ms"]
     end_timestamp_ms = params["end_timestamp_ms"]
-    if end_timestamp_ms >= 2524637869_000:
-        return send_rpc_method_error(rpc_msg_id, "Discarding archived messages failed: 'end_timestamp_ms' must be < 2524637869_000")
+    if end_timestamp_ms >= MAX_ARCHIVE_TIMESTAMP_MS:
+        return send_rpc_method_error(rpc_msg_id, f"Discarding archived messages failed: 'end_timestamp_ms' must be < {MAX_ARCHIVE_TIMESTAMP_MS}")
 
     archive_sqlite_db = sqlite.SqliteConnection(utils.paths.GATEWAY_ARCHIVE_DB_PATH)
     if archive_sqlite_db.db_unavailable:
         return send_rpc_method_error(rpc_msg_id, "Discarding archived messages failed: archive database unavailable")
 
     info(f"[RPC] Discarding archived messages - {start_timestamp_ms} -> {end_timestamp_ms}")
-    message_count = archive_sqlite_db.execute("DELETE FROM controller_archive WHERE timestamp_ms > ? AND timestamp_ms < ?",
-                                              (start_timestamp_ms, end_timestamp_ms))
+    message_count = discard_archive_messages(archive_sqlite_db, start_timestamp_ms, end_timestamp_ms)
     archive_sqlite_db.close()
+    if message_count is None:
+        return send_rpc_method_error(rpc_msg_id, "Discarding archived messages failed: deleting the messages failed, retry the request")
     send_rpc_response(rpc_msg_id, f"OK - {message_count} messages discarded - {start_timestamp_ms} -> {end_timestamp_ms}")
     return None
 
@@ -222,7 +403,18 @@ RPC_METHODS = {
     },
     "ping": {
         "description": "Ping the device (returns 'pong' reply)",
-        "exec": rpc_ping
+        "exec": rpc_ping,
+        "max_concurrent": RPC_WORKERS
+    },
+    "cancel": {
+        "description": "Cancel a queued or running request ({rpc_msg_id: str})",
+        "exec": rpc_cancel,
+        "inline": True
+    },
+    "jobs": {
+        "description": "List the queued and running requests",
+        "exec": rpc_jobs,
+        "inline": True
     },
     "init_files": {
         "description": "Initialize file-related client attributes (FILE_HASHES, FILE_READ_*)",
@@ -232,14 +424,31 @@ RPC_METHODS = {
         "description": "Restart the controller docker container",
         "exec": rpc_restart_controller
     },
+    "rollback_controller": {
+        "description": "Restart the previous controller version from its cached image, without rebuilding",
+        "exec": rpc_rollback_controller
+    },
     "run_command": {
-        "description": "Run arbitrary command ({command: list [str], timeout_s: int [default 30s]}) - use with caution!",
-        "exec": rpc_run_command
+        "description": "Run arbitrary command ({command: list [str], timeout_s: int [default 30s], chunk_bytes: int, chunk_interval_s: int, max_output_bytes: int}), output is streamed as run_command_output telemetry - use with caution!",
+        "exec": rpc_run_command,
+        "max_concurrent": 2
     },
     "archive_republish_messages": {
-        "description": "Republish messages from archive ({start_timestamp_ms: int, end_timestamp_ms: int})",
+        "description": "Republish messages from archive in the background ({start_timestamp_ms: int, end_timestamp_ms: int})",
         "exec": rpc_archive_republish_messages
     },
+    "archive_republish_status": {
+        "description": "Get the progress of the running republish job",
+        "exec": rpc_archive_republish_status
+    },
+    "archive_republish_cancel": {
+        "description": "Cancel the running republish job",
+        "exec": rpc_archive_republish_cancel
+    },
+    "archive_query": {
+        "description": "Get min/mean/max/count of a field per time bucket from archive ({start_timestamp_ms: int, end_timestamp_ms: int, field: str, bucket_ms: int})",
+        "exec": rpc_archive_query
+    },
     "archive_discard_messages": {
         "description": "Discard messages from archive ({start_timestamp_ms: int, end_timestamp_ms: int})",
         "exec": rpc_archive_discard_messages
@@ -247,16 +456,28 @@ RPC_METHODS = {
 }
 
 
+def execute_rpc_method(rpc_msg_id: str, method: str, params: Any) -> None:
+    try:
+        RPC_METHODS[method]["exec"](rpc_msg_id, method, params) # type: ignore[operator]
+    except Exception as e:
+        error(f"Error executing RPC method '{method}': {e}")
+        GatewayMqttClient().publish_log("ERROR", f"Error executing RPC method '{method}': {e}")
+        send_rpc_response(rpc_msg_id, f"Error executing RPC method '{method}': {e}")
+
+
 def on_rpc_request(rpc_msg_id: str, method: str, params: Any) -> None:
-    """Handle incoming RPC requests"""
+    """Handle incoming RPC requests. Methods run on the RPC worker pool, at most `max_concurrent` (default 1)
+    at a time per method, except for the `inline` ones."""
     info(f"RPC request: {rpc_msg_id} {method} ({params})")
     if method in RPC_METHODS:
-        try:
-            RPC_METHODS[method]["exec"](rpc_msg_id, method, params) # type: ignore[operator]
-        except Exception as e:
-            error(f"Error executing RPC method '{method}': {e}")
-            GatewayMqttClient().publish_log("ERROR", f"Error executing RPC method '{method}': {e}")
-            send_rpc_response(rpc_msg_id, f"Error executing RPC method '{method}': {e}")
+        if RPC_METHODS[method].get("inline"):
+            execute_rpc_method(rpc_msg_id, method, params)
+            return
+        rejection = get_rpc_worker_pool().submit(
+            rpc_msg_id, method, lambda: execute_rpc_method(rpc_msg_id, method, params),
+            int(RPC_METHODS[method].get("max_concurrent", 1))) # type: ignore[call-overload]
+        if rejection is not None:
+            send_rpc_method_error(rpc_msg_id, f"RPC method '{method}' rejected: {rejection}")
     elif method == "list":
         help_text = ["Available RPC methods:"]
         for method_name, method_data in RPC_METHODS.items():
@@ -15,14 +15,17 @@ def restart_controller_if_needed():
     if int(time_ns() / 1_000_000) - last_container_restart_ts > container_restart_delay_ms:
         last_container_restart_ts = int(time_ns() / 1_000_000)
         docker_client = GatewayDockerClient()
+        # an update stops and starts the controller itself
+        if docker_client.is_update_in_progress():
+            return False
         if not docker_client.is_controller_running():
             container_restart_delay_ms *= CONTAINER_RESTART_EXPONENTIAL_BACKOFF_FACTOR
-            info("Controller is not running, starting new container in 10s...")
+            info("Controller is not running, starting new container...")
             info("New controller restart exponential backoff: " + str(container_restart_delay_ms) + "ms")
-            sleep(10)
             last_launched_version = docker_client.get_last_launched_controller_version()
             if last_launched_version is not None:
-                docker_client.start_controller_safely(last_launched_version)
+                # started by the update thread, so the main loop keeps forwarding messages meanwhile
+                docker_client.start_controller_in_background(last_launched_version)
                 return True
             else:
                 error("Failed to determine last launched controller version, unable to start new container...")
@@ -0,0 +1,112 @@
+import base64
+from hashlib import md5
+from typing import BinaryIO
+
+# signatures are computed for blocks of at least this size, larger files use larger blocks
+MIN_BLOCK_SIZE = 4096
+MAX_SIGNATURE_BLOCKS = 1000
+WEAK_CHECKSUM_MODULUS = 1 << 16
+
+
+def get_block_size(file_size: int) -> int:
+    """Power of two block size, so the signature of a file has at most `MAX_SIGNATURE_BLOCKS` blocks"""
+    block_size = MIN_BLOCK_SIZE
+    while file_size > block_size * MAX_SIGNATURE_BLOCKS:
+        block_size *= 2
+    return block_size
+
+
+def weak_checksum(data: bytes) -> tuple[int, int]:
+    """rsync's rolling checksum of a block as (a, b)"""
+    a = sum(data) % WEAK_CHECKSUM_MODULUS
+    b = sum((len(data) - i) * byte for i, byte in enumerate(data)) % WEAK_CHECKSUM_MODULUS
+    return a, b
+
+
+def roll_checksum(a: int, b: int, out_byte: int, in_byte: int, block_size: int) -> tuple[int, int]:
+    """Moves the window of a weak checksum by one byte"""
+    a = (a - out_byte + in_byte) % WEAK_CHECKSUM_MODULUS
+    b = (b - block_size * out_byte + a) % WEAK_CHECKSUM_MODULUS
+    return a, b
+
+
+def strong_checksum(data: bytes) -> str:
+    return md5(data).hexdigest()
+
+
+def block_signatures(content: bytes, block_size: int) -> list[list]:
+    """[weak checksum, strong checksum] of each block of the content"""
+    signatures = []
+    for offset in range(0, len(content), block_size):
+        block = content[offset:offset + block_size]
+        a, b = weak_checksum(block)
+        signatures.append([a | (b << 16), strong_checksum(block)])
+    return signatures
+
+
+def compute_delta(signatures: list[list], block_size: int, content: bytes) -> list[list]:
+    """Sender side: encodes the content as ["copy", first block, number of blocks] operations for blocks
+    of the receiver's file that match the signatures and ["data", base64] operations for everything else"""
+    blocks_by_weak: dict[int, list[tuple[int, str]]] = {}
+    for index, (weak, strong) in enumerate(signatures):
+        blocks_by_weak.setdefault(weak, []).append((index, strong))
+
+    ops: list[list] = []
+    literal_start = 0
+
+    def add_copy(index: int) -> None:
+        if len(ops) > 0 and ops[-1][0] == "copy" and ops[-1][1] + ops[-1][2] == index:
+            ops[-1][2] += 1
+        else:
+            ops.append(["copy", index, 1])
+
+    offset = 0
+    a, b = weak_checksum(content[:block_size])
+    while offset + block_size <= len(content):
+        match = None
+        for index, strong in blocks_by_weak.get(a | (b << 16), []):
+            if strong == strong_checksum(content[offset:offset + block_size]):
+                match = index
+                break
+        if match is not None:
+            if literal_start < offset:
+                ops.append(["data", base64.b64encode(content[literal_start:offset]).decode()])
+            add_copy(match)
+            offset += block_size
+            literal_start = offset
+            a, b = weak_checksum(content[offset:offset + block_size])
+            continue
+        if offset + block_size < len(content):
+            a, b = roll_checksum(a, b, content[offset], content[offset + block_size], block_size)
+        offset += 1
+
+    # the last, shorter block of the receiver's file only matches the end of the content
+    if literal_start < len(content) and len(signatures) > 0:
+        tail = content[max(literal_start, len(content) - block_size):]
+        weak, strong = signatures[-1]
+        if len(tail) < block_size and strong == strong_checksum(tail):
+            if literal_start < len(content) - len(tail):
+                ops.append(["data", base64.b64encode(content[literal_start:len(content) - len(tail)]).decode()])
+            add_copy(len(signatures) - 1)
+            literal_start = len(content)
+    if literal_start < len(content):
+        ops.append(["data", base64.b64encode(content[literal_start:]).decode()])
+    return ops
+
+
+def apply_delta(base: BinaryIO, ops: list[list], block_size: int, target: BinaryIO) -> None:
+    """Receiver side: writes the content encoded by `ops` to `target`, copying blocks from `base`"""
+    for op in ops:
+        if op[0] == "copy":
+            base.seek(op[1] * block_size)
+            remaining = op[2] * block_size
+            while remaining > 0:
+                chunk = base.read(min(remaining, 1024 * 1024))
+                if len(chunk) == 0:
+                    break
+                target.write(chunk)
+                remaining -= len(chunk)
+        elif op[0] == "data":
+            target.write(base64.b64decode(op[1]))
+        else:
+            raise ValueError(f"Unknown delta operation: {op[0]}")
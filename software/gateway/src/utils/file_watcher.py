@@ -0,0 +1,108 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from typing import Callable, Optional
+
+from modules.logging import error, warn
+
+# inotify event masks (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000  # the watch was removed, e.g. because the directory was deleted
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+# the watched files are checked in this interval even without events (e.g. if inotify is unavailable)
+RESCAN_INTERVAL_SECONDS = 30
+# events within this time after the first one are handled together
+DEBOUNCE_SECONDS = 0.5
+
+
+class FileWatcher(threading.Thread):
+    """Calls `on_change` when one of the files returned by `get_paths` is written, created, moved or deleted,
+    using inotify on the parent directories. Also calls it every `RESCAN_INTERVAL_SECONDS`, so missed events
+    are reconciled. Falls back to the periodic call only if inotify is not available."""
+
+    def __init__(self, get_paths: Callable[[], set[str]], on_change: Callable[[], None]) -> None:
+        super().__init__(daemon=True)
+        self.get_paths = get_paths
+        self.on_change = on_change
+        self.paths: set[str] = set()
+        self.watched_dirs: dict[int, str] = {}  # watch descriptor -> directory
+        self.refresh_read_fd, self.refresh_write_fd = os.pipe()
+        self.libc: Optional[ctypes.CDLL] = None
+        self.inotify_fd = -1
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.inotify_fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            pass
+        if self.inotify_fd < 0:
+            warn("[FILE-WATCHER] inotify is not available, checking files periodically")
+
+    def refresh(self) -> None:
+        """Updates the watches to the current paths, thread-safe"""
+        os.write(self.refresh_write_fd, b"\0")
+
+    def __update_watches(self) -> None:
+        self.paths = self.get_paths()
+        if self.libc is None or self.inotify_fd < 0:
+            return
+        directories = {os.path.dirname(path) for path in self.paths}
+        # remove the watches of directories without watched files, they only cause wakeups
+        for wd, directory in list(self.watched_dirs.items()):
+            if directory not in directories:
+                self.libc.inotify_rm_watch(self.inotify_fd, wd)
+                del self.watched_dirs[wd]
+        watched = set(self.watched_dirs.values())
+        for directory in directories - watched:
+            # returns the existing watch descriptor if the directory is already watched
+            wd = self.libc.inotify_add_watch(self.inotify_fd, directory.encode(), WATCH_MASK)
+            if wd >= 0:
+                self.watched_dirs[wd] = directory
+
+    def __read_events(self) -> bool:
+        """Returns True if a watched file changed"""
+        changed = False
+        while True:
+            try:
+                buffer = os.read(self.inotify_fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _cookie, name_length = INOTIFY_EVENT_HEADER.unpack_from(buffer, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                name = buffer[offset:offset + name_length].rstrip(b"\0").decode(errors="replace")
+                offset += name_length
+                if mask & IN_IGNORED:
+                    self.watched_dirs.pop(wd, None)
+                    continue
+                if mask & IN_Q_OVERFLOW or os.path.join(self.watched_dirs.get(wd, ""), name) in self.paths:
+                    changed = True
+
+    def run(self) -> None:
+        self.__update_watches()
+        fds = [self.refresh_read_fd] + ([self.inotify_fd] if self.inotify_fd >= 0 else [])
+        while True:
+            ready, _, _ = select.select(fds, [], [], RESCAN_INTERVAL_SECONDS)
+            changed = len(ready) == 0
+            if self.refresh_read_fd in ready:
+                os.read(self.refresh_read_fd, 4096)
+                self.__update_watches()
+            if self.inotify_fd in ready:
+                time.sleep(DEBOUNCE_SECONDS)
+                changed = self.__read_events() or changed
+            if changed:
+                try:
+                    self.on_change()
+                except Exception as e:
+                    error(f"[FILE-WATCHER] Error handling file changes: {e}")
@@ -15,6 +15,11 @@ GATEWAY_LOGS_BUFFER_DB_PATH = join(str(GATEWAY_DATA_PATH), GATEWAY_LOGS_BUFFER_D
 
 GATEWAY_ARCHIVE_DB_NAME = "gateway_archive.db"
 GATEWAY_ARCHIVE_DB_PATH = join(str(GATEWAY_DATA_PATH), GATEWAY_ARCHIVE_DB_NAME)
+# archive partitions, one db file per month or day
+GATEWAY_ARCHIVE_PARTITIONS_PATH = join(str(GATEWAY_DATA_PATH), "gateway_archive")
+
+# staging directory of chunked file content transfers
+FILE_TRANSFERS_PATH = join(str(GATEWAY_DATA_PATH), "file_transfers")
 
 COMMUNICATION_QUEUE_DB_NAME = "communication_queue.db"
 COMMUNICATION_QUEUE_DB_PATH = join(str(CONTROLLER_DATA_PATH), COMMUNICATION_QUEUE_DB_NAME)
@@ -29,4 +34,6 @@ debug(f'CONTROLLER_GIT_PATH: {CONTROLLER_GIT_PATH}')
 
 debug(f'GATEWAY_LOGS_BUFFER_DB_PATH: {GATEWAY_LOGS_BUFFER_DB_PATH}')
 debug(f'GATEWAY_ARCHIVE_DB_PATH: {GATEWAY_ARCHIVE_DB_PATH}')
-debug(f'COMMUNICATION_QUEUE_DB_PATH: {COMMUNICATION_QUEUE_DB_PATH}')
\ No newline at end of file
+debug(f'GATEWAY_ARCHIVE_PARTITIONS_PATH: {GATEWAY_ARCHIVE_PARTITIONS_PATH}')
+debug(f'COMMUNICATION_QUEUE_DB_PATH: {COMMUNICATION_QUEUE_DB_PATH}')
+debug(f'FILE_TRANSFERS_PATH: {FILE_TRANSFERS_PATH}')
\ No newline at end of file
@@ -0,0 +1,72 @@
+import os
+from collections import deque
+from typing import Optional
+
+PUBLISH_WINDOW_MIN = 1
+PUBLISH_WINDOW_MAX = int(os.environ.get("ACROPOLIS_PUBLISH_WINDOW_MAX") or 32)
+PUBLISH_WINDOW_INITIAL = 4
+# number of recent round trip times of which the minimum is the base RTT
+BASE_RTT_SAMPLES = 100
+
+
+class AdaptivePublishWindow:
+    """Sliding window of unacknowledged QoS 1 publishes, keyed by mid.
+
+    The window size adapts to the measured round trip time like TCP Vegas: the number of publishes queued
+    on the path is estimated as `window * (1 - base_rtt / smoothed_rtt)`. The window grows by one per RTT
+    while less than one publish is queued and shrinks while more than three are queued. Ack timeouts
+    halve the window."""
+
+    def __init__(self) -> None:
+        self.size = float(PUBLISH_WINDOW_INITIAL)
+        self.in_flight: dict[int, float] = {}  # mid -> monotonic send time
+        self.recent_rtts: deque[float] = deque(maxlen=BASE_RTT_SAMPLES)
+        self.smoothed_rtt: Optional[float] = None
+        self.acked_count = 0
+        self.timeout_count = 0
+
+    def is_full(self) -> bool:
+        return len(self.in_flight) >= int(self.size)
+
+    def on_send(self, mid: int, send_time: float) -> None:
+        self.in_flight[mid] = send_time
+
+    def on_ack(self, mid: int, ack_time: float) -> bool:
+        """Returns False if the mid is not in flight (e.g. a QoS 0 publish or a publish that timed out)"""
+        send_time = self.in_flight.pop(mid, None)
+        if send_time is None:
+            return False
+        self.acked_count += 1
+
+        rtt = max(ack_time - send_time, 1e-6)
+        self.recent_rtts.append(rtt)
+        self.smoothed_rtt = rtt if self.smoothed_rtt is None else 0.875 * self.smoothed_rtt + 0.125 * rtt
+        queued = self.size * (1 - min(self.recent_rtts) / self.smoothed_rtt)
+        if queued < 1:
+            self.size = min(self.size + 1 / self.size, PUBLISH_WINDOW_MAX)
+        elif queued > 3:
+            self.size = max(self.size - 1 / self.size, PUBLISH_WINDOW_MIN)
+        return True
+
+    def forget(self, mid: int) -> None:
+        self.in_flight.pop(mid, None)
+
+    def expire(self, now: float, timeout: float) -> list[int]:
+        """Removes and returns the mids which have not been acknowledged within `timeout` seconds"""
+        expired = [mid for mid, send_time in self.in_flight.items() if now - send_time > timeout]
+        if len(expired) > 0:
+            for mid in expired:
+                del self.in_flight[mid]
+            self.timeout_count += len(expired)
+            self.size = max(self.size / 2, PUBLISH_WINDOW_MIN)
+        return expired
+
+    def stats(self) -> dict:
+        return {
+            "mqtt_publish_window": int(self.size),
+            "mqtt_publishes_in_flight": len(self.in_flight),
+            "mqtt_smoothed_rtt_ms": round(self.smoothed_rtt * 1000) if self.smoothed_rtt is not None else None,
+            "mqtt_base_rtt_ms": round(min(self.recent_rtts) * 1000) if len(self.recent_rtts) > 0 else None,
+            "mqtt_acked_publishes": self.acked_count,
+            "mqtt_ack_timeouts": self.timeout_count,
+        }
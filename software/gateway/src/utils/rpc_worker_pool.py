@@ -0,0 +1,78 @@
+import queue
+import threading
+from typing import Callable, Optional
+
+
+class RpcJob:
+    def __init__(self, rpc_msg_id: str, method: str, run: Callable[[], None]) -> None:
+        self.rpc_msg_id = rpc_msg_id
+        self.method = method
+        self.run = run
+        self.started = False
+        self.cancel_event = threading.Event()
+
+
+class RpcWorkerPool:
+    """Runs RPC handlers on a fixed number of daemon threads, so slow handlers don't block the main loop.
+
+    At most `max_queued` jobs wait for a worker, and at most `max_concurrent` jobs of a method are queued or
+    running at the same time. Jobs are cancelled by setting their cancel event: jobs that did not start yet
+    are dropped, running handlers are expected to check `is_cancelled` and stop early."""
+
+    def __init__(self, workers: int, max_queued: int) -> None:
+        self.jobs_queue: queue.Queue[RpcJob] = queue.Queue(maxsize=max_queued)
+        self.jobs: dict[str, RpcJob] = {}  # queued and running jobs by rpc message id
+        self.lock = threading.Lock()
+        for n in range(workers):
+            threading.Thread(target=self.__work, name=f"rpc-worker-{n}", daemon=True).start()
+
+    def submit(self, rpc_msg_id: str, method: str, run: Callable[[], None], max_concurrent: int) -> Optional[str]:
+        """Queues the job, returns the reason if it is rejected"""
+        with self.lock:
+            if rpc_msg_id in self.jobs:
+                return f"request {rpc_msg_id} is already running"
+            if sum(1 for job in self.jobs.values() if job.method == method) >= max_concurrent:
+                return f"'{method}' is already running {max_concurrent} time(s)"
+            job = RpcJob(rpc_msg_id, method, run)
+            try:
+                self.jobs_queue.put_nowait(job)
+            except queue.Full:
+                return "too many queued requests"
+            self.jobs[rpc_msg_id] = job
+        return None
+
+    def cancel(self, rpc_msg_id: str) -> Optional[bool]:
+        """Returns None if the job is unknown, False if it is queued and dropped, True if it is running"""
+        with self.lock:
+            job = self.jobs.get(rpc_msg_id)
+            if job is None:
+                return None
+            job.cancel_event.set()
+            if not job.started:
+                del self.jobs[rpc_msg_id]
+            return job.started
+
+    def is_cancelled(self, rpc_msg_id: str) -> bool:
+        with self.lock:
+            job = self.jobs.get(rpc_msg_id)
+        return job is not None and job.cancel_event.is_set()
+
+    def running_jobs(self) -> list[tuple[str, str, bool]]:
+        """(rpc message id, method, started) of the queued and running jobs"""
+        with self.lock:
+            return [(job.rpc_msg_id, job.method, job.started) for job in self.jobs.values()]
+
+    def __work(self) -> None:
+        while True:
+            job = self.jobs_queue.get()
+            with self.lock:
+                if job.cancel_event.is_set():
+                    continue
+                job.started = True
+            try:
+                job.run()
+            except Exception as e:
+                print(f"[RPC-WORKER] Unhandled error in RPC '{job.method}': {e}")
+            finally:
+                with self.lock:
+                    self.jobs.pop(job.rpc_msg_id, None)
@@ -0,0 +1,34 @@
+import threading
+import time
+from typing import Optional
+
+# The gateway side of the timestamp parity rule, documented with the
+# allocator in software/controller/src/utils/timestamps.py: the gateway only
+# publishes odd timestamps, the controller only even ones.
+TIMESTAMP_STRIDE = 2
+GATEWAY_TIMESTAMP_OFFSET = 1
+
+
+def now_ms() -> int:
+    return int(time.time_ns() / 1_000_000)
+
+
+class TimestampAllocator:
+    """Unique, monotonically increasing odd millisecond timestamps per series. Thread-safe."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.last_timestamps_ms: dict[str, int] = {}
+
+    def allocate(self, series: str, timestamp_ms: Optional[int] = None) -> int:
+        if timestamp_ms is None:
+            timestamp_ms = now_ms()
+        with self.lock:
+            ts = max(timestamp_ms, self.last_timestamps_ms.get(series, 0) + 1)
+            ts += (GATEWAY_TIMESTAMP_OFFSET - ts) % TIMESTAMP_STRIDE
+            self.last_timestamps_ms[series] = ts
+            return ts
+
+
+# allocator shared by all gateway modules publishing telemetry
+timestamp_allocator = TimestampAllocator()
@@ -0,0 +1,46 @@
+import sqlite3
+import threading
+from time import sleep
+from typing import Optional
+
+# interval in which the communication queue db is checked for commits of the controller
+DATA_VERSION_CHECK_INTERVAL_SECONDS = 0.2
+
+wakeup_event = threading.Event()
+
+
+def wake_up() -> None:
+    """Wakes up the gateway main loop, thread-safe"""
+    wakeup_event.set()
+
+
+def wait_for_wakeup(timeout: Optional[float]) -> bool:
+    """Blocks until `wake_up` is called or the timeout expires. Returns False on timeout."""
+    woken_up = wakeup_event.wait(timeout)
+    wakeup_event.clear()
+    return woken_up
+
+
+class DataVersionWatcher(threading.Thread):
+    """Wakes up the main loop when another connection commits to the sqlite db at `path`.
+
+    `PRAGMA data_version` only changes for commits of other connections and is answered from the
+    WAL index in shared memory, so checking it does not touch the db file."""
+
+    def __init__(self, path: str) -> None:
+        super().__init__(daemon=True)
+        self.path = path
+
+    def run(self) -> None:
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        data_version = None
+        while True:
+            try:
+                current_data_version = conn.execute("PRAGMA data_version;").fetchone()[0]
+            except sqlite3.Error as e:
+                print(f'[WAKEUP] Failed to read data_version of "{self.path}": {e}')
+                current_data_version = None
+            if current_data_version != data_version:
+                data_version = current_data_version
+                wake_up()
+            sleep(DATA_VERSION_CHECK_INTERVAL_SECONDS)
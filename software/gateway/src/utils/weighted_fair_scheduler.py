@@ -0,0 +1,28 @@
+from typing import Any, Iterable, Mapping, Optional
+
+
+class WeightedFairScheduler:
+    """Smooth weighted round robin over a fixed set of lanes.
+
+    Each call to `next_lane` picks one of the given non-empty lanes, so empty
+    lanes do not take up any share. Over time every busy lane is picked
+    proportionally to its weight, and picks of a lane are spread evenly
+    (weights 4:2:1 yield A B A C A B A instead of A A A A B B C)."""
+
+    def __init__(self, weights: Mapping[Any, int]) -> None:
+        assert all(weight > 0 for weight in weights.values())
+        self.weights = weights
+        self.current_weights: dict[Any, int] = {lane: 0 for lane in weights}
+
+    def next_lane(self, non_empty_lanes: Iterable[Any]) -> Optional[Any]:
+        candidates = [lane for lane in non_empty_lanes if lane in self.weights]
+        if len(candidates) == 0:
+            return None
+
+        total_weight = 0
+        for lane in candidates:
+            self.current_weights[lane] += self.weights[lane]
+            total_weight += self.weights[lane]
+        selected = max(candidates, key=lambda lane: self.current_weights[lane])
+        self.current_weights[selected] -= total_weight
+        return selected
@@ -0,0 +1,37 @@
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+import pytest
+
+# the gateway modules read their paths from the environment when they are imported
+os.environ.setdefault("ACROPOLIS_DATA_PATH", tempfile.mkdtemp(prefix="acropolis-gateway-tests-"))
+os.environ.setdefault("ACROPOLIS_GATEWAY_GIT_PATH", os.path.join(os.environ["ACROPOLIS_DATA_PATH"], ".git"))
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+
+# Fixture to keep the log shipper from publishing or buffering log records of the tests
+@pytest.fixture(autouse=True, scope="session")
+def no_log_shipper():
+    from modules import logging
+    # a thread that is never started counts as running
+    logging.log_shipper_thread = threading.Thread(target=lambda: None)
+    yield
+
+
+# Fixture to create an archive db with its partitions in a temporary directory
+@pytest.fixture
+def archive_db(tmp_path, monkeypatch):
+    from modules import archive, sqlite
+    monkeypatch.setattr(archive, "GATEWAY_ARCHIVE_PARTITIONS_PATH", str(tmp_path / "gateway_archive"))
+    for name, value in [("partition_names", set()), ("partitions", {}), ("partition_watermarks", {}),
+                        ("compacted_partitions", set()), ("chunk_sizes", {}), ("chunk_cache", OrderedDict())]:
+        monkeypatch.setattr(archive, name, value)
+    db = sqlite.SqliteConnection(str(tmp_path / "gateway_archive.db"))
+    archive.init_archive_db(db)
+    yield db
+    for partition in list(archive.partitions.values()):
+        partition.close()
+    db.close()
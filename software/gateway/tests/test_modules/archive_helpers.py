@@ -0,0 +1,46 @@
+import json
+from modules import archive
+
+# 2025-01-31T23:00:00Z, the last hour of the January partition
+JANUARY_END_MS = 1738364400_000
+HOUR_MS = 3600_000
+
+
+def co2_message(value: float) -> str:
+    return json.dumps({column: float(value) for column in archive.ARCHIVE_MESSAGE_TYPES["archive_co2"]})
+
+
+def other_message(value: float) -> str:
+    return json.dumps({"other": float(value)})
+
+
+def archive_hours(hours: range, first_message_id: int = 1) -> list[tuple[int, str]]:
+    """Archives a co2 and an untyped message with the same timestamp every 20 minutes of the hours after
+    JANUARY_END_MS, returns the archived (timestamp_ms, message) rows"""
+    rows = []
+    for hour in hours:
+        for minute in range(0, 60, 20):
+            timestamp_ms = JANUARY_END_MS + hour * HOUR_MS + minute * 60_000
+            rows += [(timestamp_ms, co2_message(timestamp_ms)), (timestamp_ms, other_message(timestamp_ms))]
+    assert archive.archive_messages([(first_message_id + i, timestamp_ms, message)
+                                     for i, (timestamp_ms, message) in enumerate(rows)])
+    return rows
+
+
+def read_all(archive_db, start_timestamp_ms: int, end_timestamp_ms: int, limit: int) -> list[tuple[int, int, str]]:
+    """Reads the archive in pages of `limit` messages"""
+    messages: list[tuple[int, int, str]] = []
+    after_timestamp_ms, after_id = start_timestamp_ms, -1
+    while True:
+        page = archive.read_archive_page(archive_db, end_timestamp_ms, after_timestamp_ms, after_id, limit)
+        messages += page
+        if len(page) < limit:
+            return messages
+        after_id, after_timestamp_ms, _ = page[-1]
+
+
+def compact(db, cutoff_timestamp_ms: int) -> int:
+    compacted = 0
+    while (count := archive._compact(db, cutoff_timestamp_ms)) > 0:
+        compacted += count
+    return compacted
@@ -0,0 +1,68 @@
+import json
+import pytest
+from modules import archive
+from tests.test_modules.archive_helpers import (JANUARY_END_MS, HOUR_MS, co2_message, other_message, archive_hours,
+                                                read_all, compact)
+
+
+@pytest.mark.parametrize("values, table", [
+    ({column: 1.5 for column in archive.ARCHIVE_MESSAGE_TYPES["archive_co2"]}, "archive_co2"),
+    ({**{column: 1.5 for column in archive.ARCHIVE_MESSAGE_TYPES["archive_co2"]}, "gmp343_raw": None},
+     "archive_co2"),
+    # extra or missing keys and values of another kind stay JSON
+    ({**{column: 1.5 for column in archive.ARCHIVE_MESSAGE_TYPES["archive_co2"]}, "other": 1.5},
+     archive.ARCHIVE_TABLE),
+    ({"gmp343_raw": 1.5}, archive.ARCHIVE_TABLE),
+    ({**{column: 1.5 for column in archive.ARCHIVE_MESSAGE_TYPES["archive_co2"]}, "gmp343_raw": 1},
+     archive.ARCHIVE_TABLE),
+    ({**{column: 1.5 for column in archive.ARCHIVE_MESSAGE_TYPES["archive_co2"]}, "gmp343_raw": float("nan")},
+     archive.ARCHIVE_TABLE),
+    ({**{column: 1 for column in archive.ARCHIVE_MESSAGE_TYPES["archive_communication_queue"]},
+      "communication_queue_dropped": True}, archive.ARCHIVE_TABLE),
+])
+def test_route_archive_message(values, table):
+    """Test that only messages which are restored exactly are stored in a typed table."""
+    assert archive.route_archive_message(json.dumps(values))[0] == table
+
+
+def test_typed_messages_are_restored_exactly(archive_db):
+    """Test that messages of the typed tables are read back with their keys, kinds and nulls."""
+    system = {column: True if kind == archive.BOOLEAN else 20.5
+              for column, kind in archive.ARCHIVE_MESSAGE_TYPES["archive_system"].items()}
+    system.update(ups_battery_is_fully_charged=False, ups_battery_error_detected=None)
+    queue = {column: 3 for column in archive.ARCHIVE_MESSAGE_TYPES["archive_communication_queue"]}
+    messages = [json.dumps(system), json.dumps(queue), other_message(1.5), "not json"]
+    assert archive.archive_messages([(n + 1, JANUARY_END_MS, message) for n, message in enumerate(messages)])
+
+    january = archive.partitions["2025-01"]
+    assert january.execute("SELECT COUNT(*) FROM archive_system;") == [(1,)]
+    assert january.execute("SELECT COUNT(*) FROM archive_communication_queue;") == [(1,)]
+    assert january.execute(f"SELECT COUNT(*) FROM {archive.ARCHIVE_TABLE};") == [(2,)]
+    assert january.execute(f"SELECT COUNT(*) FROM {archive.ARCHIVE_VIEW};") == [(4,)]
+    assert sorted(message for _, _, message in read_all(archive_db, 0, archive.MAX_ARCHIVE_TIMESTAMP_MS, 3)) == \
+        sorted(messages)
+
+
+def test_read_archive_page_across_tables_chunks_and_partitions(archive_db):
+    """Test that paginating returns every message once in order, from the tables and chunks of the archive db
+    and of the partitions, including messages sharing a timestamp at a page boundary."""
+    legacy_timestamp_ms = JANUARY_END_MS - 2 * HOUR_MS
+    legacy_rows = [(legacy_timestamp_ms, co2_message(1.5)), (legacy_timestamp_ms, other_message(1.5))]
+    assert archive_db.execute_transaction(archive.archive_insert_queries(legacy_rows))
+    rows = legacy_rows + archive_hours(range(4))
+    assert compact(archive.partitions["2025-01"], JANUARY_END_MS + HOUR_MS) == 6
+    assert compact(archive.partitions["2025-02"], JANUARY_END_MS + 2 * HOUR_MS) == 6
+
+    for limit in [1, 3, 4, 100]:
+        messages = read_all(archive_db, JANUARY_END_MS - 3 * HOUR_MS, archive.MAX_ARCHIVE_TIMESTAMP_MS, limit)
+        # the partitions don't overlap in time, so the pagination keys are unique
+        assert len({(timestamp_ms, archive_id) for archive_id, timestamp_ms, _ in messages}) == len(rows)
+        assert [(timestamp_ms, archive_id) for archive_id, timestamp_ms, _ in messages] == \
+            sorted((timestamp_ms, archive_id) for archive_id, timestamp_ms, _ in messages)
+        assert sorted((timestamp_ms, json.dumps(json.loads(message))) for _, timestamp_ms, message in messages) == \
+            sorted((timestamp_ms, message) for timestamp_ms, message in rows)
+
+    # the time range is exclusive at its end
+    messages = read_all(archive_db, JANUARY_END_MS, JANUARY_END_MS + HOUR_MS, 5)
+    assert [timestamp_ms for _, timestamp_ms, _ in messages] == [
+        timestamp_ms for timestamp_ms, _ in rows if JANUARY_END_MS <= timestamp_ms < JANUARY_END_MS + HOUR_MS]
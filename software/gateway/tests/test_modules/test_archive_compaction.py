@@ -0,0 +1,51 @@
+from modules import archive
+from tests.test_modules.archive_helpers import JANUARY_END_MS, HOUR_MS, archive_hours, read_all, compact
+
+
+def test_compact(archive_db):
+    """Test that compaction moves one hour of a table at a time into a chunk without changing the messages."""
+    archive_hours(range(1))
+    january = archive.partitions["2025-01"]
+    before = read_all(archive_db, 0, archive.MAX_ARCHIVE_TIMESTAMP_MS, 100)
+
+    # messages after the cutoff are kept
+    assert compact(january, JANUARY_END_MS) == 0
+    assert archive._compact(january, JANUARY_END_MS + HOUR_MS) == 3
+    assert archive._compact(january, JANUARY_END_MS + HOUR_MS) == 3
+    assert archive._compact(january, JANUARY_END_MS + HOUR_MS) == 0
+    assert january.execute("SELECT COUNT(*) FROM archive_co2;") == [(0,)]
+    assert january.execute(f"SELECT COUNT(*), SUM(row_count) FROM {archive.ARCHIVE_CHUNKS_TABLE};") == [(2, 6)]
+    assert archive.compaction_counters["archive_compression_ratio"] > 1
+
+    assert read_all(archive_db, 0, archive.MAX_ARCHIVE_TIMESTAMP_MS, 100) == before
+    assert archive.count_archive_messages(archive_db, 0, archive.MAX_ARCHIVE_TIMESTAMP_MS) == len(before)
+
+
+def test_queries_read_the_chunks(archive_db):
+    """Test that counting and aggregating return the same results before and after the compaction."""
+    archive_hours(range(-2, 2))
+    field = next(iter(archive.ARCHIVE_MESSAGE_TYPES["archive_co2"]))
+    start_timestamp_ms, end_timestamp_ms = JANUARY_END_MS - 90 * 60_000, JANUARY_END_MS + 90 * 60_000
+    count = archive.count_archive_messages(archive_db, start_timestamp_ms, end_timestamp_ms)
+    buckets = archive.query_archive_buckets(archive_db, start_timestamp_ms, end_timestamp_ms, field, HOUR_MS)
+    assert [bucket_count for *_, bucket_count in buckets] == [1, 3, 3, 2]
+
+    assert compact(archive.partitions["2025-01"], JANUARY_END_MS + HOUR_MS) == 18
+    assert compact(archive.partitions["2025-02"], JANUARY_END_MS + 2 * HOUR_MS) == 6
+    assert archive.count_archive_messages(archive_db, start_timestamp_ms, end_timestamp_ms) == count
+    assert archive.query_archive_buckets(archive_db, start_timestamp_ms, end_timestamp_ms, field, HOUR_MS) == buckets
+
+
+def test_compact_archive_skips_compacted_partitions(archive_db):
+    """Test that old partitions are compacted one chunk at a time and skipped once fully compacted."""
+    rows = archive_hours(range(2))
+    compacted = 0
+    while (count := archive.compact_archive(archive_db)) > 0:
+        compacted += count
+    assert compacted == len(rows)
+    assert archive.compacted_partitions == {"2025-01", "2025-02"}
+    assert archive.compact_archive(archive_db) == 0
+
+    # dropping a partition forgets that it was compacted
+    archive._drop_partition("2025-02")
+    assert archive.compacted_partitions == {"2025-01"}
@@ -0,0 +1,86 @@
+import os
+import time
+from modules import archive
+from tests.test_modules.archive_helpers import (JANUARY_END_MS, HOUR_MS, co2_message, other_message, archive_hours,
+                                                read_all, compact)
+
+
+def test_archive_messages_once_per_partition(archive_db):
+    """Test that messages are routed to the partition of their month and to the table of their type."""
+    rows = archive_hours(range(3))
+    assert sorted(archive.partition_names) == ["2025-01", "2025-02"]
+    january = archive.partitions["2025-01"]
+    assert january.execute("SELECT COUNT(*) FROM archive_co2;") == [(3,)]
+    assert january.execute(f"SELECT COUNT(*) FROM {archive.ARCHIVE_TABLE};") == [(3,)]
+
+    # retried messages are skipped by the partition watermarks
+    assert archive.archive_messages([(1, rows[0][0], rows[0][1])])
+    assert archive.count_archive_messages(archive_db, 0, archive.MAX_ARCHIVE_TIMESTAMP_MS) == len(rows)
+
+
+def test_partitions_keep_their_granularity(archive_db, monkeypatch):
+    """Test that months with partitions keep their granularity after changing the partition setting, so no
+    partitions overlap and paginating returns every message once."""
+    rows = archive_hours(range(-1, 0))
+    assert sorted(archive.partition_names) == ["2025-01"]
+
+    # the month file of January takes its remaining days, February is split into days
+    monkeypatch.setattr(archive, "ARCHIVE_PARTITION", "day")
+    rows += archive_hours(range(2), 100)
+    assert sorted(archive.partition_names) == ["2025-01", "2025-02-01"]
+
+    # February keeps its day files, April gets a month file
+    monkeypatch.setattr(archive, "ARCHIVE_PARTITION", "month")
+    rows += archive_hours(range(24 * 10, 24 * 10 + 1), 200)
+    rows += archive_hours(range(24 * 59 + 1, 24 * 59 + 2), 300)
+    assert sorted(archive.partition_names) == ["2025-01", "2025-02-01", "2025-02-10", "2025-04"]
+
+    messages = read_all(archive_db, 0, archive.MAX_ARCHIVE_TIMESTAMP_MS, 4)
+    assert len({(timestamp_ms, archive_id) for archive_id, timestamp_ms, _ in messages}) == len(rows)
+
+
+def test_discard(archive_db):
+    """Test that discarding deletes the partitions within the range, the rows and chunks within the range
+    and rewrites the chunks overlapping its bounds."""
+    legacy_rows = [(JANUARY_END_MS - HOUR_MS, co2_message(1.5))]
+    assert archive_db.execute_transaction(archive.archive_insert_queries(legacy_rows))
+    rows = legacy_rows + archive_hours(range(-1, 2)) + archive_hours(range(24 * 28 + 1, 24 * 28 + 2), 100)
+    assert sorted(archive.partition_names) == ["2025-01", "2025-02", "2025-03"]
+    compact(archive.partitions["2025-01"], JANUARY_END_MS + HOUR_MS)
+
+    # from within the last hour of January to the start of March
+    start_timestamp_ms, end_timestamp_ms = JANUARY_END_MS + 30 * 60_000, JANUARY_END_MS + (24 * 28 + 1) * HOUR_MS
+    expected = archive.count_archive_messages(archive_db, start_timestamp_ms, end_timestamp_ms)
+    assert expected == 2 + 6
+    february_path = archive._partition_path("2025-02")
+    assert os.path.exists(february_path)
+
+    assert archive.discard_archive_messages(archive_db, start_timestamp_ms, end_timestamp_ms) == expected
+    assert not os.path.exists(february_path)
+    assert sorted(archive.partition_names) == ["2025-01", "2025-03"]
+    assert archive.count_archive_messages(archive_db, start_timestamp_ms, end_timestamp_ms) == 0
+    remaining = read_all(archive_db, 0, archive.MAX_ARCHIVE_TIMESTAMP_MS, 100)
+    assert sorted(timestamp_ms for _, timestamp_ms, _ in remaining) == sorted(
+        timestamp_ms for timestamp_ms, _ in rows if not start_timestamp_ms < timestamp_ms < end_timestamp_ms)
+
+    # a discarded partition is recreated for new messages
+    assert archive.archive_messages([(200, JANUARY_END_MS + 2 * HOUR_MS, other_message(2.5))])
+    assert "2025-02" in archive.partition_names
+
+
+def test_drop_expired_partitions(archive_db, monkeypatch):
+    """Test that only partitions which ended more than the retention ago are deleted."""
+    archive_hours(range(2))
+    now_ms = int(time.time() * 1000)
+    assert archive.archive_messages([(100, now_ms, other_message(1.5))])
+    current = archive._partition_name(now_ms)
+    assert archive.drop_expired_partitions() == 0
+
+    monkeypatch.setattr(archive, "ARCHIVE_RETENTION_MS", now_ms - (JANUARY_END_MS + 2 * HOUR_MS))
+    assert archive.drop_expired_partitions() == 1
+    assert sorted(archive.partition_names) == ["2025-02", current]
+    assert not os.path.exists(archive._partition_path("2025-01"))
+
+    monkeypatch.setattr(archive, "ARCHIVE_RETENTION_MS", 1)
+    assert archive.drop_expired_partitions() == 1
+    assert archive.partition_names == {current}
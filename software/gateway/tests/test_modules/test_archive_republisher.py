@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+import pytest
+from modules import archive, archive_republisher
+from modules.archive_republisher import ArchiveRepublisher
+
+# 2025-02-01T00:00:00Z
+FEBRUARY_START_MS = 1738368000_000
+BATCH_RECORDS = 4
+
+
+class FakeMqttClient:
+    connected = True
+
+    def __init__(self) -> None:
+        self.batches: list[list[dict]] = []
+
+    def publish_telemetry(self, message: str) -> bool:
+        records = json.loads(message)
+        if isinstance(records, list):
+            self.batches.append(records)
+        return True
+
+
+# Fixture to run the republisher on the archive db with small batches, returns the fake mqtt client
+@pytest.fixture
+def mqtt_client(archive_db, monkeypatch) -> FakeMqttClient:
+    client = FakeMqttClient()
+    monkeypatch.setattr(archive_republisher, "GatewayMqttClient", lambda: client)
+    monkeypatch.setattr(archive_republisher, "TELEMETRY_BATCH_MAX_RECORDS", BATCH_RECORDS)
+    monkeypatch.setattr(archive_republisher, "ARCHIVE_REPUBLISH_MAX_BYTES_PER_SECOND", 10**9)
+    monkeypatch.setattr(archive_republisher, "singleton_instance", None)
+    for name, value in [("archive_db", None), ("job", None), ("job_thread", None),
+                        ("cancel_event", threading.Event())]:
+        monkeypatch.setattr(ArchiveRepublisher, name, value)
+    yield client
+    ArchiveRepublisher().cancel()
+    wait_for_job()
+
+
+def wait_for_job(timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while ArchiveRepublisher().status() is not None:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def archive_rows() -> list[tuple[int, dict]]:
+    """Archives runs of typed and untyped messages sharing a timestamp, longer than a batch, returns the
+    archived (timestamp_ms, values)"""
+    columns = archive.ARCHIVE_MESSAGE_TYPES["archive_co2"]
+    rows = []
+    for second in range(3):
+        for i in range(5):
+            rows.append((FEBRUARY_START_MS + second * 1000, {column: float(i) for column in columns}))
+            rows.append((FEBRUARY_START_MS + second * 1000, {"other": float(i)}))
+    assert archive.archive_messages([(n + 1, timestamp_ms, json.dumps(values))
+                                     for n, (timestamp_ms, values) in enumerate(rows)])
+    return rows
+
+
+def republished(client: FakeMqttClient) -> list[tuple[int, dict]]:
+    return [(record["ts"], record["values"]) for batch in client.batches for record in batch]
+
+
+def sort_key(row: tuple[int, dict]) -> tuple[int, str]:
+    return row[0], json.dumps(row[1], sort_keys=True)
+
+
+def test_republish_pages_across_equal_timestamps(archive_db, mqtt_client):
+    """Test that every message is republished once, although pages end within runs of equal timestamps."""
+    rows = archive_rows()
+    republisher = ArchiveRepublisher().init(archive_db)
+    assert republisher.start("1", FEBRUARY_START_MS - 1, FEBRUARY_START_MS + 3000) is None
+    wait_for_job()
+
+    assert all(len(batch) <= BATCH_RECORDS for batch in mqtt_client.batches)
+    assert sorted(republished(mqtt_client), key=sort_key) == sorted(rows, key=sort_key)
+    assert archive_db.execute(f"SELECT COUNT(*) FROM {archive_republisher.JOB_TABLE};") == [(0,)]
+
+
+def test_republish_resumes_from_the_persisted_cursor(archive_db, mqtt_client):
+    """Test that a job resumed after a restart continues after its cursor within a run of equal timestamps."""
+    rows = archive_rows()
+    # the job of a previous run, stopped after 7 of the 10 messages of the first timestamp
+    published = archive.read_archive_page(archive_db, FEBRUARY_START_MS + 3000, FEBRUARY_START_MS - 1,
+                                          archive.MAX_ARCHIVE_ID, 7)
+    cursor_id, cursor_timestamp_ms, _ = published[-1]
+    assert cursor_timestamp_ms == FEBRUARY_START_MS
+    ArchiveRepublisher().init(archive_db)
+    ArchiveRepublisher.job_thread = threading.Thread()  # keeps the job of the previous run from starting
+    assert ArchiveRepublisher().start("1", FEBRUARY_START_MS - 1, FEBRUARY_START_MS + 3000) is None
+    archive_db.execute(
+        f"UPDATE {archive_republisher.JOB_TABLE} SET cursor_timestamp_ms = ?, cursor_id = ?, republished_count = 7;",
+        (cursor_timestamp_ms, cursor_id))
+
+    # restart
+    ArchiveRepublisher.job, ArchiveRepublisher.job_thread = None, None
+    ArchiveRepublisher().init(archive_db)
+    wait_for_job()
+
+    resumed = republished(mqtt_client)
+    assert len(resumed) == len(rows) - 7
+    assert sorted(resumed + [(timestamp_ms, json.loads(message)) for _, timestamp_ms, message in published],
+                  key=sort_key) == sorted(rows, key=sort_key)
@@ -0,0 +1,112 @@
+from typing import Optional
+import json
+import time
+import pytest
+from docker.errors import APIError, ContainerError
+from modules import docker_client
+from modules.git_client import GatewayGitClient
+from modules.mqtt import GatewayMqttClient
+
+
+class FakeImage:
+    def __init__(self, tag: str, size: int) -> None:
+        self.tags = [tag]
+        self.attrs = {"Size": size}
+
+
+class FakeImages:
+    def __init__(self) -> None:
+        self.tags: set[str] = set()
+        self.removed: list[str] = []
+        self.prune_filters: list[dict] = []
+        self.build_error: Optional[Exception] = None
+
+    def list(self) -> list:
+        return [FakeImage(tag, 2_000_000_000) for tag in sorted(self.tags)]
+
+    def prune(self, filters: dict) -> None:
+        self.prune_filters.append(filters)
+
+    def build(self, tag: str, **kwargs) -> None:
+        self.tags.add(tag)  # a failed build can leave the image tagged
+        if self.build_error is not None:
+            raise self.build_error
+
+    def remove(self, tag: str, **kwargs) -> None:
+        self.tags.discard(tag)
+        self.removed.append(tag)
+
+
+class FakeContainers:
+    def __init__(self) -> None:
+        self.run_error: Optional[Exception] = None
+
+    def run(self, image: str, **kwargs) -> None:
+        if self.run_error is not None:
+            raise self.run_error
+
+
+class FakeDocker:
+    def __init__(self) -> None:
+        self.images = FakeImages()
+        self.containers = FakeContainers()
+
+
+# Fixture to create a docker client without a docker daemon, git repository or broker
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    sw_states: list[tuple] = []
+    monkeypatch.setattr(GatewayGitClient, "execute_fetch", lambda self, version: True)
+    monkeypatch.setattr(GatewayGitClient, "get_commit_from_hash_or_tag", lambda self, version: "0" * 40)
+    monkeypatch.setattr(GatewayGitClient, "execute_reset_to_commit", lambda self, commit: True)
+    monkeypatch.setattr(GatewayMqttClient, "publish_sw_state",
+                        lambda self, version, state, msg="": sw_states.append((version, state)))
+    monkeypatch.setattr(GatewayMqttClient, "publish_telemetry", lambda self, message: True)
+    client = object.__new__(docker_client.GatewayDockerClient)
+    monkeypatch.setattr(docker_client, "CONTROLLER_IMAGE_USAGE_PATH", str(tmp_path / "controller_image_usage.json"))
+    client.docker_client = FakeDocker()
+    # no controller is running
+    client.controller_container_attrs = None
+    client.controller_state_reconcile_ts = time.monotonic()
+    client.ota_target_version = None
+    client.sw_states = sw_states
+    return client
+
+
+IMAGE_TAG = docker_client.CONTROLLER_IMAGE_PREFIX + "v1.0.0:latest"
+
+
+def test_stage_controller_image(client):
+    assert client.stage_controller_image("v1.0.0")
+    assert client.docker_client.images.tags == {IMAGE_TAG}
+    assert client.sw_states[-1] == ("v1.0.0", "VERIFIED")
+
+
+@pytest.mark.parametrize("build_error, run_error", [
+    (APIError("build failed"), None),
+    (None, ContainerError("container", 1, "compileall", "image", b"")),
+    (None, APIError("daemon not responding")),
+])
+def test_failed_image_is_removed(client, build_error, run_error):
+    """Test that an image is never left tagged if it failed to build or verify."""
+    client.docker_client.images.build_error = build_error
+    client.docker_client.containers.run_error = run_error
+    assert not client.stage_controller_image("v1.0.0")
+    assert client.docker_client.images.tags == set()
+    assert client.sw_states[-1] == ("v1.0.0", "FAILED")
+
+
+def test_evict_controller_images(client, monkeypatch):
+    """Test that the least recently used images are removed until they fit into the budget and only
+    dangling controller images are pruned, so the build cache is kept."""
+    monkeypatch.setattr(docker_client, "CONTROLLER_IMAGES_MAX_BYTES", 4_000_000_000)
+    monkeypatch.setattr(docker_client, "CONTROLLER_IMAGES_KEEP_PREVIOUS", 0)
+    versions = ["v1.0.0", "v1.1.0", "v1.2.0"]
+    client.docker_client.images.tags = {docker_client.CONTROLLER_IMAGE_PREFIX + v + ":latest" for v in versions}
+    with open(docker_client.CONTROLLER_IMAGE_USAGE_PATH, "w") as f:
+        json.dump({version: i for i, version in enumerate(versions)}, f)
+
+    client.evict_controller_images()
+    assert client.docker_client.images.removed == [docker_client.CONTROLLER_IMAGE_PREFIX + "v1.0.0:latest"]
+    assert client.docker_client.images.prune_filters == [
+        {"dangling": True, "label": docker_client.CONTROLLER_IMAGE_LABEL}]
@@ -0,0 +1,138 @@
+import json
+import os
+import random
+from hashlib import md5
+import pytest
+from modules import file_transfer
+from utils import file_delta
+
+BLOCK_SIZE = 16
+
+
+def transfer_part(**values) -> dict:
+    return {"transfer_id": "t", "part": 0, "parts": 1, "hash": "", "block_size": 4096, "ops": [], **values}
+
+
+# Fixture to stage the transfers in a temporary directory, returns the published transfer states
+@pytest.fixture
+def transfer_states(tmp_path, monkeypatch) -> list[dict]:
+    monkeypatch.setattr(file_transfer, "FILE_TRANSFERS_PATH", str(tmp_path / "file_transfers"))
+    states: list[dict] = []
+
+    class FakeMqttClient:
+        def publish_message_raw(self, _topic: str, message: str) -> None:
+            states.append(json.loads(message)[file_transfer.FILE_TRANSFER_PREFIX + "config"])
+
+    monkeypatch.setattr(file_transfer, "GatewayMqttClient", FakeMqttClient)
+    return states
+
+
+@pytest.fixture
+def base_file(tmp_path) -> str:
+    path = tmp_path / "config.txt"
+    path.write_bytes(random.Random(0).randbytes(10 * BLOCK_SIZE + 5))
+    return str(path)
+
+
+def read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def delta_parts(base_file: str, content: bytes, parts: int, transfer_id: str = "t1", **values) -> list[dict]:
+    """The transfer of `content` as a delta against the base file, its ops split into `parts` parts"""
+    base = read(base_file)
+    ops = file_delta.compute_delta(file_delta.block_signatures(base, BLOCK_SIZE), BLOCK_SIZE, content)
+    assert len(ops) >= parts
+    bounds = [len(ops) * n // parts for n in range(parts + 1)]
+    return [{"format": file_transfer.FILE_TRANSFER_FORMAT, "transfer_id": transfer_id, "part": n, "parts": parts,
+             "hash": md5(content).hexdigest(), "base_hash": md5(base).hexdigest(), "block_size": BLOCK_SIZE,
+             "ops": ops[bounds[n]:bounds[n + 1]], **values}
+            for n in range(parts)]
+
+
+def changed_content(base_file: str) -> bytes:
+    base = read(base_file)
+    return base[:3 * BLOCK_SIZE] + b"inserted" + base[3 * BLOCK_SIZE:6 * BLOCK_SIZE] + b"data" + base[7 * BLOCK_SIZE:]
+
+
+def staging_path() -> str:
+    return os.path.join(file_transfer.FILE_TRANSFERS_PATH, "config")
+
+
+def test_only_marked_parts_are_transfers():
+    """Test that the content of JSON files with the same keys is not mistaken for a transfer part."""
+    assert file_transfer.is_file_transfer_part(transfer_part(format=file_transfer.FILE_TRANSFER_FORMAT))
+    assert not file_transfer.is_file_transfer_part(transfer_part())
+    assert not file_transfer.is_file_transfer_part(transfer_part(format="json"))
+    assert not file_transfer.is_file_transfer_part("text content")
+
+
+def test_transfer_is_staged_until_all_parts_are_received(transfer_states, base_file):
+    """Test that parts are staged on disk in any order, the missing parts are reported and the file is only
+    written once all parts are received."""
+    base, content = read(base_file), changed_content(base_file)
+    parts = delta_parts(base_file, content, 3)
+
+    assert not file_transfer.receive_file_transfer_part("config", base_file, parts[2])
+    assert not file_transfer.receive_file_transfer_part("config", base_file, parts[0])
+    assert [(state["state"], state["missing_parts"]) for state in transfer_states] == \
+        [("RECEIVING", [0, 1]), ("RECEIVING", [1])]
+    assert sorted(os.listdir(staging_path())) == ["part_0.json", "part_2.json", "transfer.json"]
+    assert read(base_file) == base
+
+    assert file_transfer.receive_file_transfer_part("config", base_file, parts[1])
+    assert transfer_states[-1] == {"transfer_id": "t1", "state": "COMPLETE", "missing_parts": [], "error": ""}
+    assert read(base_file) == content
+    assert not os.path.exists(staging_path())
+
+
+def test_transfer_resumes_after_restart(transfer_states, base_file):
+    """Test that the parts staged before a restart are kept, while a new transfer discards an unfinished one."""
+    content = changed_content(base_file)
+    parts = delta_parts(base_file, content, 3)
+    assert not file_transfer.receive_file_transfer_part("config", base_file, parts[0])
+    assert not file_transfer.receive_file_transfer_part("config", base_file, parts[1])
+
+    # the staged parts are only on disk, a resent part is staged again
+    assert not file_transfer.receive_file_transfer_part("config", base_file, parts[1])
+    assert transfer_states[-1]["missing_parts"] == [2]
+    assert file_transfer.receive_file_transfer_part("config", base_file, parts[2])
+    assert read(base_file) == content
+
+    # a part of another transfer restarts the staging
+    newer = delta_parts(base_file, content + b"appended", 2, transfer_id="t2")
+    assert not file_transfer.receive_file_transfer_part("config", base_file, newer[1])
+    older = delta_parts(base_file, content + b"changed", 2, transfer_id="t3")
+    assert not file_transfer.receive_file_transfer_part("config", base_file, older[0])
+    assert (transfer_states[-1]["transfer_id"], transfer_states[-1]["missing_parts"]) == ("t3", [1])
+    assert sorted(os.listdir(staging_path())) == ["part_0.json", "transfer.json"]
+
+
+def test_transfer_fails_if_the_base_file_changed(transfer_states, base_file):
+    """Test that a delta is not applied to a file that changed since the transfer started."""
+    parts = delta_parts(base_file, changed_content(base_file), 2)
+    assert not file_transfer.receive_file_transfer_part("config", base_file, parts[0])
+    with open(base_file, "ab") as f:
+        f.write(b"local change")
+    changed = read(base_file)
+
+    assert not file_transfer.receive_file_transfer_part("config", base_file, parts[1])
+    assert transfer_states[-1] == {"transfer_id": "t1", "state": "FAILED", "missing_parts": [],
+                                   "error": "base file changed"}
+    assert read(base_file) == changed
+    assert not os.path.exists(staging_path())
+
+
+def test_transfer_with_hash_mismatch_keeps_the_file(transfer_states, base_file):
+    """Test that an assembled file with the wrong hash doesn't replace the file."""
+    base = read(base_file)
+    parts = delta_parts(base_file, changed_content(base_file), 2, hash=md5(b"other content").hexdigest())
+    assert not file_transfer.receive_file_transfer_part("config", base_file, parts[0])
+
+    assert not file_transfer.receive_file_transfer_part("config", base_file, parts[1])
+    assert transfer_states[-1]["state"] == "FAILED"
+    assert transfer_states[-1]["error"].startswith("hash mismatch")
+    assert read(base_file) == base
+    assert sorted(os.listdir(os.path.dirname(base_file))) == ["config.txt", "file_transfers"]
+    assert not os.path.exists(staging_path())
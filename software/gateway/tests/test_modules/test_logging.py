@@ -0,0 +1,55 @@
+from queue import Queue
+import pytest
+from modules import logging, sqlite
+
+
+class FakeMqttClient:
+    connected = True
+    publish_succeeds = True
+    published: list[str] = []
+
+    def publish_telemetry(self, message: str) -> bool:
+        if self.publish_succeeds:
+            self.published.append(message)
+        return self.publish_succeeds
+
+
+# Fixture to create the log buffer db and a broker connection which is up
+@pytest.fixture
+def buffer_db(tmp_path, monkeypatch):
+    db = sqlite.SqliteConnection(str(tmp_path / "gateway_logs_buffer.db"))
+    db.execute(logging.LOG_BUFFER_TABLE_SCHEMA)
+    monkeypatch.setattr(logging, "gateway_logs_buffer_db", db)
+    monkeypatch.setattr(logging, "GatewayMqttClient", FakeMqttClient)
+    monkeypatch.setattr(FakeMqttClient, "published", [])
+    yield db
+    db.close()
+
+
+def buffered_count(db) -> int:
+    return db.execute("SELECT COUNT(*) FROM log_buffer;")[0][0]
+
+
+def test_buffered_logs_are_kept_while_publishing_fails(buffer_db, monkeypatch):
+    """Test that the shipper stops draining the buffer when publishing fails instead of retrying at once."""
+    logging._spill_batch([("ERROR", f"message {i}", 1_750_000_000_000 + i) for i in range(3)])
+    monkeypatch.setattr(FakeMqttClient, "publish_succeeds", False)
+    assert logging._publish_buffered_batch() == (True, False)
+    monkeypatch.setattr(FakeMqttClient, "publish_succeeds", True)
+    monkeypatch.setattr(FakeMqttClient, "connected", False)
+    assert logging._publish_buffered_batch() == (True, False)
+    assert buffered_count(buffer_db) == 3
+
+    monkeypatch.setattr(FakeMqttClient, "connected", True)
+    assert logging._publish_buffered_batch() == (True, True)
+    assert buffered_count(buffer_db) == 0
+    assert len(FakeMqttClient.published) == 1
+    assert logging._publish_buffered_batch() == (False, False)
+
+
+def test_dropped_logs_are_counted(monkeypatch):
+    monkeypatch.setattr(logging, "log_queue", Queue(maxsize=1))
+    monkeypatch.setitem(logging.log_counters, "gateway_dropped_logs", 0)
+    logging.error("queued")
+    logging.error("dropped")
+    assert logging.log_counters["gateway_dropped_logs"] == 1
@@ -0,0 +1,156 @@
+import json
+import queue
+import time
+from typing import Optional
+import pytest
+from modules import archive, outbox, sqlite
+from modules.sqlite import MessagePriority
+
+
+class FakeMqttClient:
+    """Records the published telemetry batches, acks are put into `ack_queue` by the tests"""
+
+    def __init__(self) -> None:
+        self.ack_queue: queue.Queue = queue.Queue()
+        self.published: dict[int, list[dict]] = {}
+
+    def publish_qos1(self, topic: str, payload: str) -> int:
+        mid = len(self.published) + 1
+        self.published[mid] = json.loads(payload)
+        return mid
+
+    def ack(self, *mids: int) -> None:
+        for mid in mids:
+            self.ack_queue.put((mid, time.monotonic()))
+
+
+# Fixture to create the communication queue db written by the controller
+@pytest.fixture
+def communication_db(tmp_path):
+    db = sqlite.SqliteConnection(str(tmp_path / "communication_queue.db"))
+    sqlite.create_messages_table(db, outbox.MESSAGES_TABLE)
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def mqtt_client():
+    return FakeMqttClient()
+
+
+def enqueue(db, count: int, priority: int = MessagePriority.LIVE, message_type: str = "measurement",
+            ts_ms: Optional[int] = None) -> None:
+    ts_ms = ts_ms or int(time.time() * 1000)
+    assert db.execute_transaction([
+        (f"INSERT INTO {outbox.MESSAGES_TABLE} (ts_ms, type, priority, payload) VALUES (?, ?, ?, ?);",
+         [(ts_ms + i, message_type, int(priority), json.dumps({"value": i})) for i in range(count)]),
+    ])
+
+
+def remaining_ids(db) -> list[int]:
+    return [row[0] for row in db.execute(f"SELECT id FROM {outbox.MESSAGES_TABLE} ORDER BY id;")]
+
+
+def publish_all(controller_outbox, mqtt_client) -> list[int]:
+    """Publishes until the outbox is idle, returns the mids of the new publishes"""
+    published_before = len(mqtt_client.published)
+    while controller_outbox.archive_next_range() > 0 or controller_outbox.publish_next_range(mqtt_client) > 0:
+        pass
+    return list(range(published_before + 1, len(mqtt_client.published) + 1))
+
+
+def test_publish_ranges_by_priority_and_ack(communication_db, archive_db, mqtt_client, monkeypatch):
+    """Test that the ranges of a lane are only deleted once they and all ranges before them are acked."""
+    monkeypatch.setattr(outbox, "TELEMETRY_BATCH_MAX_RECORDS", 2)
+    enqueue(communication_db, 4)
+    enqueue(communication_db, 1, MessagePriority.CALIBRATION)
+    controller_outbox = outbox.ControllerOutbox(communication_db, archive_db)
+
+    mids = publish_all(controller_outbox, mqtt_client)
+    assert [len(mqtt_client.published[mid]) for mid in mids] == [2, 1, 2]
+    assert [record["values"]["value"] for record in mqtt_client.published[mids[0]]] == [0, 1]
+    assert controller_outbox.lane_tails == {MessagePriority.LIVE: 4, MessagePriority.CALIBRATION: 5}
+
+    # the second range of the live lane is acked first
+    mqtt_client.ack(mids[2], mids[1])
+    assert controller_outbox.process_acks(mqtt_client) == 2
+    assert remaining_ids(communication_db) == [1, 2, 3, 4]
+    mqtt_client.ack(mids[0])
+    controller_outbox.process_acks(mqtt_client)
+    assert remaining_ids(communication_db) == []
+    assert len(controller_outbox.in_flight_lanes) == 0
+
+    # the watermarks are persisted
+    restarted_outbox = outbox.ControllerOutbox(communication_db, archive_db)
+    assert restarted_outbox.archived_up_to_id == 5
+    assert restarted_outbox.acked_up_to_ids[MessagePriority.LIVE] == 4
+    assert restarted_outbox.acked_up_to_ids[MessagePriority.CALIBRATION] == 5
+
+
+def test_logs_are_published_but_not_archived(communication_db, archive_db, mqtt_client):
+    enqueue(communication_db, 2, MessagePriority.LOG, message_type="log")
+    enqueue(communication_db, 1)
+    controller_outbox = outbox.ControllerOutbox(communication_db, archive_db)
+
+    mids = publish_all(controller_outbox, mqtt_client)
+    assert sum(len(mqtt_client.published[mid]) for mid in mids) == 3
+    assert controller_outbox.archived_up_to_id == 3
+    assert archive.count_archive_messages(archive_db, 0, archive.MAX_ARCHIVE_TIMESTAMP_MS) == 1
+
+
+def test_late_live_messages_are_backfilled(communication_db, archive_db, mqtt_client):
+    """Test that live messages older than `LIVE_MESSAGE_MAX_AGE_MS` are published after fresh ones."""
+    enqueue(communication_db, 2, ts_ms=int(time.time() * 1000) - 2 * outbox.LIVE_MESSAGE_MAX_AGE_MS)
+    enqueue(communication_db, 1)
+    controller_outbox = outbox.ControllerOutbox(communication_db, archive_db)
+
+    mids = publish_all(controller_outbox, mqtt_client)
+    assert [len(mqtt_client.published[mid]) for mid in mids] == [1, 2]
+    assert controller_outbox.lane_tails == {MessagePriority.LIVE: 3, MessagePriority.BACKFILL: 2}
+
+
+def test_lane_is_resent_after_ack_timeout(communication_db, archive_db, mqtt_client, monkeypatch):
+    """Test that a lane is sent again from its acked watermark if an ack times out."""
+    monkeypatch.setattr(outbox, "TELEMETRY_BATCH_MAX_RECORDS", 1)
+    enqueue(communication_db, 3)
+    controller_outbox = outbox.ControllerOutbox(communication_db, archive_db)
+    mids = publish_all(controller_outbox, mqtt_client)
+    assert len(mids) == 3
+    mqtt_client.ack(mids[0])
+    controller_outbox.process_acks(mqtt_client)
+
+    monkeypatch.setattr(outbox, "PUBLISH_ACK_TIMEOUT_SECONDS", 0)
+    controller_outbox.process_acks(mqtt_client)
+    assert len(controller_outbox.in_flight_lanes) == 0
+    # late acks of the expired publishes are ignored
+    mqtt_client.ack(mids[1])
+    monkeypatch.setattr(outbox, "PUBLISH_ACK_TIMEOUT_SECONDS", 30)
+    assert controller_outbox.process_acks(mqtt_client) == 0
+    assert remaining_ids(communication_db) == [2, 3]
+
+    resent_mids = publish_all(controller_outbox, mqtt_client)
+    assert [mqtt_client.published[mid][0]["values"]["value"] for mid in resent_mids] == [1, 2]
+    mqtt_client.ack(*resent_mids)
+    controller_outbox.process_acks(mqtt_client)
+    assert remaining_ids(communication_db) == []
+
+
+def test_watermarks_are_reset_when_the_queue_db_is_recreated(communication_db, archive_db, mqtt_client):
+    enqueue(communication_db, 3)
+    controller_outbox = outbox.ControllerOutbox(communication_db, archive_db)
+    mids = publish_all(controller_outbox, mqtt_client)
+
+    communication_db.reset_db_conn("test")
+    assert controller_outbox.archive_next_range() == 0
+    assert controller_outbox.archived_up_to_id == 0
+    assert len(controller_outbox.in_flight_lanes) == 0
+    # acks of publishes before the reset are ignored
+    mqtt_client.ack(*mids)
+    assert controller_outbox.process_acks(mqtt_client) == 0
+
+    enqueue(communication_db, 2)
+    mids = publish_all(controller_outbox, mqtt_client)
+    assert sum(len(mqtt_client.published[mid]) for mid in mids) == 2
+    mqtt_client.ack(*mids)
+    controller_outbox.process_acks(mqtt_client)
+    assert remaining_ids(communication_db) == []
@@ -0,0 +1,136 @@
+import json
+import sys
+import time
+import pytest
+import utils.paths
+from modules import archive
+from on_mqtt_msg import on_rpc_request
+
+# 2025-02-01T00:00:00Z
+FEBRUARY_START_MS = 1738368000_000
+HOUR_MS = 3600_000
+DAY_MS = 24 * HOUR_MS
+
+
+# Fixture to collect the responses and errors sent by the RPC methods
+@pytest.fixture
+def rpc_replies(monkeypatch):
+    replies: dict[str, list] = {"responses": [], "errors": []}
+    monkeypatch.setattr(on_rpc_request, "send_rpc_response",
+                        lambda _rpc_msg_id, response: replies["responses"].append(response))
+    monkeypatch.setattr(on_rpc_request, "send_rpc_method_error",
+                        lambda _rpc_msg_id, msg: replies["errors"].append(msg))
+    return replies
+
+
+# Fixture to collect the telemetry published by the RPC methods
+@pytest.fixture
+def telemetry(monkeypatch) -> list[dict]:
+    messages: list[dict] = []
+
+    class FakeMqttClient:
+        def publish_telemetry(self, message: str) -> None:
+            messages.append(json.loads(message)["values"])
+
+    monkeypatch.setattr(on_rpc_request, "GatewayMqttClient", FakeMqttClient)
+    return messages
+
+
+def run_command(command: list[str], **params) -> None:
+    on_rpc_request.rpc_run_command("1", "run_command", {"command": command, **params})
+
+
+def test_run_command_output_is_capped(rpc_replies, telemetry, monkeypatch):
+    """Test that the streamed output stops at `max_output_bytes` and the response only holds the output tail."""
+    monkeypatch.setattr(on_rpc_request, "RUN_COMMAND_TAIL_BYTES", 1000)
+    script = "for i in range(200): print(f'{i:03d}' + 'x' * 96)"
+    run_command([sys.executable, "-c", script], chunk_bytes=1000, max_output_bytes=5000)
+
+    assert rpc_replies["errors"] == []
+    response = rpc_replies["responses"][0]
+    assert response.startswith("OK - Command executed - ")
+    assert "exited with code 0" in response
+    # 200 lines of 100 bytes, the last 10 lines fit into the tail
+    assert "[19000 bytes truncated] 190x" in response
+    assert response.endswith("199" + "x" * 96 + "\n")
+
+    assert [chunk["run_command_seq"] for chunk in telemetry] == list(range(len(telemetry)))
+    assert "".join(chunk["run_command_output"] for chunk in telemetry) == \
+        "".join(f"{i:03d}" + "x" * 96 + "\n" for i in range(50))
+    assert all(len(chunk["run_command_output"].encode()) <= 5000 for chunk in telemetry)
+    assert [chunk["run_command_final"] for chunk in telemetry] == [False] * (len(telemetry) - 1) + [True]
+    assert telemetry[-1]["run_command_truncated"]
+
+
+def test_run_command_timeout(rpc_replies, telemetry):
+    """Test that a command is killed after `timeout_s` and its output so far is returned with the error."""
+    start = time.monotonic()
+    run_command([sys.executable, "-u", "-c", "import time; print('started'); time.sleep(10)"], timeout_s=1)
+    assert time.monotonic() - start < 5
+
+    assert rpc_replies["responses"] == []
+    assert "Timeout after 1 seconds" in rpc_replies["errors"][0]
+    assert rpc_replies["errors"][0].endswith("Output: started\n")
+    assert telemetry[-1]["run_command_final"]
+
+
+def test_run_command_doesnt_wait_for_children_holding_the_output(rpc_replies, telemetry, monkeypatch):
+    """Test that a background child keeping the pipe open doesn't block the response."""
+    monkeypatch.setattr(on_rpc_request, "RUN_COMMAND_DRAIN_SECONDS", 0.2)
+    start = time.monotonic()
+    run_command(["sh", "-c", "echo done; sleep 5 &"], timeout_s=10)
+    assert time.monotonic() - start < 3
+
+    assert rpc_replies["errors"] == []
+    assert rpc_replies["responses"][0].endswith("Output: done\n[output of child processes truncated]\n")
+
+
+def archive_query(start_timestamp_ms, end_timestamp_ms, bucket_ms: int = HOUR_MS, field: str = "co2"):
+    params = {"start_timestamp_ms": start_timestamp_ms, "end_timestamp_ms": end_timestamp_ms,
+              "field": field, "bucket_ms": bucket_ms}
+    on_rpc_request.rpc_archive_query("1", "archive_query", {k: v for k, v in params.items() if v is not None})
+
+
+def test_archive_query_buckets(archive_db, rpc_replies, monkeypatch):
+    """Test that the query aggregates the values of a field per bucket of the time range."""
+    monkeypatch.setattr(utils.paths, "GATEWAY_ARCHIVE_DB_PATH", archive_db.path)
+    assert archive.archive_messages([
+        (i + 1, FEBRUARY_START_MS + (i * 20 + 10) * 60_000, json.dumps({"co2": float(i)})) for i in range(6)])
+
+    archive_query(FEBRUARY_START_MS, FEBRUARY_START_MS + DAY_MS)
+    assert rpc_replies["errors"] == []
+    assert rpc_replies["responses"][0]["rows"] == [
+        [FEBRUARY_START_MS, 0.0, 1.0, 2.0, 3], [FEBRUARY_START_MS + HOUR_MS, 3.0, 4.0, 5.0, 3]]
+
+
+@pytest.mark.parametrize("start_timestamp_ms, end_timestamp_ms, bucket_ms", [
+    # missing, reversed and empty ranges
+    (None, FEBRUARY_START_MS, HOUR_MS),
+    (FEBRUARY_START_MS, None, HOUR_MS),
+    (FEBRUARY_START_MS + DAY_MS, FEBRUARY_START_MS, HOUR_MS),
+    (FEBRUARY_START_MS, FEBRUARY_START_MS, HOUR_MS),
+    # outside of the archive's timestamp range
+    (0, FEBRUARY_START_MS, DAY_MS),
+    (FEBRUARY_START_MS, archive.MAX_ARCHIVE_TIMESTAMP_MS, 30 * DAY_MS),
+    # longer than the max. span, even with few buckets
+    (FEBRUARY_START_MS, FEBRUARY_START_MS + on_rpc_request.ARCHIVE_QUERY_MAX_SPAN_MS + 1, 100 * DAY_MS),
+    # more than the max. number of buckets
+    (FEBRUARY_START_MS, FEBRUARY_START_MS + (on_rpc_request.ARCHIVE_QUERY_MAX_BUCKETS + 1) * 1000, 1000),
+])
+def test_archive_query_rejects_invalid_ranges(archive_db, rpc_replies, monkeypatch, start_timestamp_ms,
+                                              end_timestamp_ms, bucket_ms):
+    """Test that invalid and oversized time ranges are rejected with an error before reading the archive."""
+    monkeypatch.setattr(utils.paths, "GATEWAY_ARCHIVE_DB_PATH", archive_db.path)
+    archive_query(start_timestamp_ms, end_timestamp_ms, bucket_ms)
+    assert rpc_replies["responses"] == []
+    assert len(rpc_replies["errors"]) == 1
+    assert rpc_replies["errors"][0].startswith("Querying archive failed: ")
+
+
+def test_archive_query_bucket_cap(archive_db, rpc_replies, monkeypatch):
+    """Test that a range of exactly the max. number of buckets is accepted."""
+    monkeypatch.setattr(utils.paths, "GATEWAY_ARCHIVE_DB_PATH", archive_db.path)
+    archive_query(FEBRUARY_START_MS, FEBRUARY_START_MS + on_rpc_request.ARCHIVE_QUERY_MAX_BUCKETS * 1000, 1000)
+    assert rpc_replies["errors"] == []
+    assert rpc_replies["responses"] == [
+        {"field": "co2", "bucket_ms": 1000, "columns": ["ts", "min", "mean", "max", "count"], "rows": []}]
@@ -0,0 +1,69 @@
+import io
+import random
+import pytest
+from utils import file_delta
+
+BLOCK_SIZE = 16
+
+
+def round_trip(base: bytes, content: bytes) -> tuple[bytes, list[list]]:
+    ops = file_delta.compute_delta(file_delta.block_signatures(base, BLOCK_SIZE), BLOCK_SIZE, content)
+    target = io.BytesIO()
+    file_delta.apply_delta(io.BytesIO(base), ops, BLOCK_SIZE, target)
+    return target.getvalue(), ops
+
+
+@pytest.fixture
+def base() -> bytes:
+    return random.Random(0).randbytes(10 * BLOCK_SIZE + 5)
+
+
+def test_unchanged_content_is_a_single_copy(base):
+    content, ops = round_trip(base, base)
+    assert content == base
+    assert ops == [["copy", 0, 11]]
+
+
+def test_inserted_and_removed_bytes(base):
+    """Test that the blocks around a change are copied and only the change is sent as data."""
+    changed = base[:3 * BLOCK_SIZE] + b"inserted" + base[3 * BLOCK_SIZE:6 * BLOCK_SIZE] + base[7 * BLOCK_SIZE:]
+    content, ops = round_trip(base, changed)
+    assert content == changed
+    assert ops[0] == ["copy", 0, 3]
+    assert sum(len(op[1]) for op in ops if op[0] == "data") < 2 * BLOCK_SIZE
+
+
+def test_changed_tail(base):
+    """Test that content ending in a different, shorter last block is reassembled."""
+    for changed in [base[:-2], base + b"appended", base[:4 * BLOCK_SIZE]]:
+        content, _ = round_trip(base, changed)
+        assert content == changed
+
+
+def test_empty_base_and_content(base):
+    content, ops = round_trip(b"", base)
+    assert content == base
+    assert [op[0] for op in ops] == ["data"]
+
+    content, ops = round_trip(base, b"")
+    assert content == b""
+    assert ops == []
+
+
+def test_random_edits_round_trip(base):
+    rng = random.Random(1)
+    for _ in range(50):
+        changed = bytearray(base)
+        for _ in range(rng.randint(1, 5)):
+            position = rng.randint(0, len(changed))
+            if rng.random() < 0.5:
+                changed[position:position] = rng.randbytes(rng.randint(1, 2 * BLOCK_SIZE))
+            else:
+                del changed[position:position + rng.randint(1, 2 * BLOCK_SIZE)]
+        content, _ = round_trip(base, bytes(changed))
+        assert content == bytes(changed)
+
+
+def test_unknown_operation_is_rejected():
+    with pytest.raises(ValueError):
+        file_delta.apply_delta(io.BytesIO(b""), [["move", 0, 1]], BLOCK_SIZE, io.BytesIO())
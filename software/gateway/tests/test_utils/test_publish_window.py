@@ -0,0 +1,54 @@
+from utils import publish_window
+
+
+def send_and_ack(window: publish_window.AdaptivePublishWindow, first_mid: int, count: int, now: float,
+                 rtt: float) -> None:
+    for mid in range(first_mid, first_mid + count):
+        window.on_send(mid, now)
+    for mid in range(first_mid, first_mid + count):
+        assert window.on_ack(mid, now + rtt)
+
+
+def test_window_grows_while_the_rtt_is_at_its_base():
+    window = publish_window.AdaptivePublishWindow()
+    send_and_ack(window, 1, 4, 0, 0.1)
+    assert window.size > publish_window.PUBLISH_WINDOW_INITIAL
+
+    for i in range(1000):
+        send_and_ack(window, 10 + i, 1, i, 0.1)
+    assert window.size == publish_window.PUBLISH_WINDOW_MAX
+
+
+def test_window_shrinks_while_publishes_are_queued():
+    """Test that the window shrinks once the RTT grows above the base RTT, i.e. publishes are queued."""
+    window = publish_window.AdaptivePublishWindow()
+    window.size = 16
+    send_and_ack(window, 1, 1, 0, 0.1)
+    send_and_ack(window, 2, 20, 1, 1.0)
+    assert window.size < 16
+    assert window.stats()["mqtt_base_rtt_ms"] == 100
+
+
+def test_timeout_halves_the_window():
+    window = publish_window.AdaptivePublishWindow()
+    window.size = 8
+    for mid in range(1, 9):
+        window.on_send(mid, mid)
+    assert window.is_full()
+
+    # only the publishes older than the timeout expire
+    assert window.expire(now=14, timeout=10) == [1, 2, 3]
+    assert window.size == 4
+    assert window.timeout_count == 3
+    # late acks of expired publishes are ignored
+    assert not window.on_ack(1, 15)
+    assert window.on_ack(4, 15)
+
+
+    # the window never shrinks below its minimum
+    for mid in range(5, 9):
+        window.forget(mid)
+    for i in range(5):
+        window.on_send(10 + i, 100 * i)
+        assert window.expire(now=100 * i + 11, timeout=10) == [10 + i]
+    assert window.size == publish_window.PUBLISH_WINDOW_MIN
@@ -0,0 +1,80 @@
+import threading
+import time
+from utils.rpc_worker_pool import RpcWorkerPool
+
+
+def wait_until(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def blocking_job(release: threading.Event, ran: list[str], rpc_msg_id: str):
+    def run() -> None:
+        ran.append(rpc_msg_id)
+        release.wait(5)
+    return run
+
+
+def test_concurrency_limit_per_method():
+    """Test that a method runs at most `max_concurrent` times, while other methods are still accepted."""
+    pool = RpcWorkerPool(workers=2, max_queued=10)
+    release, ran = threading.Event(), []
+    assert pool.submit("1", "run_command", blocking_job(release, ran, "1"), max_concurrent=1) is None
+    assert pool.submit("2", "run_command", blocking_job(release, ran, "2"), max_concurrent=1) == \
+        "'run_command' is already running 1 time(s)"
+    assert pool.submit("1", "reboot", blocking_job(release, ran, "1"), max_concurrent=1) == \
+        "request 1 is already running"
+    assert pool.submit("3", "reboot", blocking_job(release, ran, "3"), max_concurrent=1) is None
+    assert wait_until(lambda: sorted(ran) == ["1", "3"])
+
+    # the slot of a method is free again once its job finished
+    release.set()
+    assert wait_until(lambda: pool.running_jobs() == [])
+    assert pool.submit("2", "run_command", lambda: ran.append("2"), max_concurrent=1) is None
+    assert wait_until(lambda: "2" in ran)
+
+
+def test_queue_limit():
+    """Test that jobs waiting for a busy worker are rejected beyond `max_queued`."""
+    pool = RpcWorkerPool(workers=1, max_queued=1)
+    release, ran = threading.Event(), []
+    assert pool.submit("1", "a", blocking_job(release, ran, "1"), max_concurrent=5) is None
+    assert wait_until(lambda: ran == ["1"])
+    assert pool.submit("2", "a", blocking_job(release, ran, "2"), max_concurrent=5) is None
+    assert pool.submit("3", "a", blocking_job(release, ran, "3"), max_concurrent=5) == "too many queued requests"
+    release.set()
+    assert wait_until(lambda: pool.running_jobs() == [])
+    assert ran == ["1", "2"]
+
+
+def test_cancel_queued_and_running_jobs():
+    """Test that a queued job is dropped before it starts, and a running job sees its cancellation."""
+    pool = RpcWorkerPool(workers=1, max_queued=10)
+    release, ran, cancelled = threading.Event(), [], []
+
+    def cancellable() -> None:
+        ran.append("1")
+        wait_until(lambda: pool.is_cancelled("1"))
+        cancelled.append(pool.is_cancelled("1"))
+        release.wait(5)
+
+    assert pool.submit("1", "a", cancellable, max_concurrent=5) is None
+    assert wait_until(lambda: ran == ["1"])
+    assert pool.submit("2", "a", blocking_job(release, ran, "2"), max_concurrent=5) is None
+    assert pool.running_jobs() == [("1", "a", True), ("2", "a", False)]
+
+    assert pool.cancel("2") is False
+    assert pool.running_jobs() == [("1", "a", True)]
+    assert pool.cancel("1") is True
+    assert wait_until(lambda: cancelled == [True])
+    assert pool.cancel("unknown") is None
+
+    release.set()
+    assert wait_until(lambda: pool.running_jobs() == [])
+    # the dropped job never ran
+    time.sleep(0.05)
+    assert ran == ["1"]